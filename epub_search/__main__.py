@@ -38,9 +38,21 @@ try:
 except ImportError:
     from io import StringIO # Python 3
 
+from epub_search import cache
+from epub_search import estimate
+from epub_search import flatfile
+from epub_search import fuzzy
 from epub_search import matching
+from epub_search import query
+from epub_search import rank
+from epub_search import resume
 from epub_search import search
 from epub_search import util
+from epub_search import watch
+
+
+# How many times a second the progress is drawn
+_PROGRESS_RATE = 10.0
 
 
 class LogLevel:
@@ -72,11 +84,60 @@ def _parse_args(argv):
     parser = argparse.ArgumentParser(description='Search ePub contents.')
     parser.add_argument('-c', '--context', action='store_true',
                         help='print the match in the context of the paragraph')
+    parser.add_argument('--context-chars', metavar='N', type=int,
+                        default=None,
+                        help='print at most N characters of context on '
+                             'either side of the match, implies --context')
+    parser.add_argument('--max-snippets', metavar='N', type=int,
+                        default=None,
+                        help='print the context of at most N matches '
+                             'for each book')
     parser.add_argument('-i', '--ignore-case', action='store_true',
                         help='ignore case when searching')
+    parser.add_argument('--fold', action='store_true',
+                        help='ignore case and accents when searching, '
+                             'so cafe also matches café')
+    parser.add_argument('--query', action='store_true',
+                        help='the pattern is a boolean query of words and '
+                             '"phrases" with AND, OR, NOT, NEAR/N and ()')
+    parser.add_argument('--fuzzy', metavar='K', type=int, default=None,
+                        help='match the pattern as text with at most K '
+                             'inserted, deleted or changed characters')
     parser.add_argument('-s', '--sort', default=None,
                         choices=['author', 'title'],
                         help='how the results should be sorted')
+    parser.add_argument('--dedup', action='store_true',
+                        help='search books with the same content once')
+    parser.add_argument('--cache', metavar='DIR', default=None,
+                        help='reuse results of previous searches and '
+                             'text kept up to date by "watch" from DIR')
+    parser.add_argument('--checkpoint', metavar='FILE', default=None,
+                        help='keep the results in FILE when interrupted, '
+                             'running the same search again resumes it')
+    parser.add_argument('--rank', metavar='K', type=int, default=None,
+                        help='list the K most relevant books for the words '
+                             'of the pattern instead of every match')
+    parser.add_argument('--index', metavar='FILE', default=None,
+                        help='rank using the counts saved by "stats --save"')
+    parser.add_argument('--estimate', action='store_true',
+                        help='estimate the number of books and matches '
+                             'by searching a random sample of the books')
+    parser.add_argument('--sample', metavar='N', type=int, default=100,
+                        help='search about N books for --estimate at first')
+    parser.add_argument('--precision', metavar='FRACTION', type=float,
+                        default=None,
+                        help='keep doubling the --estimate sample until the '
+                             'estimates are within FRACTION of the value')
+    parser.add_argument('--time-limit', metavar='SECONDS', type=float,
+                        default=None,
+                        help='keep doubling the --estimate sample while it '
+                             'can be searched within SECONDS')
+    parser.add_argument('--title-boost', metavar='WEIGHT', type=float,
+                        default=0.0,
+                        help='weight of ranked words found in the title')
+    parser.add_argument('--author-boost', metavar='WEIGHT', type=float,
+                        default=0.0,
+                        help='weight of ranked words found in the author')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-q', '--quiet', action='store_true',
@@ -118,25 +179,130 @@ def _parse_args(argv):
 
         curses = None
 
-    matcher = matching.Matcher(args.pattern, args.ignore_case, True)
+    args.log_level = log_level
+
+    if args.context_chars is not None:
+        if args.context_chars < 0:
+            parser.error('--context-chars must be at least 0')
+
+        args.context = True
+
+    if args.max_snippets is not None and args.max_snippets < 1:
+        parser.error('--max-snippets must be at least 1')
+
+    if args.estimate:
+        if args.rank is not None or args.context:
+            parser.error('--estimate can not be used with --rank '
+                         'or --context')
+
+        if args.sample < 1:
+            parser.error('--sample must be at least 1')
+
+        if args.precision is not None and args.precision <= 0:
+            parser.error('--precision must be more than 0')
+
+    args.paths = tuple(util.unique(args.paths))
+    if args.query and args.fuzzy is not None:
+        parser.error('--query and --fuzzy can not be used together')
+
+    if args.fold and (args.query or args.fuzzy is not None):
+        parser.error('--fold can not be used with --query or --fuzzy')
+
+    if args.fuzzy is not None:
+        try:
+            args.matcher = fuzzy.FuzzyMatcher(args.pattern, args.fuzzy,
+                                              args.ignore_case)
+
+        except ValueError as e:
+            parser.error('invalid --fuzzy: %s' % (e))
+
+    elif not args.query:
+        args.matcher = matching.Matcher(args.pattern, args.ignore_case, True,
+                                        args.fold)
 
-    return (tuple(util.unique(args.paths)), matcher,
-            log_level, args.sort, args.context, args.sync)
+    else:
+        try:
+            args.matcher = query.Query(args.pattern, args.ignore_case)
+
+        except query.QueryError as e:
+            parser.error('invalid query: %s' % (e))
+
+    if args.cache is None:
+        args.result_cache = None
+        args.text_cache = None
+        args.parse_cache = None
+
+    else:
+        args.result_cache, args.text_cache, args.parse_cache = \
+            _open_caches(args.cache)
+
+    return args
 
 
-def _print_progress(curses_window, n_searched, paths, results):
-    n_paths_len = len('{0:n}'.format(len(paths)))
+def _open_caches(directory):
+    return (cache.ResultCache(directory=os.path.join(directory, 'results')),
+            cache.TextCache(os.path.join(directory, 'texts')),
+            cache.ParseCache(os.path.join(directory, 'parse')))
+
+
+def _progress_text(progress):
+    n_paths_len = len('{0:n}'.format(progress.n_paths))
 
     # format() does not support providing the width in the arguments
     progress_format = 'Searched {0:>%in}/{1:n} ePubs, {2:>%in} {3}...' % \
                       (n_paths_len, n_paths_len)
 
-    matches_str = 'match' if len(results) == 1 else 'matches'
+    matches_str = 'match' if progress.n_matched == 1 else 'matches'
+
+    text = progress_format.format(progress.n_searched, progress.n_paths,
+                                  progress.n_matched, matches_str)
+
+    if progress.eta is not None and not progress.finished:
+        text += ' about {0:n}s left'.format(int(progress.eta + 0.5))
+
+    return text
+
+
+class _CursesProgress(object):
+    """Draws the progress in a curses window."""
 
-    curses_window.clear()
-    curses_window.addstr(progress_format.format(n_searched, len(paths),
-                                                len(results), matches_str))
-    curses_window.refresh()
+    def __init__(self, curses_window):
+        self.curses_window = curses_window
+
+    def __call__(self, progress):
+        self.curses_window.clear()
+        self.curses_window.addstr(_progress_text(progress))
+        self.curses_window.refresh()
+
+
+class _PlainProgress(object):
+    """Draws the progress on a single line of a terminal."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.__length = 0
+
+    def clear(self):
+        """Removes the line, such as before writing something else."""
+
+        if self.__length > 0:
+            self.stream.write('\r%s\r' % (' ' * self.__length))
+            self.stream.flush()
+
+        self.__length = 0
+
+    def __call__(self, progress):
+        self.clear()
+
+        # The results are printed afterwards
+        if progress.finished:
+            return
+
+        text = _progress_text(progress)
+        self.stream.write(text)
+        self.stream.flush()
+
+        self.__length = len(text)
 
 
 def _result_name(result, sort):
@@ -157,18 +323,299 @@ def _result_name(result, sort):
     return ' - '.join(part_order)
 
 
+def _parse_watch_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='epub-search watch',
+        description='Keep the cached text of ePubs up to date.')
+    parser.add_argument('--cache', metavar='DIR', required=True,
+                        help='directory to store the text in')
+    parser.add_argument('--interval', metavar='SECONDS', type=float,
+                        default=2.0, help='how often to look for changes')
+    parser.add_argument('--debounce', metavar='SECONDS', type=float,
+                        default=1.0,
+                        help='how long changes must stop before updating')
+    parser.add_argument('--rate', metavar='N', type=float, default=10.0,
+                        help='update at most N ePubs per second')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='supress warning output')
+    parser.add_argument('paths', metavar='PATH', nargs='+',
+                        help='epubs/paths to watch')
+
+    return parser.parse_args(argv)
+
+
+def _watch(argv):
+    args = _parse_watch_args(argv)
+    result_cache, text_cache = _open_caches(args.cache)[:2]
+
+    def print_changes(changes, updated, errors):
+        if not args.quiet:
+            for error in errors:
+                sys.stderr.write('Error: %s\n' % (error))
+
+        print('Updated {0:n} ePubs, removed {1:n}'.format(
+              len(updated), len(changes.removed)))
+        sys.stdout.flush()
+
+    refresher = watch.Refresher(text_cache, result_cache, args.rate,
+                                print_changes)
+    refresher.start()
+
+    # Polling continues while the refresher is busy
+    for changes in watch.Watcher(args.paths, args.interval, args.debounce):
+        refresher.submit(changes)
+
+
+def _parse_extract_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='epub-search extract',
+        description='Write the text of ePubs to a flat UTF-8 file with an '
+                    'offset table in OUTPUT.offsets.')
+    parser.add_argument('-o', '--output', metavar='OUTPUT', required=True,
+                        help='file to write the text to')
+    parser.add_argument('--shard-size', metavar='BYTES', type=int,
+                        default=None,
+                        help='split the text into OUTPUT.NNNN files of '
+                             'about BYTES each')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='supress warning output')
+    parser.add_argument('--sync', action='store_const', const=True,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('paths', metavar='PATH', nargs='+',
+                        action=_EpubPathsAction, type=_epub_path,
+                        help='list of epubs/paths to extract')
+
+    return parser.parse_args(argv)
+
+
+def _extract(argv):
+    args = _parse_extract_args(argv)
+    paths = tuple(util.unique(args.paths))
+
+    errors = flatfile.write(paths, args.output, args.shard_size, args.sync)
+
+    if not args.quiet:
+        for error in errors:
+            sys.stderr.write('Error: %s\n' % (error))
+
+    print('Extracted {0:n} ePubs out of {1:n}'.format(
+          len(paths) - len(errors), len(paths)))
+
+
+def _parse_stats_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='epub-search stats',
+        description='Count terms across ePubs.')
+    parser.add_argument('-t', '--term', dest='terms', metavar='TERM',
+                        action='append', default=[],
+                        help='a word to report the counts of, '
+                             'may be given multiple times')
+    parser.add_argument('--top', metavar='N', type=int, default=10,
+                        help='number of ePubs to list')
+    parser.add_argument('--by', default=None, choices=['author', 'title'],
+                        help='report totals grouped by author or title')
+    parser.add_argument('--per-chapter', action='store_true',
+                        help='count each chapter separately')
+    parser.add_argument('--load', metavar='FILE', default=None,
+                        help='use the counts saved in FILE '
+                             'instead of reading the ePubs')
+    parser.add_argument('--save', metavar='FILE', default=None,
+                        help='save the counts to FILE')
+    parser.add_argument('--cache', metavar='DIR', default=None,
+                        help='use the text kept up to date by "watch" '
+                             'in DIR')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='supress warning output')
+    parser.add_argument('--sync', action='store_const', const=True,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('paths', metavar='PATH', nargs='*',
+                        action=_EpubPathsAction, type=_epub_path,
+                        help='list of epubs/paths to count the terms of')
+    args = parser.parse_args(argv)
+
+    if args.load is None and not args.paths:
+        parser.error('either PATH or --load is required')
+
+    return args
+
+
+def _stats(argv):
+    # Avoid importing numpy for every search
+    from epub_search import stats
+
+    args = _parse_stats_args(argv)
+
+    if args.load is not None:
+        matrix = stats.TermMatrix.load(args.load)
+
+    else:
+        text_cache = None
+        if args.cache is not None:
+            text_cache = _open_caches(args.cache)[1]
+
+        matrix, errors = stats.TermMatrix.build(util.unique(args.paths),
+                                                args.per_chapter, args.sync,
+                                                text_cache)
+
+        if not args.quiet:
+            for error in errors:
+                sys.stderr.write('Error: %s\n' % (error))
+
+    if args.save is not None:
+        matrix.save(args.save)
+
+    print('Counted {0:n} terms in {1:n} ePubs'.format(matrix.n_terms,
+                                                      len(matrix.books)))
+
+    if not args.terms:
+        return
+
+    # Whale and whale are the same term
+    args.terms = stats.normalize_terms(args.terms)
+
+    print('')
+    for term, total in sorted(matrix.term_totals(args.terms).items()):
+        print(u'{0:>12n}  {1!s}'.format(total, term))
+
+    if args.by is not None:
+        grouped = matrix.totals_by(args.by, args.terms)
+
+        # Those without an author or title go last
+        for key, totals in sorted(grouped.items(),
+                                  key=lambda x: (x[0] is None, x[0])):
+            print('')
+            print(key if key is not None else 'Unknown')
+
+            for term in args.terms:
+                print(u'{0:>12n}  {1!s}'.format(totals.get(term, 0), term))
+
+        return
+
+    print('')
+    for book in matrix.top_books(args.terms, args.top):
+        print(u'{0:>12n}  {1!s}'.format(book.total,
+                                        os.path.basename(book.path)))
+
+
+def _rank(args):
+    if args.index is not None:
+        from epub_search import stats
+
+        matrix = stats.TermMatrix.load(args.index)
+        ranked = rank.rank_index(matrix, args.pattern, args.rank,
+                                 args.title_boost, args.author_boost)
+        n_books = len(matrix.books)
+
+    else:
+        ranked, errors = rank.rank(args.paths, args.pattern, args.rank,
+                                   args.sync, args.text_cache,
+                                   args.title_boost, args.author_boost)
+        n_books = len(args.paths)
+
+        if errors and args.log_level >= LogLevel.DEFAULT:
+            for error in errors:
+                sys.stderr.write('Error: %s\n' % (error))
+
+            print('\n')
+
+    if not ranked:
+        print('No matches found')
+        return
+
+    print('Ranked {0:n} books out of {1:n}'.format(len(ranked), n_books))
+
+    for result in ranked:
+        print(u'{0:>8.3f}  {1!s}'.format(result.score,
+                                         _result_name(result, args.sort)))
+
+
+def _estimate(args):
+    found, errors = estimate.estimate(args.paths, args.matcher, args.sample,
+                                      args.precision, args.time_limit,
+                                      sync=args.sync,
+                                      text_cache=args.text_cache,
+                                      parse_cache=args.parse_cache)
+
+    if errors and args.log_level >= LogLevel.DEFAULT:
+        for error in errors:
+            sys.stderr.write('Error: %s\n' % (error))
+
+        print('\n')
+
+    if found.exact:
+        print('Searched all {0:n} books'.format(found.n_paths))
+
+    else:
+        print('Estimated from {0:n} books out of {1:n}, with {2:n}% '
+              'confidence'.format(found.n_sampled, found.n_paths,
+                                  int(found.confidence * 100 + 0.5)))
+
+    for name, interval in (('Matched books', found.matched),
+                           ('Matches', found.matches)):
+        if found.exact:
+            print(u'{0!s}: {1:n}'.format(name, int(interval.value)))
+            continue
+
+        print(u'{0!s}: about {1:n} ({2:n} to {3:n})'.format(
+            name, int(interval.value + 0.5), int(interval.low + 0.5),
+            int(interval.high + 0.5)))
+
+
+_COMMANDS = {'extract': _extract,
+             'stats': _stats,
+             'watch': _watch}
+
+
 def _epub_search(argv):
     # Required for formatting with thousand separator
     locale.setlocale(locale.LC_ALL, '')
 
-    paths, matcher, log_level, sort, with_context, sync = _parse_args(argv)
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # A path with the same name can be given as ./watch
+    if argv and argv[0] in _COMMANDS:
+        return _COMMANDS[argv[0]](argv[1:])
+
+    args = _parse_args(argv)
+
+    if args.rank is not None:
+        return _rank(args)
+
+    if args.estimate:
+        return _estimate(args)
+
+    paths = args.paths
+    matcher = args.matcher
+    log_level = args.log_level
+    sort = args.sort
+    with_context = args.context
+    sync = args.sync
+    result_cache = args.result_cache
+    text_cache = args.text_cache
 
     results = []
     logged = False
 
-    if curses is not None:
-        n_searched = 0
+    # The ePubs searched before an interruption are not searched again
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = resume.Checkpoint(args.checkpoint, paths, matcher,
+                                       with_context, args.context_chars,
+                                       args.max_snippets)
+
+        results.extend(result for result in checkpoint.results
+                       if result.error is None and result.n_matches > 0)
+        search_paths = checkpoint.remaining(paths)
+
+    else:
+        search_paths = paths
 
+    # Only a terminal is shown the progress without curses
+    plain_progress = None
+    progress = None
+
+    if curses is not None:
         # Redirect until after after search
         saved_stderr = sys.stderr
         
@@ -179,11 +626,25 @@ def _epub_search(argv):
             sys.stderr = StringIO()
 
         curses_window = curses.initscr()
+        progress = _CursesProgress(curses_window)
 
-        _print_progress(curses_window, n_searched, paths, results)
+    elif sys.stderr.isatty() and log_level > LogLevel.QUIET:
+        plain_progress = _PlainProgress(sys.stderr)
+        progress = plain_progress
 
     try:
-        for result in search.search(paths, matcher, with_context, sync):
+        for result in search.search(search_paths, matcher, with_context,
+                                    sync, result_cache, text_cache,
+                                    args.context_chars, args.max_snippets,
+                                    args.dedup, args.parse_cache,
+                                    progress, _PROGRESS_RATE):
+            if checkpoint is not None:
+                checkpoint.add(result)
+
+            if plain_progress is not None and \
+               (result.error is not None or result.warnings is not None):
+                plain_progress.clear()
+
             if result.error is not None:
                 if log_level >= LogLevel.DEFAULT:
                     logged = True
@@ -199,12 +660,16 @@ def _epub_search(argv):
                 if result.n_matches > 0:
                     results.append(result)
 
-            if curses is not None:
-                n_searched += 1
+    except KeyboardInterrupt:
+        if checkpoint is not None:
+            checkpoint.save()
 
-                _print_progress(curses_window, n_searched, paths, results)
+        raise
 
     finally:
+        if plain_progress is not None:
+            plain_progress.clear()
+
         # Must make sure we restore the screen's
         # state, otherwise bad things will happen
         if curses is not None:
@@ -215,6 +680,9 @@ def _epub_search(argv):
 
             sys.stderr = saved_stderr
 
+    if checkpoint is not None:
+        checkpoint.remove()
+
     # Separate the errors and warnings from the results
     if logged:
         print('\n')
@@ -242,12 +710,24 @@ def _epub_search(argv):
         result_format = u'{0:>%in}  {1!s}' % (max_matches_len)
 
         for result in results:
-            print(result_format.format(result.n_matches,
-                                       _result_name(result, sort)))
+            result_name = _result_name(result, sort)
+
+            if result.duplicates:
+                result_name += ' (same as %s)' % (', '.join(
+                    os.path.basename(path) for path in result.duplicates))
+
+            print(result_format.format(result.n_matches, result_name))
 
         # Print context after match list
         if with_context:
+            printed = set()
+
             for result in results:
+                # The context is the same for duplicates
+                if printed.intersection(result.duplicates or ()):
+                    continue
+
+                printed.add(result.path)
                 print('')
 
                 result_name = _result_name(result, sort)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Searching once for queries which arrive together.
+
+Most of a search is spent reading, decompressing and stripping the
+ePubs, not matching them. When several queries arrive at about the
+same time, such as in a long-running server, QueryBatcher collects
+them for a short window and passes over the ePubs once for all of
+them with search.search_many(). Each caller gets only its results.
+"""
+
+import threading
+import time
+
+try:
+    import Queue as queue
+
+except ImportError:
+    import queue # Python 3
+
+from epub_search import search
+
+
+class _Failure(object):
+    # The exception of a failed pass, raised for each of its callers
+    __slots__ = ('exception',)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _results(results):
+    while 1:
+        result = results.get()
+
+        # The pass is done
+        if result is None:
+            return
+
+        if isinstance(result, _Failure):
+            raise result.exception
+
+        yield result
+
+
+class QueryBatcher(object):
+    """Searches paths for the queries arriving within window seconds.
+
+    search() can be called from any number of threads. The first
+    query starts a window, the queries arriving within it are searched
+    in one pass when it ends. Only one pass runs at a time, queries
+    arriving during a pass are searched together in the next pass as
+    soon as it ends. sync, text_cache and parse_cache are as for
+    search.search().
+    """
+
+    def __init__(self, paths, window=0.05, sync=None, text_cache=None,
+                 parse_cache=None):
+        self.paths = tuple(paths)
+        self.window = window
+        self.sync = sync
+        self.text_cache = text_cache
+        self.parse_cache = parse_cache
+
+        self.__lock = threading.Lock()
+
+        # The (query, results queue) of the next batch
+        self.__pending = []
+        self.__running = False
+
+    def search(self, matcher, with_context=False, context_chars=None,
+               max_snippets=None):
+        """Yields a SearchResult for each path like search.search().
+
+        The results are yielded as the pass finishes each ePub,
+        an error during the pass is raised for every query in it.
+        """
+
+        results = queue.Queue()
+
+        with self.__lock:
+            self.__pending.append(((matcher, with_context, context_chars,
+                                    max_snippets), results))
+
+            if not self.__running:
+                self.__running = True
+
+                thread = threading.Thread(target=self.__run)
+
+                # Do not keep the process alive
+                thread.daemon = True
+                thread.start()
+
+        return _results(results)
+
+    def __run(self):
+        time.sleep(self.window)
+
+        while 1:
+            with self.__lock:
+                batch = self.__pending
+                self.__pending = []
+
+                if not batch:
+                    self.__running = False
+                    return
+
+            self.__search(batch)
+
+    def __search(self, batch):
+        try:
+            for path_results in search.search_many(
+                    self.paths, [x[0] for x in batch], self.sync,
+                    self.text_cache, self.parse_cache):
+                for (x, results), result in zip(batch, path_results):
+                    results.put(result)
+
+        except Exception as e:
+            for x, results in batch:
+                results.put(_Failure(e))
+
+        for x, results in batch:
+            results.put(None)
+
+# ex:et:ts=4:
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""ePubs stored in zip and tar bundles.
+
+An ePub in a bundle has the path of the bundle joined with the
+member's name, as if the bundle was a directory, so that results
+and caches treat it like any other ePub. The data is read from the
+bundle into memory, never extracted to disk. A tar can only be read
+efficiently from start to end, so its members are read with
+with_data() in a single pass. A compressed tar is already read
+whole to list it, members() keeps its ePubs for with_data().
+"""
+
+import os
+import posixpath
+import tarfile
+
+from epub_search import zipreader
+
+
+# Files with these extensions are looked at when walking a directory
+EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+              '.tar.xz', '.txz')
+
+# The ePub's container, which a bundle does not have
+_CONTAINER_PATH = 'META-INF/container.xml'
+
+# Listing a compressed tar decompresses all of it, so members() keeps
+# the ePubs, at most this many bytes of them, for with_data()
+_KEEP_SIZE = 64 * 1024 * 1024
+
+_COMPRESSED_MAGICS = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ')
+
+# The data kept by members() for each _bundle_key()
+_kept = {}
+
+
+def _is_tar(path):
+    # Checked before a zip, the ePubs in an uncompressed tar
+    # would otherwise be mistaken for data prepended to a zip
+    try:
+        return tarfile.is_tarfile(path)
+
+    except Exception:
+        return False
+
+
+def _zip_names(path):
+    # Returns the names in the zip at path, or None if it is not a zip
+    try:
+        with zipreader.ZipReader(path, small_size=0) as bundle_zipfile:
+            return bundle_zipfile.namelist()
+
+    except Exception:
+        return None
+
+
+def _is_compressed(path):
+    with open(path, 'rb') as bundle_file:
+        magic = bundle_file.read(6)
+
+    return any(magic.startswith(x) for x in _COMPRESSED_MAGICS)
+
+
+def _bundle_key(path):
+    # Kept data is only used while the bundle has not changed
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        return None
+
+    return path, stat.st_size, stat.st_mtime
+
+
+def _tar_name(info):
+    # Names can start with ./, which the member's path does not have
+    return posixpath.normpath(info.name)
+
+
+def is_bundle(path):
+    """Returns whether the file at @path is a zip or tar of ePubs."""
+
+    if _is_tar(path):
+        return True
+
+    names = _zip_names(path)
+    if names is None:
+        return False
+
+    # An ePub is a zip as well
+    return _CONTAINER_PATH not in names and \
+        any(name.endswith('.epub') for name in names)
+
+
+def members(path):
+    """Returns the paths of the ePubs in the bundle at @path.
+
+    The members of a tar are in the order they are stored in, for
+    with_data(), those of a zip are sorted like a directory's.
+    A compressed tar has to be decompressed to list it, its ePubs
+    are kept in memory, up to _KEEP_SIZE bytes for all bundles,
+    so that with_data() does not decompress it again.
+    """
+
+    if _is_tar(path):
+        names = []
+        kept = {}
+
+        keep = _is_compressed(path)
+        kept_size = sum(len(data) for bundle_kept in _kept.values()
+                        for data in bundle_kept.values())
+
+        # Only read once from start to end
+        with tarfile.open(path, 'r|*' if keep else 'r') as bundle_tarfile:
+            for info in bundle_tarfile:
+                if not info.isfile() or not info.name.endswith('.epub'):
+                    continue
+
+                name = _tar_name(info)
+                names.append(name)
+
+                if keep and kept_size + info.size <= _KEEP_SIZE:
+                    kept[name] = bundle_tarfile.extractfile(info).read()
+                    kept_size += len(kept[name])
+
+        if kept:
+            _kept[_bundle_key(path)] = kept
+
+    else:
+        names = sorted((name for name in _zip_names(path) or ()
+                        if name.endswith('.epub')), key=str.lower)
+
+    return [os.path.join(path, *name.split('/')) for name in names]
+
+
+def split(path):
+    """Returns (bundle path, member name) for the ePub at @path.
+
+    Returns None when @path is not in a bundle.
+    """
+
+    if os.path.exists(path):
+        return None
+
+    parent = path
+    while True:
+        child = parent
+        parent = os.path.dirname(parent)
+
+        if parent == child or not parent:
+            return None
+
+        if os.path.exists(parent):
+            break
+
+    if not os.path.isfile(parent):
+        return None
+
+    name = os.path.relpath(path, parent).replace(os.sep, '/')
+    return parent, name
+
+
+def member_data(path):
+    """Returns the data of the ePub at @path in a bundle.
+
+    Returns None when @path is not in a bundle. Reading a single
+    member of a tar can mean reading all of the members before it.
+    """
+
+    located = split(path)
+    if located is None:
+        return None
+
+    bundle_path, name = located
+
+    kept = _kept.get(_bundle_key(bundle_path), {})
+    if name in kept:
+        return kept[name]
+
+    if not _is_tar(bundle_path):
+        with zipreader.ZipReader(bundle_path,
+                                 small_size=0) as bundle_zipfile:
+            return bundle_zipfile.read(name)
+
+    with tarfile.open(bundle_path) as bundle_tarfile:
+        for info in bundle_tarfile:
+            if info.isfile() and _tar_name(info) == name:
+                return bundle_tarfile.extractfile(info).read()
+
+    raise KeyError('There is no item named %r in the archive' % (name))
+
+
+def _tar_data(bundle_path, wanted):
+    # Reads the tar from start to end, yielding
+    # (path, data) for the members in wanted
+    wanted = dict(wanted)
+
+    # Those kept by members() are used once, in the order of wanted
+    key = _bundle_key(bundle_path)
+    kept = _kept.get(key, {})
+
+    for name in [name for name in wanted if name in kept]:
+        yield wanted.pop(name), kept.pop(name)
+
+    if not kept:
+        _kept.pop(key, None)
+
+    if not wanted:
+        return
+
+    # A stream can not seek, so it is read once in order
+    with tarfile.open(bundle_path, 'r|*') as bundle_tarfile:
+        for info in bundle_tarfile:
+            name = _tar_name(info)
+            if not info.isfile() or name not in wanted:
+                continue
+
+            path = wanted.pop(name)
+
+            yield path, bundle_tarfile.extractfile(info).read()
+
+            if not wanted:
+                return
+
+    # Changed since it was listed, the error is reported by epub.Epub
+    for path in wanted.values():
+        yield path, None
+
+
+def with_data(paths):
+    """Yields (path, data) for each of @paths.
+
+    Consecutive members of the same tar are read in a single
+    pass and yielded in the order they are stored in. data is
+    None for the other paths, those of zips are read when opened
+    since a zip can be read in any order.
+    """
+
+    # Whether each bundle is a tar
+    tars = {}
+
+    run_bundle = None
+    run = []
+
+    for path in paths:
+        located = split(path)
+
+        if located is not None:
+            if located[0] not in tars:
+                tars[located[0]] = _is_tar(located[0])
+
+            if not tars[located[0]]:
+                located = None
+
+        if run and (located is None or located[0] != run_bundle):
+            for x in _tar_data(run_bundle, run):
+                yield x
+
+            run_bundle = None
+            run = []
+
+        if located is None:
+            yield path, None
+            continue
+
+        run_bundle = located[0]
+        run.append((located[1], path))
+
+    if run:
+        for x in _tar_data(run_bundle, run):
+            yield x
+
+# ex:et:ts=4:
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Caching of search results and stripped text."""
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import tempfile
+import zlib
+
+try:
+    import cPickle as pickle
+
+except ImportError:
+    import pickle # Python 3
+
+import epub_search
+from epub_search import epub
+from epub_search import matching
+from epub_search import signature
+from epub_search import tag_stripper
+from epub_search import util
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+
+    # Readers must never see a partially written file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+
+        os.rename(tmp_path, path)
+
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class ResultCache(object):
+    """A least recently used cache of search results.
+
+    Results are keyed by the matcher's pattern and flags, whether
+    context was requested and a version of the ePubs searched, for
+    instance util.fingerprint() of the paths. When directory is
+    given results are also pickled there so they survive between
+    runs, the in-memory tier is checked first. Both keep at most
+    max_entries results, on disk the least recently used going by
+    their modification time are removed by put().
+    """
+
+    def __init__(self, max_entries=128, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+
+        self.__entries = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(matcher, with_context, version, context_chars=None,
+            max_snippets=None):
+        """Returns the key for a search with @matcher over @version."""
+
+        parts = (epub_search.__version__, type(matcher).__name__,
+                 matcher.to_match,
+                 bool(matcher.ignore_case), bool(matcher.use_regex),
+                 getattr(matcher, 'max_errors', None),
+                 bool(getattr(matcher, 'fold', False)),
+                 bool(with_context), version, context_chars, max_snippets)
+
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def __disk_path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def __remember(self, key, results):
+        entries = self.__entries
+
+        entries.pop(key, None)
+        entries[key] = results
+
+        while len(entries) > self.max_entries:
+            # Evict the least recently used
+            entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns the results for @key, or None."""
+
+        results = self.__entries.pop(key, None)
+
+        if results is None and self.directory is not None:
+            try:
+                with open(self.__disk_path(key), 'rb') as disk_file:
+                    results = pickle.load(disk_file)
+
+            # Missing, or corrupt and will be overwritten
+            except Exception:
+                results = None
+
+        if results is None:
+            self.__misses += 1
+            return None
+
+        self.__hits += 1
+        self.__remember(key, results)
+
+        if self.directory is not None:
+            # Marks it as recently used for __prune()
+            try:
+                os.utime(self.__disk_path(key), None)
+
+            except OSError:
+                pass
+
+        return results
+
+    def put(self, key, results):
+        """Stores @results, which must be picklable, for @key."""
+
+        # Prevent modification
+        results = tuple(results)
+
+        self.__remember(key, results)
+
+        if self.directory is not None:
+            _write_atomic(self.__disk_path(key),
+                          pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+            self.__prune()
+
+    def __prune(self):
+        # Results for older versions of the ePubs are never used again
+        used = []
+
+        for child in os.listdir(self.directory):
+            if not child.endswith('.pickle'):
+                continue
+
+            child_path = os.path.join(self.directory, child)
+
+            try:
+                used.append((os.path.getmtime(child_path), child_path))
+
+            # Removed by another process
+            except OSError:
+                pass
+
+        used.sort()
+
+        for mtime, child_path in used[:max(0, len(used) -
+                                           self.max_entries)]:
+            try:
+                os.unlink(child_path)
+
+            except OSError:
+                pass
+
+    def clear(self):
+        """Removes all of the results, including those on disk."""
+
+        self.__entries.clear()
+
+        if self.directory is None:
+            return
+
+        for child in os.listdir(self.directory):
+            if child.endswith('.pickle'):
+                try:
+                    os.unlink(os.path.join(self.directory, child))
+
+                except OSError:
+                    pass
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+
+_cached_book_fields = ('path', 'fingerprint', 'title', 'author',
+                       'warnings', 'labels', 'blobs')
+
+
+class CachedBook(namedtuple('CachedBook', _cached_book_fields)):
+    """The stripped text of an ePub stored by TextCache.
+
+    blobs are the zlib compressed UTF-8 text of each chapter.
+    """
+
+    def chapters(self, which=None):
+        """Yields the (label, text) of each chapter.
+
+        When @which is given only the chapters at
+        those indices are decompressed and yielded.
+        """
+
+        # Repeated chapters share their text, as with epub.Epub
+        texts = {}
+
+        for i, (label, blob) in enumerate(zip(self.labels, self.blobs)):
+            if which is not None and i not in which:
+                continue
+
+            if blob not in texts:
+                texts[blob] = zlib.decompress(blob).decode('utf-8')
+
+            yield label, texts[blob]
+
+
+ParseRecord = namedtuple('ParseRecord', ('error', 'tag_strategy'))
+
+SignedBook = namedtuple('SignedBook', ('title', 'author', 'warnings',
+                                       'signatures'))
+
+
+class ParseCache(object):
+    """How ePubs that were not simple to parse went, stored on disk.
+
+    Only ePubs which could not be parsed, or which needed a fallback
+    tag stripper, are recorded so the next run can report them or
+    start with that tag stripper. Entries are only returned while the
+    ePub's util.file_fingerprint() is the one they were stored with.
+
+    How the tag strippers did is also kept for each producer of
+    ePubs, see epub.Epub.producer, so that new ePubs start with
+    the tag stripper which did best for others by their producer.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        # The StrategyStats loaded for each producer
+        self.__stats = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __disk_path(self, path):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.parse')
+
+    def get(self, path):
+        """Returns the ParseRecord for @path, or None."""
+
+        try:
+            with open(self.__disk_path(path), 'rb') as disk_file:
+                fingerprint, error, tag_strategy = pickle.load(disk_file)
+
+        # Missing, or corrupt and will be overwritten
+        except Exception:
+            return None
+
+        if fingerprint != util.file_fingerprint(path):
+            return None
+
+        return ParseRecord(error, tag_strategy)
+
+    def put(self, path, fingerprint, error=None, tag_strategy=None):
+        """Records the @error or the @tag_strategy needed for @path.
+
+        @fingerprint must be util.file_fingerprint() from
+        before the ePub was read.
+        """
+
+        _write_atomic(self.__disk_path(path),
+                      pickle.dumps((fingerprint, error, tag_strategy),
+                                   pickle.HIGHEST_PROTOCOL))
+
+    def remove(self, path):
+        try:
+            os.unlink(self.__disk_path(path))
+
+        except OSError:
+            pass
+
+    def __stats_path(self, producer):
+        # ePubs without a producer are counted together
+        name = hashlib.sha1((producer or '').encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.strategies')
+
+    def strategy_stats(self, producer):
+        """Returns the tag_stripper.StrategyStats for @producer.
+
+        They are only read once, later changes by other
+        processes are not seen.
+        """
+
+        stats = self.__stats.get(producer, None)
+        if stats is not None:
+            return stats
+
+        try:
+            with open(self.__stats_path(producer), 'rb') as disk_file:
+                stats = tag_stripper.StrategyStats(pickle.load(disk_file))
+
+        # Missing, or corrupt and will be overwritten
+        except Exception:
+            stats = tag_stripper.StrategyStats()
+
+        self.__stats[producer] = stats
+        return stats
+
+    def add_strategy_stats(self, producer, stats):
+        """Adds the tag_stripper.StrategyStats @stats to @producer's.
+
+        Nothing is written unless it is worth merging them, which for
+        most ePubs it no longer is once a producer's are settled.
+        Processes doing this at the same time can lose each other's
+        counts, which is fine for choosing the order.
+        """
+
+        stored = self.strategy_stats(producer)
+        if not stats.worth_merging(stored):
+            return
+
+        stored.merge(stats)
+
+        _write_atomic(self.__stats_path(producer),
+                      pickle.dumps(stored.counts, pickle.HIGHEST_PROTOCOL))
+
+
+class TextCache(object):
+    """The stripped text of ePubs stored on disk.
+
+    Entries are only returned while the ePub's
+    util.file_fingerprint() is the one they were stored with.
+    Next to the text is a signature.Signature of each chapter,
+    with which chapters and whole ePubs that can not match are
+    skipped without loading the text.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __disk_path(self, path, extension='.text'):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+    def __load(self, path, with_body):
+        try:
+            with open(self.__disk_path(path), 'rb') as disk_file:
+                # The fingerprint is stored separately so
+                # checking it does not require loading the text
+                fingerprint = pickle.load(disk_file)
+                if fingerprint != util.file_fingerprint(path):
+                    return None
+
+                if not with_body:
+                    return fingerprint
+
+                return CachedBook(path, fingerprint, *pickle.load(disk_file))
+
+        # Missing, or corrupt and will be overwritten
+        except Exception:
+            return None
+
+    def is_fresh(self, path):
+        """Whether the stored text for @path is up to date."""
+
+        return self.__load(path, False) is not None
+
+    def get(self, path):
+        """Returns the CachedBook for @path, or None when stale."""
+
+        return self.__load(path, True)
+
+    def put(self, path, fingerprint, title, author, warnings, labels, texts):
+        """Stores the stripped @texts of the ePub at @path.
+
+        @fingerprint must be util.file_fingerprint() from
+        before the ePub was read.
+        """
+
+        blobs = tuple(zlib.compress(text.encode('utf-8'), 6)
+                      for text in texts)
+        body = (title, author, warnings, tuple(labels), blobs)
+
+        _write_atomic(self.__disk_path(path),
+                      pickle.dumps(fingerprint, pickle.HIGHEST_PROTOCOL) +
+                      pickle.dumps(body, pickle.HIGHEST_PROTOCOL))
+
+        self.__put_signatures(path, fingerprint, title, author, warnings,
+                              texts)
+
+    def __put_signatures(self, path, fingerprint, title, author, warnings,
+                         texts):
+        # Repeated chapters share their signature
+        signatures = {}
+        for text in texts:
+            if text not in signatures:
+                signatures[text] = signature.Signature.build(text)
+
+        body = SignedBook(title, author, warnings,
+                          tuple(signatures[text] for text in texts))
+
+        _write_atomic(self.__disk_path(path, '.sig'),
+                      pickle.dumps(fingerprint, pickle.HIGHEST_PROTOCOL) +
+                      pickle.dumps(tuple(body), pickle.HIGHEST_PROTOCOL))
+
+        return body
+
+    def signatures(self, path, with_book=False):
+        """Returns the SignedBook for @path, or None when stale.
+
+        The signatures are made the first time for text
+        stored before they were, which loads the text. With
+        @with_book returns (SignedBook, CachedBook) where the
+        CachedBook is the one loaded for that, or None.
+        """
+
+        signed_book = None
+        cached_book = None
+
+        try:
+            with open(self.__disk_path(path, '.sig'), 'rb') as disk_file:
+                if pickle.load(disk_file) != util.file_fingerprint(path):
+                    raise ValueError('stale')
+
+                signed_book = SignedBook(*pickle.load(disk_file))
+
+        # Missing, stale or corrupt and will be overwritten
+        except Exception:
+            cached_book = self.get(path)
+
+        if cached_book is not None:
+            texts = [text for label, text in cached_book.chapters()]
+            signed_book = self.__put_signatures(path,
+                                                cached_book.fingerprint,
+                                                cached_book.title,
+                                                cached_book.author,
+                                                cached_book.warnings, texts)
+
+        if with_book:
+            return signed_book, cached_book
+
+        return signed_book
+
+    def folded_chapters(self, cached_book):
+        """Yields the (label, matching.FoldedText) of each chapter.
+
+        The folded text and its offsets are stored next to the text the
+        first time, afterwards they are loaded instead of folded again.
+        """
+
+        folded_path = self.__disk_path(cached_book.path, '.folded')
+
+        try:
+            with open(folded_path, 'rb') as disk_file:
+                if pickle.load(disk_file) != cached_book.fingerprint:
+                    raise ValueError('stale')
+
+                stored = pickle.load(disk_file)
+
+        # Missing, stale or corrupt and will be overwritten
+        except Exception:
+            stored = None
+
+        if stored is not None:
+            for (label, text), (blob, positions, deltas) in \
+                zip(cached_book.chapters(), stored):
+                folded = zlib.decompress(blob).decode('utf-8')
+                yield label, matching.FoldedText(text, folded,
+                                                 positions, deltas)
+
+            return
+
+        stored = []
+        for label, text in cached_book.chapters():
+            folded_text = matching.FoldedText(text)
+            stored.append((zlib.compress(folded_text.folded.encode('utf-8'),
+                                         6),
+                           folded_text.positions, folded_text.deltas))
+
+            yield label, folded_text
+
+        _write_atomic(folded_path,
+                      pickle.dumps(cached_book.fingerprint,
+                                   pickle.HIGHEST_PROTOCOL) +
+                      pickle.dumps(tuple(stored), pickle.HIGHEST_PROTOCOL))
+
+    def update(self, path):
+        """Extracts the text of the ePub at @path and stores it.
+
+        Returns the error message when the ePub could not be parsed.
+        """
+
+        fingerprint = util.file_fingerprint(path)
+
+        try:
+            epub_file = epub.Epub(path)
+
+        except epub.BadEpubError as e:
+            self.remove(path)
+            return str(e)
+
+        with epub_file:
+            labels = []
+            texts = []
+
+            for content in epub_file.contents:
+                # Text is None when stripping the tags failed
+                if content.text is not None:
+                    labels.append(content.label)
+                    texts.append(content.text)
+
+            self.put(path, fingerprint, epub_file.title, epub_file.author,
+                     epub_file.warnings, labels, texts)
+
+        return None
+
+    def remove(self, path):
+        for extension in ('.text', '.folded', '.sig'):
+            try:
+                os.unlink(self.__disk_path(path, extension))
+
+            except OSError:
+                pass
+
+# ex:et:ts=4:
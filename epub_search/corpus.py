@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""In-memory ePub text for running many queries."""
+
+from array import array
+
+from epub_search import epub
+from epub_search import matching
+from epub_search import multiprocess
+from epub_search import textstore
+from epub_search import util
+from epub_search.search import SearchResult, _match_contents
+
+
+# Chapters are joined with a newline so that a literal
+# pattern without one can never match across chapters
+_CHAPTER_SEPARATOR = u'\n'
+
+
+class _Book(object):
+    """The stripped text of an ePub.
+
+    All of the chapters are kept in a single string, the offsets
+    array has the start of each chapter followed by the end of the
+    last chapter. The folded text of the chapters is only made for
+    the first search which ignores accents.
+    """
+
+    __slots__ = ('path', 'title', 'author', 'warnings',
+                 'labels', 'offsets', 'text', 'folded')
+
+    def __init__(self, path, title, author, warnings, labels, texts):
+        self.path = path
+        self.title = title
+        self.author = author
+        self.warnings = warnings
+
+        # Prevent modification
+        self.labels = tuple(labels)
+        self.offsets = array('l')
+
+        position = 0
+        for text in texts:
+            self.offsets.append(position)
+            position += len(text) + len(_CHAPTER_SEPARATOR)
+
+        # The final offset does not include the separator
+        self.offsets.append(max(0, position - len(_CHAPTER_SEPARATOR)))
+
+        self.text = _CHAPTER_SEPARATOR.join(texts)
+        self.folded = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def n_chars(self):
+        n_separators = max(0, len(self.labels) - 1)
+        return len(self.text) - n_separators * len(_CHAPTER_SEPARATOR)
+
+    def chapter(self, i):
+        """Returns the text of the chapter at index @i."""
+
+        end = self.offsets[i + 1]
+        if i + 1 < len(self.labels):
+            end -= len(_CHAPTER_SEPARATOR)
+
+        return self.text[self.offsets[i]:end]
+
+    def chapters(self):
+        """Yields the (label, text) of each chapter."""
+
+        for i in range(len(self.labels)):
+            yield self.labels[i], self.chapter(i)
+
+    def folded_chapters(self):
+        """Yields the (label, matching.FoldedText) of each chapter."""
+
+        if self.folded is None:
+            self.folded = tuple(matching.FoldedText(text)
+                                for label, text in self.chapters())
+
+        return zip(self.labels, self.folded)
+
+
+class _CompressedBook(object):
+    """The stripped text of an ePub compressed per chapter.
+
+    The chapters are compressed when loading, which might be in
+    another process, and are moved into a CompressedTextStore by
+    attach() which must be called before accessing the chapters.
+    """
+
+    __slots__ = ('path', 'title', 'author', 'warnings',
+                 'labels', 'blobs', 'keys', 'store')
+
+    def __init__(self, path, title, author, warnings, labels, texts,
+                 compression):
+        self.path = path
+        self.title = title
+        self.author = author
+        self.warnings = warnings
+
+        # Prevent modification
+        self.labels = tuple(labels)
+        self.blobs = [(textstore.compress(text, compression), len(text))
+                      for text in texts]
+
+        self.keys = None
+        self.store = None
+
+    def attach(self, store):
+        self.keys = array('l', [store.add_compressed(blob, length)
+                                for blob, length in self.blobs])
+        self.blobs = None
+        self.store = store
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def n_chars(self):
+        return sum(self.store.length(key) for key in self.keys)
+
+    def chapter(self, i):
+        """Returns the text of the chapter at index @i."""
+
+        return self.store.get(self.keys[i])
+
+    def chapters(self):
+        """Yields the (label, text) of each chapter."""
+
+        for i in range(len(self.labels)):
+            yield self.labels[i], self.chapter(i)
+
+    def folded_chapters(self):
+        """Yields the (label, matching.FoldedText) of each chapter.
+
+        These are not kept, that would defeat the compression.
+        """
+
+        for label, text in self.chapters():
+            yield label, matching.FoldedText(text)
+
+
+def _extract_book(path, text_cache):
+    if text_cache is not None:
+        cached_book = text_cache.get(path)
+
+        if cached_book is not None:
+            chapters = list(cached_book.chapters())
+            labels = [label for label, text in chapters]
+            texts = [text for label, text in chapters]
+
+            return (cached_book.title, cached_book.author,
+                    cached_book.warnings, labels, texts)
+
+    fingerprint = util.file_fingerprint(path)
+
+    try:
+        epub_file = epub.Epub(path)
+
+    except epub.BadEpubError as e:
+        return SearchResult(path=path, error=str(e))
+
+    with epub_file:
+        labels = []
+        texts = []
+
+        for content in epub_file.contents:
+            # Text is None when stripping the tags failed
+            if content.text is None:
+                continue
+
+            labels.append(content.label)
+            texts.append(content.text)
+
+        extracted = (epub_file.title, epub_file.author,
+                     epub_file.warnings, labels, texts)
+
+    if text_cache is not None:
+        text_cache.put(path, fingerprint, *extracted)
+
+    return extracted
+
+
+def _load_book(path, compression=None, text_cache=None):
+    extracted = _extract_book(path, text_cache)
+    if isinstance(extracted, SearchResult):
+        return extracted
+
+    if compression is not None:
+        return _CompressedBook(path, *(extracted + (compression,)))
+
+    return _Book(path, *extracted)
+
+
+def _is_book(loaded):
+    # Books that failed to load are an error SearchResult
+    return not isinstance(loaded, SearchResult)
+
+
+class Corpus(object):
+    """The stripped text of many ePubs kept in memory.
+
+    Loading parses each ePub once, afterwards any number
+    of queries can be run without touching the ePubs again.
+    Results are SearchResult objects in the order the paths
+    were given, ePubs that failed to load have the error set.
+
+    When compression is one of textstore.COMPRESSIONS each chapter
+    is kept compressed in a textstore.CompressedTextStore and the
+    cache_size most recently used chapters are kept decompressed.
+
+    When text_cache, a cache.TextCache, is given the text is loaded
+    from it when up to date and stored in it otherwise.
+    """
+
+    def __init__(self, paths, sync=None, compression=None, cache_size=16,
+                 text_cache=None):
+        paths = tuple(paths)
+
+        # Taken before loading so changes while loading are noticed
+        fingerprint = util.fingerprint(paths)
+
+        if compression is None:
+            self.__store = None
+
+        else:
+            self.__store = textstore.CompressedTextStore(compression,
+                                                         cache_size)
+
+        # Same rules as search.search()
+        if sync or (sync is None and len(paths) <= 1):
+            loaded = [_load_book(path, compression, text_cache)
+                      for path in paths]
+
+        else:
+            loaded = list(multiprocess.Job(_load_book,
+                                           [(path, compression, text_cache)
+                                            for path in paths]))
+
+            # The job returns them in the order they finished
+            order = dict((path, i) for i, path in enumerate(paths))
+            loaded.sort(key=lambda x: order[x.path])
+
+        self.__compression = compression
+        self.__text_cache = text_cache
+
+        for book in loaded:
+            self.__attach(book)
+
+        self.__paths = paths
+        self.__books = loaded
+        self.__fingerprint = fingerprint
+
+    def __attach(self, book):
+        if self.__store is not None and _is_book(book):
+            book.attach(self.__store)
+
+    def update(self, changed=(), removed=()):
+        """Reloads the ePubs at @changed and drops those at @removed.
+
+        Paths in @changed which are not in the corpus are added.
+        This is meant to be driven by a watch.Watcher, compressed
+        text of replaced chapters is not freed from the store.
+        """
+
+        removed = set(removed)
+        changed = [path for path in changed if path not in removed]
+
+        books = dict((book.path, book) for book in self.__books)
+        paths = [path for path in self.__paths if path not in removed]
+        paths.extend(path for path in changed if path not in books)
+
+        fingerprint = util.fingerprint(paths)
+
+        for path in changed:
+            books[path] = _load_book(path, self.__compression,
+                                     self.__text_cache)
+            self.__attach(books[path])
+
+        self.__paths = tuple(paths)
+        self.__books = [books[path] for path in paths]
+        self.__fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.__paths)
+
+    @property
+    def paths(self):
+        """Returns the paths of the ePubs in the corpus."""
+
+        return self.__paths
+
+    @property
+    def books(self):
+        """Returns the (path, title, author) of each loaded ePub."""
+
+        return tuple((book.path, book.title, book.author)
+                     for book in self.__books if _is_book(book))
+
+    @property
+    def fingerprint(self):
+        """Returns the version of the ePubs when they were loaded."""
+
+        return self.__fingerprint
+
+    @property
+    def store(self):
+        """Returns the CompressedTextStore, or None."""
+
+        return self.__store
+
+    @property
+    def n_chars(self):
+        """Returns the number of characters held by the corpus."""
+
+        return sum(book.n_chars for book in self.__books if _is_book(book))
+
+    @staticmethod
+    def __count_book(book, matcher):
+        # A literal pattern without a newline cannot cross
+        # the chapter separator so the whole book is counted
+        if isinstance(book, _Book) and not matcher.is_regex and \
+           _CHAPTER_SEPARATOR not in matcher.to_match:
+            return matcher.count(book.text)
+
+        return _match_contents(book.chapters(), matcher, False)[0]
+
+    def __search_book(self, book, matcher, with_context,
+                      context_chars=None, max_snippets=None):
+        if not _is_book(book):
+            return book
+
+        if getattr(matcher, 'fold', False):
+            n_matches, matches = _match_contents(book.folded_chapters(),
+                                                 matcher, with_context,
+                                                 context_chars, max_snippets)
+
+        # One scan for the required literals skips every chapter
+        elif isinstance(book, _Book) and matcher.is_regex and \
+           not matcher.may_match(book.text):
+            n_matches = 0
+            matches = () if with_context else None
+
+        elif not with_context:
+            n_matches = self.__count_book(book, matcher)
+            matches = None
+
+        else:
+            n_matches, matches = _match_contents(book.chapters(), matcher,
+                                                 True, context_chars,
+                                                 max_snippets)
+
+        return SearchResult(path=book.path, title=book.title,
+                            author=book.author, n_matches=n_matches,
+                            matches=matches, warnings=book.warnings)
+
+    def search(self, matcher, with_context=False, cache=None,
+               context_chars=None, max_snippets=None):
+        """Returns a SearchResult for each ePub.
+
+        When @cache, a cache.ResultCache, is given the results
+        are looked up in it and stored in it on a miss.
+        @context_chars and @max_snippets are as for search.search().
+        """
+
+        if cache is not None:
+            key = cache.key(matcher, with_context, self.__fingerprint,
+                            context_chars, max_snippets)
+
+            results = cache.get(key)
+            if results is not None:
+                return list(results)
+
+        results = [self.__search_book(book, matcher, with_context,
+                                      context_chars, max_snippets)
+                   for book in self.__books]
+
+        if cache is not None:
+            cache.put(key, results)
+
+        return results
+
+    def count(self, matcher):
+        """Returns a SearchResult with only the number of matches."""
+
+        return self.search(matcher, False)
+
+    def match(self, matcher):
+        """Returns a SearchResult with the matches in context."""
+
+        return self.search(matcher, True)
+
+    def search_many(self, matchers, with_context=False, context_chars=None,
+                    max_snippets=None):
+        """Returns the results of search() for each of @matchers.
+
+        Each book is visited once for all of the
+        matchers to keep its text in the CPU's caches.
+        """
+
+        matchers = tuple(matchers)
+        results = [[] for matcher in matchers]
+
+        for book in self.__books:
+            for i, matcher in enumerate(matchers):
+                results[i].append(self.__search_book(book, matcher,
+                                                     with_context,
+                                                     context_chars,
+                                                     max_snippets))
+
+        return results
+
+# ex:et:ts=4:
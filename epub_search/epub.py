@@ -20,12 +20,14 @@
 """ePub metadata and content parsing."""
 
 from collections import namedtuple
+from io import BytesIO
 import posixpath
 import urllib
-import zipfile
 
 from lxml import etree as ElementTree
 
+from epub_search import bundle
+from epub_search import zipreader
 from epub_search.tag_stripper import TagStripError, TagStripper
 
 # Python 3 compat
@@ -79,20 +81,112 @@ def _XPATH(expr):
 
 
 _XPATH_ROOT_FILES = _XPATH('./container:rootfiles/container:rootfile')
-_XPATH_METADATA = _XPATH('./opf:metadata[1]')
-_XPATH_METADATA_TITLE = _XPATH('./dc:title[1]/text()')
-_XPATH_METADATA_CREATORS = _XPATH('./dc:creator')
-_XPATH_CREATOR_IS_AUTHOR = _XPATH('./@opf:role="aut"')
-
-_XPATH_ITEMS = _XPATH('./opf:manifest/opf:item[@id][@href][@media-type]')
-_XPATH_TOC_ID = _XPATH('./opf:spine[1]/@toc')
-_XPATH_IDREFS = _XPATH('./opf:spine/opf:itemref/@idref')
 
 _XPATH_NAV_POINTS = _XPATH('./ncx:navMap/ncx:navPoint')
 _XPATH_NAV_POINT_TEXT = _XPATH('./ncx:navLabel/ncx:text[1]/text()')
 _XPATH_NAV_POINT_CONTENT_SRC = _XPATH('./ncx:content[1]/@src')
 
 
+def _tag(prefix, name):
+    return '{%s}%s' % (_NAMESPACES[prefix], name)
+
+
+_OPF_METADATA = _tag('opf', 'metadata')
+_OPF_MANIFEST = _tag('opf', 'manifest')
+_OPF_ITEM = _tag('opf', 'item')
+_OPF_SPINE = _tag('opf', 'spine')
+_OPF_ITEMREF = _tag('opf', 'itemref')
+_OPF_ROLE = _tag('opf', 'role')
+_DC_TITLE = _tag('dc', 'title')
+_DC_CREATOR = _tag('dc', 'creator')
+_DC_PUBLISHER = _tag('dc', 'publisher')
+_OPF_META = _tag('opf', 'meta')
+
+
+class _Opf(object):
+    """The parts of an OPF file which are used.
+
+    These are found by a single streaming parse, elements
+    are freed as soon as they have been looked at.
+    """
+
+    def __init__(self, xml):
+        self.has_metadata = False
+        self.title = None
+        self.creators = []
+        self.generator = None
+        self.publisher = None
+        self.items = []
+        self.toc_id = None
+        self.idrefs = []
+
+        has_title = False
+        has_spine = False
+        section = None
+        depth = 0
+
+        for event, element in ElementTree.iterparse(BytesIO(xml),
+                                                    events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+
+                if depth == 2:
+                    section = element.tag
+
+                    # Only the first metadata and spine are used
+                    if section == _OPF_METADATA:
+                        if self.has_metadata:
+                            section = None
+
+                        self.has_metadata = True
+
+                    elif section == _OPF_SPINE and not has_spine:
+                        has_spine = True
+                        self.toc_id = element.get('toc', None)
+
+                elif depth == 3:
+                    if section == _OPF_MANIFEST and \
+                       element.tag == _OPF_ITEM:
+                        item = (element.get('id', None),
+                                element.get('href', None),
+                                element.get('media-type', None))
+
+                        if None not in item:
+                            self.items.append(item)
+
+                    elif section == _OPF_SPINE and \
+                         element.tag == _OPF_ITEMREF:
+                        idref = element.get('idref', None)
+
+                        if idref is not None:
+                            self.idrefs.append(idref)
+
+                continue
+
+            # The text is only complete at the end of the element
+            if depth == 3 and section == _OPF_METADATA:
+                if element.tag == _DC_TITLE and not has_title:
+                    has_title = True
+                    self.title = element.text
+
+                elif element.tag == _DC_CREATOR:
+                    self.creators.append((element.text or '',
+                                          element.get(_OPF_ROLE) == 'aut'))
+
+                elif element.tag == _DC_PUBLISHER and \
+                     self.publisher is None:
+                    self.publisher = element.text
+
+                elif element.tag == _OPF_META and \
+                     element.get('name', None) == 'generator':
+                    self.generator = element.get('content', None)
+
+            elif depth == 2:
+                element.clear()
+
+            depth -= 1
+
+
 class BadEpubError(Exception):
     """The error raised for bad ePubs files."""
 
@@ -105,42 +199,67 @@ class Epub(object):
 
     This is not meant to be a full ePub parsing class, but
     a simple and fast solution for what is needed.
+
+    When labels is False the table of contents is not
+    parsed and the labels of the contents are None. data is
+    the ePub when it was already read, otherwise an ePub in a
+    bundle is read from it, see bundle.py. When utf8 is True
+    the text of the contents may be UTF-8 bytes, see TagStripper.
+
+    strategy_stats is called with the producer, when tag_strategy
+    is None, for the tag_stripper.StrategyStats of its ePubs, or
+    None, which decides the order to try the tag strippers in.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, tag_strategy=None, labels=True, data=None,
+                 utf8=False, strategy_stats=None):
         self.__path = path
+        self.__tag_strategy = tag_strategy
+        self.__strategy_stats = strategy_stats
+        self.__labels = labels
+        self.__utf8 = utf8
 
         self.__title = None
         self.__author = None
         self.__warnings = []
         self.__items = None
+        self.__spine = ()
         self.__contents = []
         self.__tag_stripper = None
 
-        # These are automatically closed by __epub_error()
-        self.__epub_file = None
+        # Repeated chapters are stripped once and share their text
+        self.__stripped = {}
+        self.__texts = {}
+
+        # This is automatically closed by __epub_error()
         self.__epub_zipfile = None
 
         try:
-            # zipfile.ZipFile.open() will open the filename
-            # per call unless a file object was passed in
-            self.__epub_file = open(path, 'rb')
+            if data is None:
+                data = bundle.member_data(path)
+
+            self.__epub_zipfile = zipreader.ZipReader(path, data=data)
+
+        except zipreader.BadZipFile:
+            raise self.__epub_error('File is not an ePub file')
 
         except Exception as e:
             raise self.__epub_error(str(e))
 
-        try:
-            self.__epub_zipfile = zipfile.ZipFile(self.__epub_file, 'r')
-
-        except zipfile.BadZipfile:
-            raise self.__epub_error('File is not an ePub file')
+        # Everything needed before the contents in as few reads as possible
+        extensions = ('.opf', '.ncx') if labels else ('.opf',)
+        self.__epub_zipfile.prefetch(
+            [_CONTAINER_PATH] + [name for name in
+                                 self.__epub_zipfile.namelist()
+                                 if name.endswith(extensions)])
 
         # Set the path prefix to the root
         # until real prefix is determined
         self.__path_prefix = ''
 
         content_path = self.__get_content_path()
-        self.__opf = self.__open_and_parse(content_path)
+        self.__content_path = content_path
+        self.__opf = self.__parse_opf(content_path)
 
         # All future paths will be in this prefix
         self.__path_prefix = posixpath.dirname(content_path)
@@ -149,13 +268,9 @@ class Epub(object):
         self.__parse_metadata()
 
     def close(self):
-        if self.__epub_file is not None:
-            if self.__epub_zipfile is not None:
-                self.__epub_zipfile.close()
-                self.__epub_zipfile = None
-
-            self.__epub_file.close()
-            self.__epub_file = None
+        if self.__epub_zipfile is not None:
+            self.__epub_zipfile.close()
+            self.__epub_zipfile = None
 
     def __enter__(self):
         return self
@@ -193,6 +308,15 @@ class Epub(object):
             full_path = posixpath.join(self.__path_prefix, path)
             raise self.__epub_error('Failed to parse %r: %s' % (full_path, e))
 
+    def __parse_opf(self, path):
+        xml = self.__open(path)
+
+        try:
+            return _Opf(xml)
+
+        except Exception as e:
+            raise self.__epub_error('Failed to parse %r: %s' % (path, e))
+
     def __get_content_path(self):
         container = self.__open_and_parse(_CONTAINER_PATH)
 
@@ -216,48 +340,45 @@ class Epub(object):
         return content_path
 
     def __parse_metadata(self):
-        metadata = _XPATH_METADATA(self.__opf)
-        if metadata is None:
+        if not self.__opf.has_metadata:
             raise self.__epub_error('Failed to find metadata')
 
-        title = _XPATH_METADATA_TITLE(metadata)
+        title = self.__opf.title
         if title is None:
             raise self.__epub_error('Failed to find title')
 
         self.__title = title.strip()
 
         # Creator is not a required tag
-        creators = _XPATH_METADATA_CREATORS(metadata)
+        creators = self.__opf.creators
         if creators:
             # Set the author to the first creator
             # in case the author role was not found
-            self.__author = creators[0].text.strip()
+            self.__author = creators[0][0].strip()
 
             for i in range(1, len(creators)):
-                if _XPATH_CREATOR_IS_AUTHOR(creators[i]):
-                    self.__author = creators[i].text.strip()
+                if creators[i][1]:
+                    self.__author = creators[i][0].strip()
                     break
 
     def __get_manifest(self):
-        items = _XPATH_ITEMS(self.__opf)
+        items = self.__opf.items
         if not items:
             raise self.__epub_error('Failed to find items in %r' %
-                                    (content_path))
+                                    (self.__content_path))
 
         manifest = {}
-        for item in items:
-            # The XPath requires that these attributes exist
-            item_id = item.get('id')
-            item_href = item.get('href')
-            item_media_type = item.get('media-type')
-
+        for item_id, item_href, item_media_type in items:
             manifest[item_id] = _Item(path=unquote(item_href),
                                       media_type=item_media_type)
 
         return manifest
 
     def __get_item_labels(self, manifest):
-        toc_item = manifest.get(_XPATH_TOC_ID(self.__opf), None)
+        if not self.__labels:
+            return {}
+
+        toc_item = manifest.get(self.__opf.toc_id, None)
         if toc_item is None or toc_item.media_type != _MIMETYPE_NCX:
             return {}
 
@@ -281,7 +402,7 @@ class Epub(object):
         manifest = self.__get_manifest()
         item_labels = self.__get_item_labels(manifest)
 
-        idrefs = _XPATH_IDREFS(self.__opf)
+        idrefs = self.__opf.idrefs
         if not idrefs:
             self.__epub_warning('Failed to find contents')
             return
@@ -303,7 +424,7 @@ class Epub(object):
     def open(self, path):
         """Returns the data located by @path."""
 
-        return self.__epub_zipfile.open(path).read()
+        return self.__epub_zipfile.read(path)
 
     @property
     def path(self):
@@ -324,14 +445,103 @@ class Epub(object):
         return self.__author
 
     @property
-    def contents(self):
-        """Returns the ePub's contents as EpubContent objects."""
+    def producer(self):
+        """Returns the software which made the ePub, or else
+        its publisher, or None."""
 
+        producer = self.__opf.generator or self.__opf.publisher
+        if producer is None:
+            return None
+
+        return producer.strip() or None
+
+    def __parse_spine(self):
         if self.__items is None:
             self.__items = []
-            self.__tag_stripper = TagStripper()
+            stats = None
+            if self.__tag_strategy is None and \
+               self.__strategy_stats is not None:
+                stats = self.__strategy_stats(self.producer)
+
+            self.__tag_stripper = TagStripper(self.__tag_strategy, stats)
 
             self.__parse_items()
+            self.__spine = tuple(self.__items)
+
+    def __load_content(self, path, label):
+        # Returns the EpubContent of path, or None when it failed to open
+        try:
+            info = self.__epub_zipfile.getinfo(path)
+            member = (info.CRC, info.file_size)
+
+        except KeyError:
+            member = None
+
+        try:
+            # path is the full path (with self.__path_prefix)
+            xhtml = self.open(path)
+
+        except Exception as e:
+            self.__epub_warning('Failed to open %r: %s' % (path, e))
+            return None
+
+        # The CRC and size only find the candidates, only the same
+        # xhtml is stripped once, comparing it costs much less
+        stripped = self.__stripped.get(member, ())
+        for stripped_xhtml, text in stripped:
+            if stripped_xhtml == xhtml:
+                return EpubContent(path, label, stripped_xhtml, text)
+
+        try:
+            text = self.__tag_stripper(xhtml, self.__utf8)
+
+        except TagStripError as e:
+            self.__epub_warning('Failed to strip tags from %r: %s' %
+                                (path, e))
+            text = None
+
+        if text is not None:
+            # Different markup can still have the same text
+            text = self.__texts.setdefault(text, text)
+
+        if member is not None:
+            self.__stripped.setdefault(member, []).append((xhtml, text))
+
+        return EpubContent(path, label, xhtml, text)
+
+    @property
+    def spine(self):
+        """Returns the (path, label) of each of the contents in order."""
+
+        self.__parse_spine()
+        return self.__spine
+
+    def contents_of(self, items):
+        """Yields EpubContent objects for the (path, label) @items.
+
+        @items are from spine, this allows parsing
+        only part of the contents, such as in another process.
+        """
+
+        self.__parse_spine()
+
+        items = tuple(items)
+        self.__epub_zipfile.prefetch(path for path, label in items)
+
+        for path, label in items:
+            content = self.__load_content(path, label)
+            if content is not None:
+                yield content
+
+    @property
+    def contents(self):
+        """Returns the ePub's contents as EpubContent objects."""
+
+        self.__parse_spine()
+
+        # The spine items are usually stored together,
+        # those which were read already are skipped
+        self.__epub_zipfile.prefetch(path for path, label in self.__items)
 
         for content in self.__contents:
             yield content
@@ -339,30 +549,39 @@ class Epub(object):
         while self.__items:
             path, label = self.__items.pop(0)
 
-            try:
-                # path is the full path (with self.__path_prefix)
-                xhtml = self.open(path)
-
-            except Exception as e:
-                self.__epub_warning('Failed to open %r: %s' % (path, e))
+            content = self.__load_content(path, label)
+            if content is None:
                 continue
 
-            try:
-                text = self.__tag_stripper(xhtml)
-
-            except TagStripError as e:
-                self.__epub_warning('Failed to strip tags from %r: %s' %
-                                    (path, e))
-                text = None
-
-            content = EpubContent(path, label, xhtml, text)
-
             # We must add the contents to the internal
             # list before yielding as we might stop generating
             self.__contents.append(content)
 
             yield content
 
+    @property
+    def tag_strategy(self):
+        """Returns the tag_stripper.STRATEGIES item used for the contents.
+
+        This is None until the contents are parsed, and
+        can change as more of the contents are parsed.
+        """
+
+        if self.__tag_stripper is None:
+            return None
+
+        return self.__tag_stripper.strategy
+
+    @property
+    def tag_stats(self):
+        """Returns the tag_stripper.StrategyStats of what was
+        tried for the contents, or None before parsing them."""
+
+        if self.__tag_stripper is None:
+            return None
+
+        return self.__tag_stripper.recorded
+
     @property
     def warnings(self):
         """Returns the warnings generated while parsing the ePub.
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Estimating how much matches by searching a sample of the ePubs.
+
+The ePubs are split by size into strata of about the same number of
+ePubs, since long books are more likely to match and have more
+matches, and each stratum is sampled in proportion to its number of
+ePubs. The totals are the stratified estimates. The confidence
+interval of the number of ePubs with a match combines the Wilson
+score intervals of the strata, so that a rare pattern which was
+not seen in the sample still gets an upper bound. That of the
+number of matches is from the normal approximation. Both are exact
+once every ePub has been searched. ePubs which can not be parsed
+count as having no matches, as they do when searching all of them.
+"""
+
+from collections import namedtuple
+import math
+import random
+import time
+
+from epub_search import search
+from epub_search import util
+
+
+# The number of size strata, fewer when there are few ePubs
+_N_STRATA = 4
+
+# Each stratum is sampled at least this much, for its variance
+_MIN_STRATUM_SAMPLE = 2
+
+
+Interval = namedtuple('Interval', ('value', 'low', 'high'))
+
+
+_estimate_fields = ('n_sampled', 'n_paths', 'n_errors', 'matched',
+                    'matches', 'confidence', 'elapsed')
+
+
+class Estimate(namedtuple('Estimate', _estimate_fields)):
+    """The estimated totals of searching every ePub.
+
+    n_sampled: the number of ePubs searched
+    n_paths: the number of ePubs the estimate is for
+    n_errors: the number of searched ePubs which could not be parsed
+    matched: an Interval of the number of ePubs with a match
+    matches: an Interval of the number of matches in all of the ePubs
+    confidence: the confidence level of the Intervals
+    elapsed: seconds spent searching
+    """
+
+    @property
+    def exact(self):
+        return self.n_sampled == self.n_paths
+
+
+def _z(confidence):
+    # The two-sided quantile of the standard normal distribution,
+    # math.erf() is increasing so a bisection is enough
+    low = 0.0
+    high = 10.0
+
+    for i in range(64):
+        middle = (low + high) / 2
+
+        if math.erf(middle / math.sqrt(2)) < confidence:
+            low = middle
+
+        else:
+            high = middle
+
+    return (low + high) / 2
+
+
+def _strata(paths, rng):
+    # Splits @paths by size, each stratum is shuffled so
+    # that any prefix of it is a random sample of it
+    by_size = sorted(paths, key=util.file_size)
+    n_strata = max(1, min(_N_STRATA, len(by_size) // _MIN_STRATUM_SAMPLE))
+
+    strata = []
+    for i in range(n_strata):
+        stratum = by_size[i * len(by_size) // n_strata:
+                          (i + 1) * len(by_size) // n_strata]
+        rng.shuffle(stratum)
+        strata.append(stratum)
+
+    return strata
+
+
+def _allocate(strata, n_paths, sample_size):
+    # The number of ePubs to have searched in each stratum
+    return [min(len(stratum),
+                max(_MIN_STRATUM_SAMPLE,
+                    int(round(float(sample_size) * len(stratum) / n_paths))))
+            for stratum in strata]
+
+
+def _wilson(x, n, z):
+    # The Wilson score interval of a proportion, which unlike the
+    # normal approximation is not empty when nothing or everything
+    # in the sample matched
+    p = float(x) / n
+    z2 = z * z
+
+    center = (p + z2 / (2 * n)) / (1 + z2 / n)
+    margin = z / (1 + z2 / n) * math.sqrt(p * (1 - p) / n +
+                                          z2 / (4 * n * n))
+
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def _normal(strata, counts, values, z):
+    # The stratified estimate of the total of @values and the
+    # margin of its normal approximation
+    total = 0.0
+    variance = 0.0
+
+    for stratum, n in zip(strata, counts):
+        sample = [values[path] for path in stratum[:n]]
+        mean = float(sum(sample)) / n
+
+        total += len(stratum) * mean
+
+        if 1 < n < len(stratum):
+            s2 = sum((x - mean) ** 2 for x in sample) / (n - 1)
+            variance += len(stratum) ** 2 * (1.0 - float(n) / len(stratum)) \
+                * s2 / n
+
+    return total, z * math.sqrt(variance)
+
+
+def _matched_interval(strata, counts, matched, z):
+    # The Wilson intervals of the strata are combined by adding the
+    # squares of their distances from the estimate on either side
+    # (MOVER), the normal approximation is used when it is wider
+    total, margin = _normal(strata, counts, matched, z)
+
+    below = 0.0
+    above = 0.0
+
+    for stratum, n in zip(strata, counts):
+        if n >= len(stratum):
+            continue
+
+        x = sum(matched[path] for path in stratum[:n])
+        p = float(x) / n
+        low, high = _wilson(x, n, z)
+
+        # The finite population correction
+        scale = len(stratum) * math.sqrt(1.0 - float(n) / len(stratum))
+        below += (scale * (p - low)) ** 2
+        above += (scale * (high - p)) ** 2
+
+    n_sampled = sum(counts)
+    n_seen = sum(matched.values())
+    n_paths = sum(len(stratum) for stratum in strata)
+
+    # Never less than was seen, nor more than is possible
+    return Interval(total,
+                    max(n_seen, total - max(margin, math.sqrt(below))),
+                    min(n_paths - n_sampled + n_seen,
+                        total + max(margin, math.sqrt(above))))
+
+
+def _matches_interval(strata, counts, matches, z, matched_interval):
+    total, margin = _normal(strata, counts, matches, z)
+
+    # A stratum where nothing matched has no variance, but the ePubs
+    # which might match going by matched_interval have at least as
+    # many matches as those which were seen to, or one
+    n_seen = sum(1 for x in matches.values() if x > 0)
+    per_book = float(sum(matches.values())) / n_seen if n_seen else 1.0
+    unseen = (matched_interval.high - matched_interval.value) * per_book
+
+    return Interval(total, max(sum(matches.values()), total - margin),
+                    total + max(margin, unseen))
+
+
+def _relative_width(interval, exact):
+    # A partial sample never makes an empty interval precise
+    if not exact and interval.high <= interval.low:
+        return float('inf')
+
+    if interval.value <= 0:
+        return 0.0 if interval.high <= 0 else float('inf')
+
+    return (interval.high - interval.low) / 2 / interval.value
+
+
+def estimate(paths, matcher, sample_size=100, precision=None,
+             time_limit=None, confidence=0.95, sync=None, text_cache=None,
+             parse_cache=None, seed=None):
+    """Returns an Estimate for searching @paths with @matcher.
+
+    About @sample_size ePubs are searched at first. With @precision,
+    the sample is doubled until both Intervals are within that fraction
+    of their value on either side, and with @time_limit until another
+    round would not be done within that many seconds of the start.
+    Also returns a list of the errors of the searched ePubs. @sync,
+    @text_cache and @parse_cache are as for search.search(), @seed
+    makes the sample the same each time.
+    """
+
+    paths = tuple(paths)
+    if not paths:
+        nothing = Interval(0.0, 0.0, 0.0)
+        return Estimate(0, 0, 0, nothing, nothing, confidence, 0.0), []
+
+    rng = random.Random(seed)
+    z = _z(confidence)
+
+    strata = _strata(paths, rng)
+    counts = [0] * len(strata)
+
+    matched = {}
+    matches = {}
+    errors = []
+
+    started = time.time()
+
+    while 1:
+        wanted = _allocate(strata, len(paths), sample_size)
+
+        sample = []
+        for stratum, n, wanted_n in zip(strata, counts, wanted):
+            sample.extend(stratum[n:wanted_n])
+
+        for result in search.search(sample, matcher, False, sync,
+                                    text_cache=text_cache,
+                                    parse_cache=parse_cache):
+            if result.error is not None:
+                errors.append(result.error)
+
+            matched[result.path] = 1 if result.n_matches > 0 else 0
+            matches[result.path] = result.n_matches
+
+        counts = [max(n, wanted_n) for n, wanted_n in zip(counts, wanted)]
+        n_sampled = sum(counts)
+
+        matched_interval = _matched_interval(strata, counts, matched, z)
+        matches_interval = _matches_interval(strata, counts, matches, z,
+                                             matched_interval)
+
+        elapsed = time.time() - started
+
+        if n_sampled >= len(paths) or (precision is None and
+                                       time_limit is None):
+            break
+
+        exact = n_sampled >= len(paths)
+        if precision is not None and \
+           _relative_width(matched_interval, exact) <= precision and \
+           _relative_width(matches_interval, exact) <= precision:
+            break
+
+        # The next round searches about as many ePubs as all before it
+        if time_limit is not None and elapsed * 2 > time_limit:
+            break
+
+        sample_size = n_sampled * 2
+
+    return Estimate(n_sampled, len(paths), len(errors), matched_interval,
+                    matches_interval, confidence, elapsed), errors
+
+# ex:et:ts=4:
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Flat UTF-8 text dumps of ePubs with an offset table.
+
+The text of every chapter is written to one file, or to shards of
+about the requested size, each chapter followed by a newline. The
+offset table, OUTPUT.offsets, maps byte ranges back to the ePub,
+chapter path and label. It is made up of:
+
+    magic 'EPUBFLAT', version, number of shards, books and chapters
+    the shard file names
+    each book's path, title and author
+    each chapter's shard, start, end and book index
+    each chapter's path and label
+
+Numbers are little-endian and strings are UTF-8 prefixed by their
+length, with a length of 0xffffffff for None.
+"""
+
+from array import array
+import bisect
+from collections import namedtuple
+import mmap
+import os
+import struct
+
+from epub_search import epub
+from epub_search import multiprocess
+from epub_search.search import SearchResult, _match_contents
+
+
+_MAGIC = b'EPUBFLAT'
+_VERSION = 1
+
+_HEADER = struct.Struct('<8sIIII')
+_LENGTH = struct.Struct('<I')
+_CHAPTER = struct.Struct('<IQQI')
+
+_NONE_LENGTH = 0xffffffff
+
+
+FlatBook = namedtuple('FlatBook', ('path', 'title', 'author'))
+FlatChapter = namedtuple('FlatChapter', ('shard', 'start', 'end', 'book',
+                                         'path', 'label'))
+
+
+class FlatFileError(Exception):
+    """The error raised for bad offset tables."""
+
+
+def _pack_string(string):
+    if string is None:
+        return _LENGTH.pack(_NONE_LENGTH)
+
+    data = string.encode('utf-8')
+    return _LENGTH.pack(len(data)) + data
+
+
+def _extract(path):
+    try:
+        epub_file = epub.Epub(path)
+
+    except epub.BadEpubError as e:
+        return path, str(e)
+
+    with epub_file:
+        chapters = []
+
+        for content in epub_file.contents:
+            # Text is None when stripping the tags failed
+            if content.text is not None:
+                chapters.append((content.path, content.label,
+                                 content.text.encode('utf-8')))
+
+        return path, (epub_file.title, epub_file.author, chapters)
+
+
+def _shard_path(output, shard, sharded):
+    if not sharded:
+        return output
+
+    return '%s.%04i' % (output, shard)
+
+
+def write(paths, output, shard_size=None, sync=None):
+    """Writes the text of the ePubs at @paths to @output.
+
+    Returns a list of the errors for ePubs that could not be parsed.
+    When @shard_size is given the text is split into files of about
+    that many bytes named OUTPUT.0000, OUTPUT.0001 and so on.
+    """
+
+    paths = tuple(paths)
+    sharded = shard_size is not None
+
+    # Same rules as search.search()
+    if sync or (sync is None and len(paths) <= 1):
+        extracted = (_extract(path) for path in paths)
+
+    else:
+        extracted = multiprocess.Job(_extract, [(path,) for path in paths])
+
+    errors = []
+    books = []
+    chapters = []
+    shard_names = []
+
+    shard_file = None
+    position = 0
+
+    try:
+        for path, book in extracted:
+            if isinstance(book, str):
+                errors.append(book)
+                continue
+
+            title, author, book_chapters = book
+            books.append(FlatBook(path, title, author))
+
+            for chapter_path, label, data in book_chapters:
+                if shard_file is None or \
+                   (sharded and position > 0 and
+                    position + len(data) > shard_size):
+                    if shard_file is not None:
+                        shard_file.close()
+
+                    shard_path = _shard_path(output, len(shard_names),
+                                             sharded)
+                    shard_names.append(os.path.basename(shard_path))
+                    shard_file = open(shard_path, 'wb')
+                    position = 0
+
+                shard_file.write(data)
+                shard_file.write(b'\n')
+
+                chapters.append(FlatChapter(len(shard_names) - 1, position,
+                                            position + len(data),
+                                            len(books) - 1,
+                                            chapter_path, label))
+                position += len(data) + 1
+
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    parts = [_HEADER.pack(_MAGIC, _VERSION, len(shard_names),
+                          len(books), len(chapters))]
+    parts.extend(_pack_string(name) for name in shard_names)
+
+    for book in books:
+        parts.extend(_pack_string(x) for x in book)
+
+    for chapter in chapters:
+        parts.append(_CHAPTER.pack(*chapter[:4]))
+
+    for chapter in chapters:
+        parts.append(_pack_string(chapter.path))
+        parts.append(_pack_string(chapter.label))
+
+    with open(output + '.offsets', 'wb') as offsets_file:
+        offsets_file.write(b''.join(parts))
+
+    return errors
+
+
+class _Reader(object):
+    __slots__ = ('data', 'position')
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def unpack(self, struct_format):
+        end = self.position + struct_format.size
+        if end > len(self.data):
+            raise FlatFileError('Truncated offset table')
+
+        values = struct_format.unpack(self.data[self.position:end])
+        self.position = end
+
+        return values
+
+    def string(self):
+        length, = self.unpack(_LENGTH)
+        if length == _NONE_LENGTH:
+            return None
+
+        end = self.position + length
+        string = self.data[self.position:end].decode('utf-8')
+        self.position = end
+
+        return string
+
+
+class FlatCorpus(object):
+    """Searches text written by write() without parsing any ePubs.
+
+    The shards are mmap()'ed and literal patterns are found in the
+    UTF-8 bytes directly, only chapters with a match are decoded.
+    """
+
+    def __init__(self, output):
+        with open(output + '.offsets', 'rb') as offsets_file:
+            reader = _Reader(offsets_file.read())
+
+        magic, version, n_shards, n_books, n_chapters = \
+            reader.unpack(_HEADER)
+        if magic != _MAGIC or version != _VERSION:
+            raise FlatFileError('%r is not an offset table' %
+                                (output + '.offsets'))
+
+        directory = os.path.dirname(output)
+        shard_paths = [os.path.join(directory, reader.string())
+                       for i in range(n_shards)]
+
+        self.books = tuple(FlatBook(reader.string(), reader.string(),
+                                    reader.string())
+                           for i in range(n_books))
+
+        self.__shards = []
+        self.__starts = []
+        self.__ends = []
+        self.__chapter_books = array('l')
+
+        chapters = []
+        for i in range(n_chapters):
+            chapters.append(reader.unpack(_CHAPTER))
+
+        for shard, start, end, book in chapters:
+            # Chapters are in order, so a single array of
+            # offsets across all of the shards can be bisected
+            offset = shard << 40
+
+            self.__starts.append(offset + start)
+            self.__ends.append(offset + end)
+            self.__chapter_books.append(book)
+
+        self.chapters = tuple(FlatChapter(shard, start, end, book,
+                                          reader.string(), reader.string())
+                              for shard, start, end, book in chapters)
+
+        try:
+            for shard_path in shard_paths:
+                with open(shard_path, 'rb') as shard_file:
+                    # mmap() fails for empty files
+                    if os.fstat(shard_file.fileno()).st_size == 0:
+                        self.__shards.append(b'')
+                        continue
+
+                    self.__shards.append(mmap.mmap(shard_file.fileno(), 0,
+                                                   access=mmap.ACCESS_READ))
+
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for shard in self.__shards:
+            if isinstance(shard, mmap.mmap):
+                shard.close()
+
+        self.__shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def chapter_text(self, i):
+        """Returns the text of the chapter at index @i."""
+
+        chapter = self.chapters[i]
+        data = self.__shards[chapter.shard][chapter.start:chapter.end]
+
+        return data.decode('utf-8')
+
+    def __candidates(self, matcher):
+        # Yields the index of each chapter which might match
+        pattern = matcher.utf8_literal
+        if pattern is None:
+            for i in range(len(self.chapters)):
+                yield i
+
+            return
+
+        starts = self.__starts
+        ends = self.__ends
+
+        for shard_index, shard in enumerate(self.__shards):
+            offset = shard_index << 40
+            position = shard.find(pattern, 0)
+
+            while position != -1:
+                i = bisect.bisect_right(starts, offset + position) - 1
+
+                # Skip the rest of the chapter, a match
+                # spanning the separator is not in a chapter
+                if offset + position + len(pattern) <= ends[i]:
+                    yield i
+
+                position = shard.find(pattern, max(ends[i] - offset,
+                                                   position + 1))
+
+    def __book_search(self, book, chapters, matcher, with_context,
+                      context_chars, max_snippets):
+        contents = ((self.chapters[i].label, self.chapter_text(i))
+                    for i in chapters)
+        n_matches, matches = _match_contents(contents, matcher, with_context,
+                                             context_chars, max_snippets)
+
+        if n_matches == 0:
+            return None
+
+        book = self.books[book]
+        return SearchResult(path=book.path, title=book.title,
+                            author=book.author, n_matches=n_matches,
+                            matches=matches)
+
+    def search(self, matcher, with_context=False, context_chars=None,
+               max_snippets=None):
+        """Returns a SearchResult for each ePub with a match.
+
+        @context_chars and @max_snippets are as for search.search().
+        """
+
+        results = []
+        book = None
+        chapters = []
+
+        # Candidates are in order so an ePub's chapters are together
+        for i in self.__candidates(matcher):
+            if self.__chapter_books[i] != book:
+                if chapters:
+                    results.append(self.__book_search(book, chapters,
+                                                      matcher, with_context,
+                                                      context_chars,
+                                                      max_snippets))
+
+                book = self.__chapter_books[i]
+                chapters = []
+
+            chapters.append(i)
+
+        if chapters:
+            results.append(self.__book_search(book, chapters,
+                                              matcher, with_context,
+                                              context_chars, max_snippets))
+
+        return [result for result in results if result is not None]
+
+# ex:et:ts=4:
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Approximate matching within an edit distance."""
+
+import re
+
+from epub_search import matching
+
+# Python 3 compat
+try:
+    basestring = basestring
+except NameError:
+    basestring = (str,bytes)
+
+
+def _pieces(pattern, n_pieces):
+    # Splits pattern into n_pieces as equal as possible,
+    # returning the (offset, piece) of each of them
+    length = len(pattern)
+    pieces = []
+
+    for i in range(n_pieces):
+        start = i * length // n_pieces
+        end = (i + 1) * length // n_pieces
+        pieces.append((start, pattern[start:end]))
+
+    return pieces
+
+
+def _best_start(pattern, text, end, max_errors):
+    # Returns (errors, start) for the substring of text ending
+    # at end with the fewest errors, using the reversed strings
+    reversed_pattern = pattern[::-1]
+    window = text[max(0, end - len(pattern) - max_errors):end][::-1]
+
+    previous = list(range(len(window) + 1))
+
+    for i, char in enumerate(reversed_pattern):
+        current = [i + 1]
+
+        for j, text_char in enumerate(window):
+            current.append(min(previous[j] + (char != text_char),
+                               previous[j + 1] + 1, current[j] + 1))
+
+        previous = current
+
+    # Fewest errors, then the length closest to the pattern's
+    best = min(range(len(previous)),
+               key=lambda j: (previous[j], abs(j - len(pattern))))
+
+    return previous[best], end - best
+
+
+class FuzzyMatcher(object):
+    """Finds matches of a literal pattern within max_errors edits.
+
+    An edit is inserting, deleting or substituting a character. The
+    search uses Myers' bit-parallel algorithm, so each character of
+    text costs a few integer operations regardless of the pattern's
+    length. Since a match with at most k errors must contain one of
+    k + 1 pieces of the pattern exactly, the pieces are first found
+    with the regex engine and only the text around them is scanned.
+    """
+
+    def __init__(self, to_match, max_errors, ignore_case):
+        if max_errors < 0 or max_errors >= len(to_match):
+            raise ValueError('The number of errors must be at least 0 and '
+                             'less than the length of the pattern')
+
+        self.to_match = to_match
+        self.max_errors = max_errors
+        self.ignore_case = ignore_case
+        self.use_regex = False
+
+        pattern = to_match.lower() if ignore_case else to_match
+        self.__pattern = pattern
+
+        self.__peq = {}
+        for i, char in enumerate(pattern):
+            self.__peq[char] = self.__peq.get(char, 0) | (1 << i)
+
+        self.__pieces = _pieces(pattern, max_errors + 1)
+
+        # The same piece can be at multiple offsets in the pattern
+        self.__piece_offsets = {}
+        for offset, piece in self.__pieces:
+            self.__piece_offsets.setdefault(piece, []).append(offset)
+
+        # A lookahead finds pieces which overlap each other
+        self.__pieces_re = re.compile('(?=(%s))' % ('|'.join(
+            re.escape(piece) for piece in self.__piece_offsets)))
+
+    @property
+    def is_regex(self):
+        # Matches can span anything, chapters are matched separately
+        return True
+
+    @property
+    def required_literals(self):
+        # Any one of the pieces is required, not each of them
+        return ()
+
+    @property
+    def utf8_literal(self):
+        return None
+
+    @property
+    def pieces(self):
+        """Returns the pieces of the pattern, one of which every match
+        contains, for use by an index."""
+
+        return tuple(piece for offset, piece in self.__pieces)
+
+    @property
+    def uses_signatures(self):
+        return True
+
+    def may_match_signature(self, text_signature):
+        # Every match contains one of the pieces
+        return any(text_signature.may_contain(piece)
+                   for offset, piece in self.__pieces)
+
+    def __fold(self, string):
+        if not isinstance(string, basestring):
+            raise TypeError('\'basestring\' argument expected, got %r.' %
+                            (type(string).__name__))
+
+        return string.lower() if self.ignore_case else string
+
+    def may_match(self, string):
+        return self.__pieces_re.search(self.__fold(string)) is not None
+
+    def __windows(self, string):
+        # Returns the merged (start, end) of the text around the pieces
+        length = len(self.__pattern)
+        max_errors = self.max_errors
+        piece_offsets = self.__piece_offsets
+
+        windows = []
+        for found in self.__pieces_re.finditer(string):
+            position = found.start()
+
+            # Only the first alternative is reported, but
+            # one piece can be the prefix of another
+            for piece, offsets in piece_offsets.items():
+                if not string.startswith(piece, position):
+                    continue
+
+                for offset in offsets:
+                    start = position - offset
+                    windows.append((max(0, start - max_errors),
+                                    min(len(string),
+                                        start + length + max_errors)))
+
+        windows.sort()
+
+        merged = []
+        for start, end in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+
+            else:
+                merged.append((start, end))
+
+        return merged
+
+    def __ends(self, string, start, end):
+        # Myers' algorithm, yields (end, errors) for each position
+        # in string[start:end] where a match with few enough errors ends
+        peq = self.__peq
+        length = len(self.__pattern)
+        max_errors = self.max_errors
+
+        mask = (1 << length) - 1
+        high = 1 << (length - 1)
+
+        pv = mask
+        mv = 0
+        errors = length
+
+        for position in range(start, end):
+            eq = peq.get(string[position], 0)
+
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+
+            if ph & high:
+                errors += 1
+
+            elif mh & high:
+                errors -= 1
+
+            # Matches may start anywhere, so no carry in
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+
+            if errors <= max_errors:
+                yield position + 1, errors
+
+    def __spans(self, string):
+        previous_end = 0
+
+        for start, end in self.__windows(string):
+            best = None
+
+            # Consecutive ends belong to the same match, keep the
+            # best and the longest of those that are equally good
+            for match_end, errors in self.__ends(string, start, end):
+                if best is not None and match_end == best[2] + 1:
+                    best[2] = match_end
+
+                    if errors <= best[1]:
+                        best[0:2] = [match_end, errors]
+
+                    continue
+
+                if best is not None:
+                    span = self.__span(string, best, previous_end)
+                    if span is not None:
+                        previous_end = span[1]
+                        yield span
+
+                best = [match_end, errors, match_end]
+
+            if best is not None:
+                span = self.__span(string, best, previous_end)
+                if span is not None:
+                    previous_end = span[1]
+                    yield span
+
+    def __span(self, string, best, previous_end):
+        match_end = best[0]
+        errors, match_start = _best_start(self.__pattern, string, match_end,
+                                          self.max_errors)
+
+        # All matching functions find only non-overlapping occurrences
+        if match_start < previous_end:
+            return None
+
+        return match_start, match_end
+
+    def spans(self, string):
+        """Yields the (start, end) of each match in @string."""
+
+        return self.__spans(self.__fold(string))
+
+    def count(self, string):
+        return sum(1 for span in self.spans(string))
+
+    def match(self, string, context_chars=None):
+        return matching.context_matches(self.spans(string),
+                                        self.__fold(string), string,
+                                        context_chars)
+
+# ex:et:ts=4:
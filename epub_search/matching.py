@@ -17,7 +17,17 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from array import array
+from bisect import bisect_right
 import re
+import unicodedata
+
+try:
+    # Python 3.11 deprecated the sre_parse module
+    from re import _parser as sre_parse
+
+except ImportError:
+    import sre_parse
 
 # Python 3 compat
 try:
@@ -25,14 +35,241 @@ try:
 except NameError:
     basestring = (str,bytes)
 
+try:
+    unichr = unichr
+except NameError:
+    unichr = chr
 
-class Match(object):
-    __slots__ = ('text', 'match_positions')
 
-    def __init__(self, text, match_positions):
+# Python 2 does not have casefold()
+_casefold = getattr(type(u''), 'casefold', type(u'').lower)
+
+
+_REPEATS = frozenset(getattr(sre_parse, x) for x in
+                     ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                     if hasattr(sre_parse, x))
+
+
+def _required_literals(parsed, literals):
+    # Appends the literal strings which every match of the
+    # parsed pattern contains to literals, returns whether
+    # any part of the pattern changes the case sensitivity
+    run = []
+    changes_case = False
+
+    for op, value in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(unichr(value))
+            continue
+
+        # Anchors are zero-width so the run continues
+        if op == sre_parse.AT:
+            continue
+
+        if run:
+            literals.append(u''.join(run))
+            run = []
+
+        if op == sre_parse.SUBPATTERN:
+            # Python 2 does not have the flags
+            if len(value) == 4:
+                changes_case |= bool((value[1] | value[2]) & re.IGNORECASE)
+
+            changes_case |= _required_literals(value[-1], literals)
+
+        elif op in _REPEATS:
+            min_repeat, max_repeat, repeated = value
+
+            if min_repeat >= 1:
+                changes_case |= _required_literals(repeated, literals)
+
+        # Alternatives, classes and so on are not literals
+
+    if run:
+        literals.append(u''.join(run))
+
+    return changes_case
+
+
+def _fold_char(char):
+    # Decomposing separates the accents from the letters
+    decomposed = unicodedata.normalize('NFKD', char)
+
+    return _casefold(u''.join(x for x in decomposed
+                              if not unicodedata.combining(x)))
+
+
+def fold(string):
+    """Returns @string without accents and case."""
+
+    return FoldedText(string).folded
+
+
+def _fold_regex(pattern):
+    # Literal characters are case folded like the text, so that
+    # ß matches the ss it folds to. Escapes like \S and character
+    # classes are left alone, case is handled by the regex engine
+    # within them, which only knows of single characters.
+    decomposed = unicodedata.normalize('NFKD', pattern)
+    pattern = u''.join(x for x in decomposed if not unicodedata.combining(x))
+
+    parts = []
+    in_class = False
+    i = 0
+
+    while i < len(pattern):
+        char = pattern[i]
+
+        if char == u'\\':
+            parts.append(pattern[i:i + 2])
+            i += 2
+            continue
+
+        if in_class:
+            in_class = char != u']'
+            parts.append(char)
+
+        elif char == u'[':
+            in_class = True
+            parts.append(char)
+
+            # A ] first in the class is part of it
+            for special in (u'^', u']'):
+                if pattern[i + 1:i + 2] == special:
+                    parts.append(special)
+                    i += 1
+
+        else:
+            folded = _casefold(char)
+
+            # Keeps a repeat applying to all of it
+            if len(folded) > 1:
+                folded = u'(?:%s)' % (folded)
+
+            parts.append(folded)
+
+        i += 1
+
+    return u''.join(parts)
+
+
+class FoldedText(object):
+    """The text of a chapter with the accents and case folded away.
+
+    Characters can fold to none or several characters, so positions
+    in folded map back to text with a position plus a delta. Only
+    the positions where the delta changes are stored, which for
+    mostly unaccented text is a handful.
+    """
+
+    __slots__ = ('text', 'folded', 'positions', 'deltas')
+
+    def __init__(self, text, folded=None, positions=None, deltas=None):
         self.text = text
-        # Prevent modification
-        self.match_positions = tuple(match_positions)
+
+        if folded is not None:
+            self.folded = folded
+            self.positions = positions
+            self.deltas = deltas
+            return
+
+        self.positions = array('l')
+        self.deltas = array('l')
+
+        try:
+            text.encode('ascii')
+
+        except UnicodeError:
+            pass
+
+        else:
+            # Nothing to map, lower() is one to one for ASCII
+            self.folded = text.lower()
+            return
+
+        cache = {}
+        parts = []
+        delta = 0
+        position = 0
+
+        for i, char in enumerate(text):
+            folded_char = cache.get(char, None)
+            if folded_char is None:
+                folded_char = cache[char] = _fold_char(char)
+
+            for j in range(len(folded_char)):
+                if i - position != delta:
+                    delta = i - position
+                    self.positions.append(position)
+                    self.deltas.append(delta)
+
+                position += 1
+
+            parts.append(folded_char)
+
+        self.folded = u''.join(parts)
+
+    def __len__(self):
+        return len(self.text)
+
+    def original(self, position):
+        """Returns the position in text of @position in folded."""
+
+        if position >= len(self.folded):
+            return len(self.text)
+
+        i = bisect_right(self.positions, position) - 1
+        if i < 0:
+            return position
+
+        return position + self.deltas[i]
+
+    def original_span(self, start, end):
+        """Returns the (start, end) in text of a span in folded."""
+
+        original_end = self.original(end)
+
+        # Part of a character that folded to several
+        if end > start:
+            original_end = max(original_end, self.original(end - 1) + 1)
+
+        return self.original(start), original_end
+
+
+class Match(object):
+    """Matches in a snippet of a chapter's text.
+
+    The snippet is source[start:end] and is only sliced when the text
+    is used, so a Match is just offsets into the chapter's text. When
+    pickled only the snippet is kept.
+    """
+
+    __slots__ = ('source', 'start', 'end', 'match_positions')
+
+    def __init__(self, text, match_positions, start=0, end=None):
+        self.source = text
+        self.start = start
+        self.end = len(text) if end is None else end
+
+        # Positions are relative to start
+        self.match_positions = match_positions
+
+    @property
+    def text(self):
+        if self.start == 0 and self.end == len(self.source):
+            return self.source
+
+        return self.source[self.start:self.end]
+
+    def __getstate__(self):
+        return self.text, self.match_positions
+
+    def __setstate__(self, state):
+        text, match_positions = state
+        self.source = text
+        self.start = 0
+        self.end = len(text)
+        self.match_positions = match_positions
 
     def __match_parts(self):
         current_position = 0
@@ -84,10 +321,19 @@ class Match(object):
 
 
 class Matcher(object):
-    def __init__(self, to_match, ignore_case, use_regex):
+    """Finds a literal pattern or regular expression.
+
+    When fold is True accents and case are ignored, so café matches
+    cafe. The strings given can then be FoldedTexts, which saves
+    folding them for each search, the matches are of the original
+    text.
+    """
+
+    def __init__(self, to_match, ignore_case, use_regex, fold=False):
         self.to_match = to_match
         self.ignore_case = ignore_case
         self.use_regex = use_regex
+        self.fold = fold
 
         if not use_regex:
             self.__is_regex = False
@@ -98,11 +344,174 @@ class Matcher(object):
                                   if x in set('.^$*+?{}\\[]|()'))
 
         self.__pattern = self.__get_pattern()
+        self.__prefilters = self.__get_prefilters()
+
+    @property
+    def is_regex(self):
+        """Whether the pattern is matched as a regular expression."""
+
+        return self.__is_regex
+
+    @property
+    def required_literals(self):
+        """Returns the literal strings which every match contains.
+
+        These are longest first, for a literal pattern it is the pattern
+        and for a regular expression it might be empty.
+        """
+
+        if not self.__is_regex:
+            return (self.to_match,)
+
+        return self.__required_literals
+
+    @property
+    def utf8_literal(self):
+        """Returns UTF-8 bytes which every match contains, or None.
+
+        This is the pattern, or the longest required literal of a
+        regular expression, when it is matched case sensitively.
+        """
+
+        if self.__literals_ignore_case or not self.required_literals:
+            return None
+
+        return self.required_literals[0].encode('utf-8')
+
+    @property
+    def uses_signatures(self):
+        """Whether may_match_signature() can ever return False."""
+
+        # Folding, and re's rules for ignoring case, are not lower()
+        if self.fold or (self.__is_regex and self.__literals_ignore_case):
+            return False
+
+        return bool(self.required_literals)
+
+    def may_match_signature(self, text_signature):
+        """Returns False when the text with @text_signature, a
+        signature.Signature, can not contain a match."""
+
+        if not self.uses_signatures:
+            return True
+
+        for literal in self.required_literals:
+            if not text_signature.may_contain(literal):
+                return False
+
+        return True
+
+    def may_match_utf8(self, data):
+        """Returns False when the UTF-8 bytes @data can not contain
+        a match, utf8_literal must not be None."""
+
+        return self.utf8_literal in data
+
+    def count_utf8(self, data):
+        """Returns the number of matches in the UTF-8 bytes @data.
+
+        utf8_literal must not be None. A literal pattern is counted
+        in the bytes, since UTF-8 can only match at the start of a
+        character, and only data which might match is decoded.
+        """
+
+        literal = self.utf8_literal
+
+        if not self.__is_regex:
+            return data.count(literal)
+
+        if literal not in data:
+            return 0
+
+        return self.count(data.decode('utf-8'))
+
+    def __get_prefilters(self):
+        self.__required_literals = ()
+        self.__literals_ignore_case = self.ignore_case or self.fold
+
+        if not self.__is_regex:
+            return ()
+
+        literals = []
+
+        try:
+            parsed = sre_parse.parse(self.__pattern.pattern,
+                                     self.__pattern.flags)
+            changes_case = _required_literals(parsed, literals)
+
+        # Not worth failing for, the regex engine handles it
+        except Exception:
+            return ()
+
+        # The longest literal is the least likely to be found
+        literals = tuple(sorted(set(literals), key=len, reverse=True))
+        self.__required_literals = literals
+
+        # An inline flag could make only part of it case insensitive
+        if not changes_case and not self.__pattern.flags & re.IGNORECASE:
+            return literals
+
+        self.__literals_ignore_case = True
+
+        # Still much faster than the full regular expression
+        return tuple(re.compile(re.escape(literal),
+                                re.IGNORECASE | re.UNICODE)
+                     for literal in literals)
+
+    def __prepare(self, string):
+        # Returns the string to search and the FoldedText, if any
+        if isinstance(string, FoldedText):
+            if not self.fold:
+                return string.text, None
+
+            return string.folded, string
+
+        if not isinstance(string, basestring):
+            raise TypeError('\'basestring\' argument expected, got %r.' %
+                            (type(string).__name__))
+
+        if self.fold:
+            folded_text = FoldedText(string)
+            return folded_text.folded, folded_text
+
+        return string, None
+
+    def may_match(self, string):
+        """Returns False when @string can not contain a match.
+
+        For regular expressions this only checks that the required
+        literals are in @string, which is much faster than matching.
+        """
+
+        string, folded_text = self.__prepare(string)
+        return self.__may_match(string, folded_text is not None)
+
+    def __may_match(self, string, folded):
+        if not self.__is_regex:
+            if self.ignore_case and not folded:
+                string = string.lower()
+
+            return self.__pattern in string
+
+        if self.__literals_ignore_case:
+            for literal_re in self.__prefilters:
+                if literal_re.search(string) is None:
+                    return False
+
+        else:
+            for literal in self.__prefilters:
+                if literal not in string:
+                    return False
+
+        return True
 
     def __get_pattern(self):
         pattern = self.to_match
 
         if not self.__is_regex:
+            if self.fold:
+                return fold(pattern)
+
             if not self.ignore_case:
                 return pattern
 
@@ -112,24 +521,30 @@ class Matcher(object):
         # line by line so allow proper use of ^ and $
         flags = re.MULTILINE
 
-        if self.ignore_case:
+        if self.fold:
+            pattern = _fold_regex(pattern)
+            flags |= re.IGNORECASE | re.UNICODE
+
+        elif self.ignore_case:
             flags |= re.IGNORECASE
 
         return re.compile(pattern, flags)
 
     def count(self, string):
-        if not isinstance(string, basestring):
-            raise TypeError('\'basestring\' argument expected, got %r.' %
-                            (type(string).__name__))
+        string, folded_text = self.__prepare(string)
+        folded = folded_text is not None
 
         # Regular expressions are compiled to be case insensitive
-        if not self.__is_regex:
-            return string.count(self.__pattern)
+        if self.__is_regex:
+            if not self.__may_match(string, folded):
+                return 0
 
-        if self.ignore_case:
+            return len(self.__pattern.findall(string))
+
+        if self.ignore_case and not folded:
             string = string.lower()
 
-        return len(self.__pattern.findall(string))
+        return string.count(self.__pattern)
 
     def __str_context_match(self, string):
         start = 0
@@ -148,16 +563,52 @@ class Matcher(object):
         for match in self.__pattern.finditer(string):
             yield match.start(0), match.end(0)
 
-    def match(self, string):
-        if not isinstance(string, basestring):
-            raise TypeError('\'basestring\' argument expected, got %r.' %
-                            (type(string).__name__))
+    def __spans(self, string, folded):
+        if self.__is_regex:
+            if not self.__may_match(string, folded):
+                return iter(())
+
+            return self.__regex_context_match(string)
+
+        # Regular expressions are compiled to be case insensitive
+        if self.ignore_case and not folded:
+            string = string.lower()
+
+        return self.__str_context_match(string)
+
+    def spans(self, string):
+        """Yields the (start, end) of each match in @string.
+
+        For a FoldedText these are positions in its original text.
+        """
+
+        string, folded_text = self.__prepare(string)
+        spans = self.__spans(string, folded_text is not None)
 
+        if folded_text is None:
+            return spans
+
+        return (folded_text.original_span(start, end)
+                for start, end in spans)
+
+    def match(self, string, context_chars=None):
         # Must always keep orignal for matching with ignore case,
         # otherwise the returned paragraph matched would be all lower case
+        string, folded_text = self.__prepare(string)
+
+        if folded_text is not None:
+            # Paragraphs are found in the original text
+            spans = (folded_text.original_span(start, end)
+                     for start, end in self.__spans(string, True))
+            return context_matches(spans, folded_text.text,
+                                   context_chars=context_chars)
+
         orig_string = string
 
         if self.__is_regex:
+            if not self.__may_match(string, False):
+                return iter(())
+
             match_func = self.__regex_context_match
         else:
             # Regular expressions are compiled to be case insensitive
@@ -166,39 +617,85 @@ class Matcher(object):
 
             match_func = self.__str_context_match
 
-        match = None
-        start_para = 0
-        end_para = -1
+        return context_matches(match_func(string), string, orig_string,
+                               context_chars)
+
+
+def _snippet_start(string, start, context_chars):
+    # Returns the start of the paragraph, or of the context, of start
+    low = 0 if context_chars is None else max(0, start - context_chars)
+    start_para = string.rfind('\n', low, start) + 1
+
+    if start_para == 0:
+        start_para = low
+
+    while start_para < start and string[start_para].isspace():
+        start_para += 1
+
+    return start_para
 
-        for start, end in match_func(string):
-            if end <= end_para:
-                match[1].append((start - start_para, end - start_para))
-                continue
 
-            if match is not None:
-                yield Match(*match)
+def _snippet_end(string, end, context_chars):
+    # Returns the end of the paragraph, or of the context, of end
+    if context_chars is None:
+        high = len(string)
+
+        # Only end_para has this corner case, it is
+        # required for combining multiple matches at the end
+        end_para = string.find('\n', end, -1)
+
+    else:
+        high = min(len(string), end + context_chars)
+        end_para = string.find('\n', end, high)
+
+    if end_para == -1:
+        end_para = high
+
+    # Due to how slicing works we want to check
+    # the character prior to the current end_para
+    while end_para > end and string[end_para - 1].isspace():
+        end_para -= 1
+
+    return end_para
+
+
+def context_matches(spans, string, orig_string=None, context_chars=None):
+    """Yields a Match for each paragraph of @string with @spans.
+
+    @spans are the sorted and non-overlapping (start, end) of
+    the matches in @string. The text of the Match is taken from
+    @orig_string, if given, which must have the same offsets.
+
+    When @context_chars is given a Match is only the matches and
+    at most that many characters on either side within the paragraph,
+    this also bounds the search for the paragraph's ends.
+    """
+
+    if orig_string is None:
+        orig_string = string
 
-            start_para = string.rfind('\n', 0, start) + 1
-            end_para = string.find('\n', end, -1)
+    positions = None
+    start_para = 0
+    end_para = -1
 
-            # Only end_para has this corner case, it is
-            # required for combining multiple matches at the end
-            if end_para == -1:
-                end_para = len(string)
+    for start, end in spans:
+        if start < end_para:
+            # Matches can end after a paragraph or context
+            if end > end_para:
+                end_para = _snippet_end(string, end, context_chars)
 
-            while start_para < start and string[start_para].isspace():
-                start_para += 1
+            positions.append((start - start_para, end - start_para))
+            continue
 
-            # Due to how slicing works we want to check
-            # the character prior to the current end_para
-            while end_para > end and string[end_para - 1].isspace():
-                end_para -= 1
+        if positions is not None:
+            yield Match(orig_string, positions, start_para, end_para)
 
-            match = (orig_string[start_para:end_para],
-                     [(start - start_para, end - start_para)])
+        start_para = _snippet_start(string, start, context_chars)
+        end_para = _snippet_end(string, end, context_chars)
+        positions = [(start - start_para, end - start_para)]
 
-        # Make sure we yield the final match
-        if match is not None:
-            yield Match(*match)
+    # Make sure we yield the final match
+    if positions is not None:
+        yield Match(orig_string, positions, start_para, end_para)
 
 # ex:et:ts=4:
@@ -41,24 +41,35 @@ def _process_call(all_args):
     return func(*args)
 
 
-class Job(object):
-    # TODO: multiprocessing.freeze_support()
+def cpu_count():
+    """Returns the number of processes a Job uses at most."""
 
     try:
-        __CPU_COUNT = multiprocessing.cpu_count()
+        return multiprocessing.cpu_count()
 
     except NotImplementedError:
         # All recent processors have at least 2 cores
-        __CPU_COUNT = 2
+        return 2
+
+
+class Job(object):
+    # TODO: multiprocessing.freeze_support()
+
+    __CPU_COUNT = cpu_count()
 
     def __init__(self, func, iterable):
         if not hasattr(iterable, '__iter__'):
             iterable = list(iterable)
 
-        iterable = [(func, x) if hasattr(x, '__iter__') else (func, (x,))
-                    for x in iterable]
+        # A generator is fed to the processes as they need it
+        if hasattr(iterable, '__len__'):
+            n_processes = min(self.__CPU_COUNT, len(iterable))
+
+        else:
+            n_processes = self.__CPU_COUNT
 
-        n_processes = min(self.__CPU_COUNT, len(iterable))
+        iterable = ((func, x) if hasattr(x, '__iter__') else (func, (x,))
+                    for x in iterable)
 
         # Prevent "No child processes" exception
         while 1:
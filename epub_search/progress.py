@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Reporting the progress of a search."""
+
+from collections import namedtuple
+import time
+
+from epub_search import util
+
+
+_progress_fields = ('n_searched', 'n_paths', 'n_bytes', 'total_bytes',
+                    'n_matched', 'n_matches', 'n_errors', 'elapsed', 'eta',
+                    'finished')
+
+
+class Progress(namedtuple('Progress', _progress_fields)):
+    """How far a search has got.
+
+    n_searched: the number of ePubs searched so far
+    n_paths: the number of ePubs being searched
+    n_bytes: the size of the ePubs searched so far
+    total_bytes: the size of all of the ePubs
+    n_matched: the number of ePubs with a match
+    n_matches: the number of matches in all of the ePubs
+    n_errors: the number of ePubs which could not be parsed
+    elapsed: seconds since the search started
+    eta: estimated seconds until the search is done, or None
+    finished: whether this is the last Progress of the search
+    """
+
+
+class Reporter(object):
+    """Calls callback with a Progress at most rate times a second.
+
+    The first Progress, before anything was searched, and the
+    last, with finished set, are always given. The remaining
+    time is estimated from the bytes searched so far, or from
+    the number of ePubs when the sizes are not known.
+    """
+
+    def __init__(self, callback, paths, rate=10.0):
+        self.callback = callback
+        self.interval = 1.0 / rate if rate else 0.0
+
+        self.__sizes = dict((path, util.file_size(path)) for path in paths)
+        self.__n_paths = len(paths)
+        self.__total_bytes = sum(self.__sizes.values())
+
+        self.__n_searched = 0
+        self.__n_bytes = 0
+        self.__n_matched = 0
+        self.__n_matches = 0
+        self.__n_errors = 0
+
+        self.__start = time.time()
+        self.__last = None
+
+    def __eta(self, elapsed):
+        if self.__total_bytes > 0:
+            done = float(self.__n_bytes) / self.__total_bytes
+
+        else:
+            done = float(self.__n_searched) / max(1, self.__n_paths)
+
+        if done <= 0:
+            return None
+
+        return max(0.0, elapsed / done - elapsed)
+
+    def __report(self, now, finished=False):
+        self.__last = now
+        elapsed = now - self.__start
+
+        self.callback(Progress(self.__n_searched, self.__n_paths,
+                               self.__n_bytes, self.__total_bytes,
+                               self.__n_matched, self.__n_matches,
+                               self.__n_errors, elapsed,
+                               0.0 if finished else self.__eta(elapsed),
+                               finished))
+
+    def start(self):
+        self.__start = time.time()
+        self.__report(self.__start)
+
+    def update(self, result):
+        """Counts the search.SearchResult @result."""
+
+        self.__n_searched += 1
+        self.__n_bytes += self.__sizes.get(result.path, 0)
+
+        if result.error is not None:
+            self.__n_errors += 1
+
+        elif result.n_matches > 0:
+            self.__n_matched += 1
+            self.__n_matches += result.n_matches
+
+        now = time.time()
+        if self.__last is None or now - self.__last >= self.interval:
+            self.__report(now)
+
+    def finish(self):
+        self.__report(time.time(), True)
+
+    def report(self, results):
+        """Yields @results, counting each of them."""
+
+        self.start()
+
+        for result in results:
+            self.update(result)
+            yield result
+
+        self.finish()
+
+# ex:et:ts=4:
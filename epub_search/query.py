@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Boolean and proximity queries.
+
+A query is made up of words and "quoted phrases" combined with:
+
+    a AND b, or just a b    both must be in the ePub
+    a OR b                  either must be in the ePub
+    NOT a                   a must not be in the ePub
+    a NEAR/N b              a chapter has a and b at most N words apart
+    ( ... )                 grouping
+
+NOT binds tightest, then NEAR, AND and finally OR. Words and phrases
+are matched like a literal pattern, so whale also matches whales.
+"""
+
+from bisect import bisect_left, bisect_right
+import re
+
+from epub_search import matching
+
+
+_TOKEN_RE = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+', re.UNICODE)
+_NEAR_RE = re.compile(r'^NEAR/(\d+)$')
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class QueryError(Exception):
+    """The error raised for queries that can not be parsed."""
+
+
+class _Book(object):
+    """Caches what has been found in an ePub's chapters."""
+
+    __slots__ = ('texts', 'found', 'word_starts')
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.found = {}
+        self.word_starts = {}
+
+    def words_at(self, i, positions):
+        # Converts character positions in chapter i into word indices
+        starts = self.word_starts.get(i, None)
+        if starts is None:
+            starts = [match.start() for match in
+                      _WORD_RE.finditer(self.texts[i])]
+            self.word_starts[i] = starts
+
+        return [bisect_right(starts, position) for position in positions]
+
+
+class _Node(object):
+    __slots__ = ()
+
+    # Estimated cost of evaluating relative to a term
+    cost = 1.0
+
+
+class _Term(_Node):
+    __slots__ = ('text', 'matcher', 'n_evaluated', 'n_true', 'prior')
+
+    def __init__(self, text, ignore_case):
+        self.text = text
+        self.matcher = matching.Matcher(text, ignore_case, False)
+
+        self.n_evaluated = 0
+        self.n_true = 0
+
+        # Until it is known, longer terms are assumed to be rarer
+        self.prior = 1.0 / (1 + len(text)) ** 0.5
+
+    def probability(self):
+        # Blend in the observed rate as ePubs are evaluated
+        return (self.n_true + 2 * self.prior) / (self.n_evaluated + 2)
+
+    def positions(self, text):
+        return [start for start, end in self.matcher.spans(text)]
+
+    def record(self, book, found):
+        # Whether the term is in the ePub, once it is known
+        if self not in book.found:
+            book.found[self] = found
+
+            self.n_evaluated += 1
+            self.n_true += found
+
+    def evaluate(self, book):
+        found = book.found.get(self, None)
+
+        if found is None:
+            found = False
+
+            for text in book.texts:
+                if self.matcher.may_match(text):
+                    found = True
+                    break
+
+            self.record(book, found)
+
+        return found
+
+    def parts(self, negated=False):
+        yield self, negated
+
+
+class _Not(_Node):
+    __slots__ = ('child',)
+
+    def __init__(self, child):
+        self.child = child
+
+    @property
+    def cost(self):
+        return self.child.cost
+
+    def probability(self):
+        return 1.0 - self.child.probability()
+
+    def evaluate(self, book):
+        return not self.child.evaluate(book)
+
+    def parts(self, negated=False):
+        return self.child.parts(not negated)
+
+
+class _And(_Node):
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = children
+
+    @property
+    def cost(self):
+        return sum(child.cost for child in self.children)
+
+    def probability(self):
+        probability = 1.0
+        for child in self.children:
+            probability *= child.probability()
+
+        return probability
+
+    def evaluate(self, book):
+        # Cheapest and least likely first, the first false decides
+        order = sorted(self.children,
+                       key=lambda x: x.cost * x.probability())
+
+        for child in order:
+            if not child.evaluate(book):
+                return False
+
+        return True
+
+    def parts(self, negated=False):
+        for child in self.children:
+            for part in child.parts(negated):
+                yield part
+
+
+class _Or(_And):
+    __slots__ = ()
+
+    def probability(self):
+        probability = 1.0
+        for child in self.children:
+            probability *= 1.0 - child.probability()
+
+        return 1.0 - probability
+
+    def evaluate(self, book):
+        # Cheapest and most likely first, the first true decides
+        order = sorted(self.children,
+                       key=lambda x: x.cost * (1.0 - x.probability()))
+
+        for child in order:
+            if child.evaluate(book):
+                return True
+
+        return False
+
+
+class _Near(_Node):
+    __slots__ = ('left', 'right', 'distance')
+
+    # Requires positions, not just finding the terms
+    cost = 4.0
+
+    def __init__(self, left, right, distance):
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def probability(self):
+        return min(self.left.probability(), self.right.probability()) / 2
+
+    def evaluate(self, book):
+        # Already known not to be in the ePub
+        if book.found.get(self.left, None) is False or \
+           book.found.get(self.right, None) is False:
+            return False
+
+        # A single pass over the chapters, the right term
+        # is only looked for in those with the left term
+        left_found = False
+        right_found = False
+
+        for i, text in enumerate(book.texts):
+            left = self.left.positions(text)
+            if not left:
+                continue
+
+            left_found = True
+
+            right = self.right.positions(text)
+            if not right:
+                continue
+
+            right_found = True
+
+            left = book.words_at(i, left)
+            right = book.words_at(i, right)
+
+            # Both are sorted, so walk them together
+            j = 0
+            for word in left:
+                while j < len(right) and right[j] < word - self.distance:
+                    j += 1
+
+                if j < len(right) and right[j] <= word + self.distance:
+                    self.left.record(book, True)
+                    self.right.record(book, True)
+                    return True
+
+        # The right term was only looked for where the left one is
+        self.left.record(book, left_found)
+        if right_found:
+            self.right.record(book, True)
+
+        return False
+
+    def spans(self, text, word_starts):
+        """Returns the spans of the terms in @text which are near
+        each other, @word_starts are the starts of its words."""
+
+        left = list(self.left.matcher.spans(text))
+        if not left:
+            return []
+
+        right = list(self.right.matcher.spans(text))
+        if not right:
+            return []
+
+        def near(spans, other_spans):
+            other_words = [bisect_right(word_starts, start)
+                           for start, end in other_spans]
+
+            for start, end in spans:
+                word = bisect_right(word_starts, start)
+                j = bisect_left(other_words, word - self.distance)
+
+                if j < len(other_words) and \
+                   other_words[j] <= word + self.distance:
+                    yield start, end
+
+        return list(near(left, right)) + list(near(right, left))
+
+    def parts(self, negated=False):
+        yield self, negated
+
+
+class _Parser(object):
+    def __init__(self, query, ignore_case):
+        self.query = query
+        self.tokens = _TOKEN_RE.findall(query)
+        self.position = 0
+        self.ignore_case = ignore_case
+
+    def peek(self):
+        if self.position >= len(self.tokens):
+            return None
+
+        return self.tokens[self.position]
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+
+        return token
+
+    def parse(self):
+        # Tokens are only found in what is left of an unterminated phrase
+        if self.query.count('"') % 2:
+            raise QueryError('Missing closing "')
+
+        if not self.tokens:
+            raise QueryError('Empty query')
+
+        node = self.parse_or()
+
+        if self.peek() is not None:
+            raise QueryError('Unexpected %r' % (self.peek()))
+
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_and())
+
+        return children[0] if len(children) == 1 else _Or(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+
+        while self.peek() not in (None, 'OR', ')'):
+            # AND is optional
+            if self.peek() == 'AND':
+                self.next()
+
+            children.append(self.parse_not())
+
+        return children[0] if len(children) == 1 else _And(children)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.next()
+            return _Not(self.parse_not())
+
+        return self.parse_near()
+
+    def parse_near(self):
+        node = self.parse_atom()
+
+        while self.peek() is not None and _NEAR_RE.match(self.peek()):
+            distance = int(_NEAR_RE.match(self.next()).group(1))
+            right = self.parse_atom()
+
+            if not isinstance(node, _Term) or not isinstance(right, _Term):
+                raise QueryError('NEAR requires a word or phrase '
+                                 'on each side')
+
+            node = _Near(node, right, distance)
+
+        return node
+
+    def parse_atom(self):
+        token = self.next()
+
+        if token is None:
+            raise QueryError('Unexpected end of query')
+
+        if token == '(':
+            node = self.parse_or()
+
+            if self.next() != ')':
+                raise QueryError('Missing )')
+
+            return node
+
+        if token == ')' or token in ('AND', 'OR') or _NEAR_RE.match(token):
+            raise QueryError('Unexpected %r' % (token))
+
+        if token.startswith('"'):
+            token = token[1:-1].strip()
+            if not token:
+                raise QueryError('Empty phrase')
+
+        return _Term(token, self.ignore_case)
+
+
+class Query(object):
+    """A compiled boolean query.
+
+    The query is decided for a whole ePub by accepts(), evaluating
+    the terms most likely to decide it first and stopping as soon as
+    the outcome is known. count() and match() then behave like a
+    Matcher for all of the terms that are not negated, those of a
+    NEAR only where they are near each other. An accepted ePub
+    without any of those, such as for NOT whale, is counted by
+    search._match_contents() as a single match.
+    """
+
+    def __init__(self, to_match, ignore_case):
+        self.to_match = to_match
+        self.ignore_case = ignore_case
+
+        # For the same keys in a cache.ResultCache as a Matcher
+        self.use_regex = False
+
+        self.__root = _Parser(to_match, ignore_case).parse()
+
+        positive = []
+        self.__nears = []
+
+        for part, negated in self.__root.parts():
+            if negated:
+                continue
+
+            if isinstance(part, _Near):
+                self.__nears.append(part)
+
+            elif part.text not in positive:
+                positive.append(part.text)
+
+        if not positive:
+            # Only NOTs or NEARs, which are found with __spans()
+            self.__highlighter = None
+
+        else:
+            pattern = '|'.join(re.escape(text) for text in positive)
+            if len(positive) == 1:
+                pattern = positive[0]
+
+            self.__highlighter = matching.Matcher(pattern, ignore_case,
+                                                  len(positive) > 1)
+
+    @property
+    def is_regex(self):
+        # Chapters must always be matched separately
+        return True
+
+    @property
+    def required_literals(self):
+        return ()
+
+    @property
+    def utf8_literal(self):
+        return None
+
+    @property
+    def uses_signatures(self):
+        return False
+
+    def may_match(self, string):
+        return True
+
+    def may_match_signature(self, text_signature):
+        # NOT needs every chapter
+        return True
+
+    def accepts(self, texts):
+        """Returns whether the ePub with the chapter @texts matches."""
+
+        return self.__root.evaluate(_Book(texts))
+
+    def __spans(self, string):
+        # The sorted and non-overlapping spans of the terms and NEARs
+        spans = set()
+
+        if self.__highlighter is not None:
+            spans.update(self.__highlighter.spans(string))
+
+        if self.__nears:
+            word_starts = [match.start() for match in
+                           _WORD_RE.finditer(string)]
+
+            for near in self.__nears:
+                spans.update(near.spans(string, word_starts))
+
+        merged = []
+        for start, end in sorted(spans):
+            if not merged or start >= merged[-1][1]:
+                merged.append((start, end))
+
+        return merged
+
+    def count(self, string):
+        if not self.__nears:
+            if self.__highlighter is None:
+                return 0
+
+            return self.__highlighter.count(string)
+
+        return len(self.__spans(string))
+
+    def match(self, string, context_chars=None):
+        if not self.__nears:
+            if self.__highlighter is None:
+                return iter(())
+
+            return self.__highlighter.match(string, context_chars)
+
+        return matching.context_matches(self.__spans(string), string,
+                                        context_chars=context_chars)
+
+# ex:et:ts=4:
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Ranking ePubs with BM25."""
+
+from bisect import bisect_left
+from collections import namedtuple
+import heapq
+import math
+
+from epub_search import multiprocess
+from epub_search import stats
+from epub_search.corpus import _extract_book
+from epub_search.search import SearchResult
+
+
+RankedResult = namedtuple('RankedResult', ('path', 'title', 'author',
+                                           'score'))
+
+
+class _Scorer(object):
+    """Computes the BM25 score of the query terms in an ePub.
+
+    Terms found in the title or author add the term's idf
+    times title_boost or author_boost to the score.
+    """
+
+    def __init__(self, n_books, avg_length, k1, b,
+                 title_boost, author_boost):
+        self.n_books = n_books
+        self.avg_length = avg_length or 1.0
+        self.k1 = k1
+        self.b = b
+        self.title_boost = title_boost
+        self.author_boost = author_boost
+
+    def idf(self, df):
+        return math.log(1.0 + (self.n_books - df + 0.5) / (df + 0.5))
+
+    def upper_bound(self, idf):
+        # The term frequency part tends to k1 + 1
+        return idf * (self.k1 + 1 + self.title_boost + self.author_boost)
+
+    def score(self, idf, tf, length, in_title, in_author):
+        norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+        score = tf * (self.k1 + 1) / (tf + norm) if tf else 0.0
+
+        if in_title:
+            score += self.title_boost
+
+        if in_author:
+            score += self.author_boost
+
+        return idf * score
+
+
+def query_terms(query):
+    """Returns the unique words of @query in order."""
+
+    terms = []
+    for term in stats.tokenize(query):
+        if term not in terms:
+            terms.append(term)
+
+    return terms
+
+
+def _metadata_terms(value):
+    if value is None:
+        return frozenset()
+
+    return frozenset(stats.tokenize(value))
+
+
+def _count_query_terms(path, terms, text_cache):
+    extracted = _extract_book(path, text_cache)
+    if isinstance(extracted, SearchResult):
+        return path, extracted.error
+
+    title, author, warnings, labels, texts = extracted
+    wanted = dict((term, i) for i, term in enumerate(terms))
+
+    length = 0
+    tfs = [0] * len(terms)
+
+    for text in texts:
+        words = stats.tokenize(text)
+        length += len(words)
+
+        for word in words:
+            i = wanted.get(word, None)
+            if i is not None:
+                tfs[i] += 1
+
+    return path, (title, author, length, tfs)
+
+
+def rank(paths, query, k=20, sync=None, text_cache=None,
+         title_boost=0.0, author_boost=0.0, k1=1.2, b=0.75):
+    """Returns the @k best RankedResults for @query and a list of errors.
+
+    Every ePub is scanned once since the document frequencies of
+    the terms are required, only the best @k are kept while scoring.
+    """
+
+    paths = tuple(paths)
+    terms = query_terms(query)
+    searches = [(path, terms, text_cache) for path in paths]
+
+    # Same rules as search.search()
+    if sync or (sync is None and len(paths) <= 1):
+        counted = [_count_query_terms(*x) for x in searches]
+
+    else:
+        counted = list(multiprocess.Job(_count_query_terms, searches))
+
+        # As they finish, ties must not depend on that
+        order = dict((path, i) for i, path in enumerate(paths))
+        counted.sort(key=lambda x: order[x[0]])
+
+    errors = [book for path, book in counted if not isinstance(book, tuple)]
+    books = [(path, book) for path, book in counted
+             if isinstance(book, tuple)]
+
+    if not books or not terms:
+        return [], errors
+
+    avg_length = float(sum(book[2] for path, book in books)) / len(books)
+    scorer = _Scorer(len(books), avg_length, k1, b, title_boost, author_boost)
+
+    idfs = [scorer.idf(sum(1 for path, book in books if book[3][i] > 0))
+            for i in range(len(terms))]
+
+    heap = []
+    for order, (path, (title, author, length, tfs)) in enumerate(books):
+        title_terms = _metadata_terms(title)
+        author_terms = _metadata_terms(author)
+
+        score = sum(scorer.score(idfs[i], tfs[i], length,
+                                 terms[i] in title_terms,
+                                 terms[i] in author_terms)
+                    for i in range(len(terms)))
+        if score <= 0:
+            continue
+
+        # The order breaks ties, keeping the first given paths
+        entry = (score, -order, RankedResult(path, title, author, score))
+
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    return [entry[2] for entry in sorted(heap, reverse=True)], errors
+
+
+def _book_row_starts(matrix):
+    # Rows of an ePub are contiguous, so ePub i is
+    # made up of rows starts[i] until starts[i + 1]
+    starts = [0] * (len(matrix.books) + 1)
+    starts[-1] = matrix.n_rows
+
+    previous = -1
+    for row, book in enumerate(matrix.row_books):
+        if book != previous:
+            starts[book] = row
+            previous = book
+
+    return starts
+
+
+def rank_index(matrix, query, k=20, title_boost=0.0, author_boost=0.0,
+               k1=1.2, b=0.75):
+    """Returns the @k best RankedResults for @query using @matrix.
+
+    @matrix is a stats.TermMatrix. Terms are processed from the most
+    to the least selective. Once no ePub that has not been seen yet
+    could reach the best @k, the remaining terms' postings are no
+    longer scanned, only looked up for the ePubs that still can.
+    """
+
+    terms = query_terms(query)
+    n_books = len(matrix.books)
+
+    if n_books == 0 or not terms:
+        return []
+
+    lengths = matrix.book_lengths
+    row_books = matrix.row_books
+    row_starts = _book_row_starts(matrix)
+
+    scorer = _Scorer(n_books, float(sum(lengths)) / n_books, k1, b,
+                     title_boost, author_boost)
+
+    metadata_books = {}
+    if title_boost or author_boost:
+        for i, (path, title, author) in enumerate(matrix.books):
+            for term in _metadata_terms(title) | _metadata_terms(author):
+                metadata_books.setdefault(term, []).append(i)
+
+    plans = []
+    for term in terms:
+        # The number of ePubs, rows might be chapters
+        df = matrix.book_df(term)
+        if df == 0 and term not in metadata_books:
+            continue
+
+        idf = scorer.idf(df)
+        plans.append((scorer.upper_bound(idf), idf, term))
+
+    # Most selective, and so with the highest bound, first
+    plans.sort(key=lambda x: x[0], reverse=True)
+
+    def book_score(idf, term, rows, counts, book):
+        lo = bisect_left(rows, row_starts[book])
+        hi = bisect_left(rows, row_starts[book + 1], lo)
+        tf = sum(counts[lo:hi])
+
+        title, author = matrix.books[book][1:]
+        return scorer.score(idf, tf, lengths[book],
+                            title_boost and term in _metadata_terms(title),
+                            author_boost and term in _metadata_terms(author))
+
+    scores = {}
+    remaining = sum(plan[0] for plan in plans)
+
+    for upper_bound, idf, term in plans:
+        remaining -= upper_bound
+
+        threshold = 0.0
+        if len(scores) >= k:
+            threshold = heapq.nlargest(k, scores.values())[-1]
+
+        rows, counts = matrix.column(term)
+
+        if len(scores) < k or upper_bound + remaining > threshold:
+            # New ePubs could still make it, scan all of the postings
+            candidates = set(row_books[row] for row in rows)
+            candidates.update(metadata_books.get(term, ()))
+
+        else:
+            # Drop those which can no longer reach the best k
+            candidates = [book for book, score in scores.items()
+                          if score + upper_bound + remaining > threshold
+                          or score >= threshold]
+
+            scores = dict((book, scores[book]) for book in candidates)
+
+        for book in candidates:
+            scores[book] = scores.get(book, 0.0) + \
+                           book_score(idf, term, rows, counts, book)
+
+    best = heapq.nlargest(k, scores.items(), key=lambda x: (x[1], -x[0]))
+
+    return [RankedResult(*(matrix.books[book] + (score,)))
+            for book, score in best if score > 0]
+
+# ex:et:ts=4:
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Searches which can be continued later.
+
+search_page() returns the results a page at a time with a cursor
+for the next page, which is a string that can be handed to a client
+and back. A Checkpoint keeps the results of an interrupted search
+in a file so that running it again only searches the remaining
+ePubs. Both are tied to the search's arguments and to the version
+of the ePubs, util.fingerprint(), so neither is used after the
+ePubs change.
+"""
+
+import base64
+from collections import namedtuple
+import json
+import os
+import zlib
+
+try:
+    import cPickle as pickle
+
+except ImportError:
+    import pickle # Python 3
+
+from epub_search import cache
+from epub_search import search
+from epub_search import util
+
+
+_CURSOR_VERSION = 2
+
+
+Page = namedtuple('Page', ('results', 'errors', 'cursor'))
+
+
+class CursorError(Exception):
+    """The error raised for cursors which can not be continued from."""
+
+
+def _key(paths, matcher, with_context, context_chars, max_snippets):
+    # Any change to the ePubs changes the key
+    return cache.ResultCache.key(matcher, with_context,
+                                 util.fingerprint(paths), context_chars,
+                                 max_snippets)
+
+
+def _encode_cursor(key, scanned, pending, done):
+    data = json.dumps([_CURSOR_VERSION, key, scanned, pending, done])
+    data = zlib.compress(data.encode('utf-8'))
+
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _decode_cursor(cursor, key):
+    try:
+        data = zlib.decompress(base64.urlsafe_b64decode(str(cursor)))
+        version, cursor_key, scanned, pending, done = \
+            json.loads(data.decode('utf-8'))
+
+    except Exception:
+        raise CursorError('Corrupt cursor')
+
+    if version != _CURSOR_VERSION or cursor_key != key:
+        raise CursorError('The cursor is for another search or the '
+                          'ePubs have changed')
+
+    return scanned, pending, done
+
+
+def search_page(paths, matcher, with_context, limit=20, cursor=None,
+                sync=None, text_cache=None, context_chars=None,
+                max_snippets=None, parse_cache=None):
+    """Returns a Page with the next @limit ePubs which match.
+
+    The results are in the order of @paths, which must be unique, and
+    the Page's cursor continues after them. It is None once every ePub
+    has been searched. The remaining ePubs are searched together and
+    the search is stopped once the page is full. The ePubs which were
+    searched past the end of the page are kept in the cursor and those
+    which did not match are not searched again, but those which
+    matched are, as their results can be too large for the cursor.
+    errors are the SearchResults of the ePubs which could not be
+    parsed, including those past the end of the page.
+
+    The other arguments are as for search.search() and must be the
+    same for each page. Raises CursorError when @cursor is not for
+    this search or the ePubs changed since.
+    """
+
+    paths = tuple(paths)
+    key = _key(paths, matcher, with_context, context_chars, max_snippets)
+
+    if cursor is None:
+        scanned = 0
+        pending = []
+        done = []
+
+    else:
+        scanned, pending, done = _decode_cursor(cursor, key)
+
+    # The ePubs known to match come before those not searched yet
+    skipped = set(done)
+    order = pending + [i for i in range(scanned, len(paths))
+                       if i not in skipped]
+    positions = dict((paths[i], n) for n, i in enumerate(order))
+
+    results = []
+    errors = []
+
+    # The results past the next position of order, by their position
+    found = {}
+    position = 0
+
+    searched = search.search([paths[i] for i in order], matcher,
+                             with_context, sync, text_cache=text_cache,
+                             context_chars=context_chars,
+                             max_snippets=max_snippets,
+                             parse_cache=parse_cache)
+
+    try:
+        for result in searched:
+            found[positions[result.path]] = result
+
+            while position in found and len(results) < limit:
+                result = found.pop(position)
+                position += 1
+
+                if result.error is not None:
+                    errors.append(result)
+
+                elif result.n_matches > 0:
+                    results.append(result)
+
+            if len(results) >= limit:
+                break
+
+    finally:
+        # Stops the processes
+        if hasattr(searched, 'close'):
+            searched.close()
+
+    if position > 0:
+        scanned = max(scanned, order[position - 1] + 1)
+
+    kept_pending = set(pending)
+    pending = []
+    done = [i for i in done if i >= scanned]
+
+    for n in range(position, len(order)):
+        i = order[n]
+        result = found.get(n, None)
+
+        if result is None:
+            if i in kept_pending:
+                pending.append(i)
+
+        elif result.error is not None:
+            errors.append(result)
+            done.append(i)
+
+        elif result.n_matches > 0:
+            pending.append(i)
+
+        else:
+            done.append(i)
+
+    if not pending and scanned + len(done) >= len(paths):
+        return Page(results, errors, None)
+
+    return Page(results, errors,
+                _encode_cursor(key, scanned, pending, sorted(done)))
+
+
+class Checkpoint(object):
+    """The results of a search so far, kept in a file to resume it.
+
+    When the file at path is for the same search of the same ePubs its
+    results are loaded, remaining() are the paths which still have to
+    be searched. save() is meant for when the search is interrupted,
+    remove() for when it is done.
+    """
+
+    def __init__(self, path, paths, matcher, with_context,
+                 context_chars=None, max_snippets=None):
+        self.path = path
+
+        self.__key = _key(tuple(paths), matcher, with_context,
+                          context_chars, max_snippets)
+        self.__results = []
+
+        try:
+            with open(path, 'rb') as checkpoint_file:
+                if pickle.load(checkpoint_file) == self.__key:
+                    self.__results = list(pickle.load(checkpoint_file))
+
+        # Missing, for another search or corrupt and will be overwritten
+        except Exception:
+            pass
+
+    @property
+    def results(self):
+        return tuple(self.__results)
+
+    def remaining(self, paths):
+        """Returns those of @paths without a result."""
+
+        done = set(result.path for result in self.__results)
+
+        return tuple(path for path in paths if path not in done)
+
+    def add(self, result):
+        self.__results.append(result)
+
+    def save(self):
+        data = pickle.dumps(self.__key, pickle.HIGHEST_PROTOCOL) + \
+            pickle.dumps(tuple(self.__results), pickle.HIGHEST_PROTOCOL)
+
+        cache._write_atomic(os.path.abspath(self.path), data)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+
+        except OSError:
+            pass
+
+# ex:et:ts=4:
@@ -17,17 +17,48 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import threading
 
+from epub_search import bundle
 from epub_search import epub
+from epub_search import matching
 from epub_search import multiprocess
+from epub_search import query
+from epub_search import tag_stripper
+from epub_search import util
+from epub_search.cache import ResultCache
+from epub_search.progress import Reporter
 
 
 LabelMatches = namedtuple('LabelMatches', ('label', 'matches'))
 
 
+# A single ePub at least this large is split across the processes
+_SPLIT_SIZE = 4 * 1024 * 1024
+
+# Each process gets about this many parts of the ePub
+_PARTS_PER_PROCESS = 4
+
+# At most about this much of a tar bundle is read ahead of the processes
+_BUNDLE_BATCH_SIZE = 64 * 1024 * 1024
+
+# The results of this many chapters are kept in each process
+_CHAPTER_MEMO_SIZE = 1024
+
+# Only chapters of at least this many characters are worth hashing
+_MIN_MEMO_SIZE = 4096
+
+# The results of chapters by their matcher and text, so that those
+# repeated across ePubs, as in omnibus editions, are matched once
+_chapter_memo = OrderedDict()
+
+
 _search_result_fields = ('path', 'title', 'author',
-                         'n_matches', 'matches', 'error', 'warnings')
+                         'n_matches', 'matches', 'error', 'warnings',
+                         'duplicates')
 
 
 class SearchResult(namedtuple('SearchResult', _search_result_fields)):
@@ -43,73 +74,747 @@ class SearchResult(namedtuple('SearchResult', _search_result_fields)):
     matches: matches or None
     error: error message if parsing failed
     warnings: warnings gernerated while parsing the ePub
+    duplicates: paths of ePubs with the same content or None
     """
 
     # namedtuple requires all fields
     def __new__(cls, path, title=None, author=None, n_matches=0, matches=None,
-                error=None, warnings=None):
+                error=None, warnings=None, duplicates=None):
         return super(SearchResult, cls).__new__(cls, path, title, author,
                                                 n_matches, matches,
-                                                error, warnings)
+                                                error, warnings, duplicates)
+
+
+def _is_utf8(text):
+    # Text from epub.Epub(utf8=True), Python 2's str is the same
+    return isinstance(text, bytes) and not isinstance(text, str)
+
+
+def _count(matcher, text):
+    if _is_utf8(text):
+        return matcher.count_utf8(text)
+
+    return matcher.count(text)
+
+
+def _match(matcher, text, context_chars):
+    # Only text which might match is decoded
+    if _is_utf8(text):
+        if not matcher.may_match_utf8(text):
+            return []
+
+        text = text.decode('utf-8')
+
+    return list(matcher.match(text, context_chars))
+
+
+def _memo_key(matcher, with_context, context_chars):
+    # Chapters which the matcher can count as UTF-8
+    # bytes are counted faster than they are hashed
+    if matcher.utf8_literal is not None:
+        return None
+
+    return ResultCache.key(matcher, with_context, None, context_chars)
+
+
+def _memoized(memo_key, text, func):
+    # Returns func(text) from _chapter_memo when it has it
+    if memo_key is None or isinstance(text, matching.FoldedText) or \
+       len(text) < _MIN_MEMO_SIZE:
+        return func(text)
+
+    data = text if _is_utf8(text) else text.encode('utf-8')
+    key = (memo_key, hashlib.sha1(data).digest())
+
+    value = _chapter_memo.pop(key, None)
+    if value is None:
+        value = func(text)
+
+    _chapter_memo[key] = value
+
+    while len(_chapter_memo) > _CHAPTER_MEMO_SIZE:
+        # Evict the least recently used
+        _chapter_memo.popitem(last=False)
+
+    return value
+
+
+def _utf8(matcher):
+    # Whether the text can be searched as UTF-8 bytes
+    return bool(matcher.utf8_literal)
+
+
+def _match_contents(contents, matcher, with_context, context_chars=None,
+                    max_snippets=None):
+    """Returns (n_matches, matches) for the (label, text) pairs in @contents.
+
+    matches is None when @with_context is False. With @context_chars
+    each match only has that many characters of context on either
+    side, once there are @max_snippets the rest are only counted.
+    The text can be UTF-8 bytes when _utf8() is True for @matcher.
+    """
+
+    n_matches = 0
+    matches = [] if with_context else None
+
+    # Repeated chapters are the same string, see epub.Epub.contents,
+    # and are matched once. The text is kept so its id is not reused.
+    # Those repeated in other ePubs are found by _memoized().
+    seen = {}
+    count_key = _memo_key(matcher, False, None)
+    match_key = _memo_key(matcher, True, context_chars)
+
+    def count_text(text):
+        return _count(matcher, text)
+
+    def match_text(text):
+        return _match(matcher, text, context_chars)
+
+    # Boolean queries are decided for the whole ePub first
+    if isinstance(matcher, query.Query):
+        contents = list(contents)
+
+        if not matcher.accepts([text for label, text in contents
+                                if text is not None]):
+            return n_matches, () if with_context else None
+
+    if not with_context:
+        for label, text in contents:
+            # Text is None when stripping the tags failed
+            if text is None:
+                continue
+
+            if id(text) not in seen:
+                seen[id(text)] = (text, _memoized(count_key, text,
+                                                  count_text))
+
+            n_matches += seen[id(text)][1]
+
+    else:
+        n_snippets = 0
+
+        for label, text in contents:
+            if text is None:
+                continue
+
+            if max_snippets is not None and n_snippets >= max_snippets:
+                if id(text) not in seen:
+                    seen[id(text)] = (text, _memoized(count_key, text,
+                                                      count_text))
+
+                n_matches += seen[id(text)][1]
+                continue
+
+            if id(text) not in seen:
+                found = _memoized(match_key, text, match_text)
+                seen[id(text)] = (text, sum(len(x) for x in found), found)
+
+            else:
+                found = seen[id(text)][2]
+
+            label_matches = []
 
+            for match in found:
+                n_matches += len(match)
+
+                if max_snippets is None or n_snippets < max_snippets:
+                    n_snippets += 1
+                    label_matches.append(match)
+
+            if label_matches:
+                # Prevent modification
+                label_matches = tuple(label_matches)
+                matches.append(LabelMatches(label=label,
+                                            matches=label_matches))
+
+        # Prevent modification
+        matches = tuple(matches)
+
+    # Accepted without any terms to count, such as NOT whale
+    if n_matches == 0 and isinstance(matcher, query.Query):
+        n_matches = 1
+
+    return n_matches, matches
+
+
+def _search_cached(cached_book, matcher, with_context, text_cache=None,
+                   context_chars=None, max_snippets=None, which=None):
+    # @which are the indices of the chapters that might match
+    if getattr(matcher, 'fold', False) and text_cache is not None:
+        contents = text_cache.folded_chapters(cached_book)
+
+    else:
+        contents = cached_book.chapters(which)
+
+    n_matches, matches = _match_contents(contents, matcher, with_context,
+                                         context_chars, max_snippets)
+
+    return SearchResult(path=cached_book.path, title=cached_book.title,
+                        author=cached_book.author, n_matches=n_matches,
+                        matches=matches, warnings=cached_book.warnings)
+
+
+def _fold_contents(contents):
+    # Folds each chapter once, repeated chapters stay the same object
+    folded = {}
+
+    for label, text in contents:
+        if text is not None and id(text) not in folded:
+            folded[id(text)] = matching.FoldedText(text)
+
+        yield label, None if text is None else folded[id(text)]
+
+
+def _search_cached_many(cached_book, queries, text_cache, whiches):
+    # Decompresses the chapters that might match any of @queries once
+    needed = None
+    if None not in whiches:
+        needed = set().union(*whiches)
+
+    indices = sorted(needed) if needed is not None else \
+        range(len(cached_book.labels))
+    chapters = dict(zip(indices, cached_book.chapters(needed)))
+
+    folded = None
+    results = []
+
+    for (matcher, with_context, context_chars, max_snippets), which in \
+        zip(queries, whiches):
+        if getattr(matcher, 'fold', False):
+            if folded is None:
+                folded = list(text_cache.folded_chapters(cached_book))
+
+            contents = folded
+
+        else:
+            contents = [chapters[i] for i in sorted(chapters)
+                        if which is None or i in which]
+
+        n_matches, matches = _match_contents(contents, matcher, with_context,
+                                             context_chars, max_snippets)
+
+        results.append(SearchResult(path=cached_book.path,
+                                    title=cached_book.title,
+                                    author=cached_book.author,
+                                    n_matches=n_matches, matches=matches,
+                                    warnings=cached_book.warnings))
+
+    return results
+
+
+def _search_epub_many(path, queries, text_cache=None, parse_cache=None,
+                      data=None):
+    # Searches the ePub at @path with each of @queries, which are
+    # (matcher, with_context, context_chars, max_snippets), and
+    # returns their SearchResults. The ePub is only parsed once.
+    matchers = [matcher for matcher, with_context, context_chars,
+                max_snippets in queries]
+
+    # A single search streams the chapters instead of keeping them
+    shared = len(queries) > 1
+
+    if text_cache is not None and not isinstance(path, epub.Epub):
+        whiches = [None] * len(queries)
+
+        # Chapters that can not match are not even loaded, the text is
+        # loaded when the signatures have to be made and is kept
+        signed_book = None
+        cached_book = None
+
+        if any(matcher.uses_signatures for matcher in matchers):
+            signed_book, cached_book = text_cache.signatures(path, True)
+
+        if signed_book is not None:
+            whiches = [set(i for i, text_signature in
+                           enumerate(signed_book.signatures)
+                           if matcher.may_match_signature(text_signature))
+                       for matcher in matchers]
+
+            if not any(whiches):
+                return [SearchResult(path=path, title=signed_book.title,
+                                     author=signed_book.author,
+                                     matches=() if with_context else None,
+                                     warnings=signed_book.warnings)
+                        for matcher, with_context, context_chars,
+                        max_snippets in queries]
+
+        if cached_book is None:
+            cached_book = text_cache.get(path)
+
+        if cached_book is not None:
+            if shared:
+                return _search_cached_many(cached_book, queries, text_cache,
+                                           whiches)
+
+            matcher, with_context, context_chars, max_snippets = queries[0]
+            return [_search_cached(cached_book, matcher, with_context,
+                                   text_cache, context_chars, max_snippets,
+                                   whiches[0])]
+
+    tag_strategy = None
+    strategy_stats = None
 
-def _search_epub(path, matcher, with_context):
     if isinstance(path, epub.Epub):
         epub_file = path
         path = epub_file.path
 
+        # Only ePubs opened here are recorded
+        parse_cache = None
+
     else:
+        if parse_cache is not None:
+            record = parse_cache.get(path)
+
+            if record is not None:
+                # Known to be broken, do not parse it again
+                if record.error is not None:
+                    return [SearchResult(path=path, error=record.error)
+                            for x in queries]
+
+                tag_strategy = record.tag_strategy
+
+            fingerprint = util.file_fingerprint(path)
+            strategy_stats = parse_cache.strategy_stats
+
         try:
-            epub_file = epub.Epub(path)
+            # The labels are only shown with the context and
+            # the text is only UTF-8 when every matcher can use it
+            epub_file = epub.Epub(path, tag_strategy,
+                                  labels=any(x[1] for x in queries),
+                                  data=data,
+                                  utf8=all(_utf8(x) for x in matchers),
+                                  strategy_stats=strategy_stats)
 
         except epub.BadEpubError as e:
+            if parse_cache is not None:
+                parse_cache.put(path, fingerprint, error=str(e))
+
             # For bad ePubs, return a SearchResult with the error set
-            return SearchResult(path=path, error=str(e))
+            return [SearchResult(path=path, error=str(e)) for x in queries]
 
     with epub_file:
-        n_matches = 0
-        matches = [] if with_context else None
+        contents = ((content.label, content.text)
+                    for content in epub_file.contents)
+
+        folded = None
+        if shared:
+            contents = list(contents)
+
+            # Folded once for all of the matchers which fold
+            if sum(1 for x in matchers if getattr(x, 'fold', False)) > 1:
+                folded = list(_fold_contents(contents))
+
+        found = []
+        for matcher, with_context, context_chars, max_snippets in queries:
+            if folded is not None and getattr(matcher, 'fold', False):
+                found.append(_match_contents(folded, matcher, with_context,
+                                             context_chars, max_snippets))
+
+            else:
+                found.append(_match_contents(contents, matcher, with_context,
+                                             context_chars, max_snippets))
 
+        tag_stats = epub_file.tag_stats
+
+        # Only a fallback that was needed is worth recording
+        if parse_cache is not None and tag_stats is not None:
+            if tag_stats.failed and epub_file.tag_strategy != tag_strategy:
+                parse_cache.put(path, fingerprint,
+                                tag_strategy=epub_file.tag_strategy)
+
+            # ePubs with a known tag stripper say nothing of others
+            if tag_strategy is None:
+                parse_cache.add_strategy_stats(epub_file.producer,
+                                               tag_stats)
+
+        return [SearchResult(path=path, title=epub_file.title,
+                             author=epub_file.author, n_matches=n_matches,
+                             matches=matches, warnings=epub_file.warnings)
+                for n_matches, matches in found]
+
+
+def _search_epub(path, matcher, with_context, text_cache=None,
+                 context_chars=None, max_snippets=None, parse_cache=None,
+                 data=None):
+    return _search_epub_many(path, [(matcher, with_context, context_chars,
+                                     max_snippets)],
+                             text_cache, parse_cache, data)[0]
+
+
+def _search_spine(path, index, items, matcher, with_context,
+                  context_chars, max_snippets, tag_strategy,
+                  strategy_stats=None):
+    # Searches the spine @items of the ePub at @path, which is part @index
+    try:
+        # The labels are already in @items
+        epub_file = epub.Epub(path, tag_strategy, labels=False,
+                              utf8=_utf8(matcher),
+                              strategy_stats=strategy_stats)
+
+    except epub.BadEpubError as e:
+        return index, str(e), None, None, None
+
+    with epub_file:
+        contents = ((content.label, content.text)
+                    for content in epub_file.contents_of(items))
+        found = _match_contents(contents, matcher, with_context,
+                                context_chars, max_snippets)
+
+        return index, found, epub_file.warnings, epub_file.tag_strategy, \
+            epub_file.tag_stats
+
+
+def _should_split(path, matcher, text_cache):
+    # Boolean queries need all of the chapters together
+    if isinstance(path, epub.Epub) or isinstance(matcher, query.Query) or \
+       multiprocess.cpu_count() < 2:
+        return False
+
+    if text_cache is not None and text_cache.is_fresh(path):
+        return False
+
+    try:
+        return os.path.getsize(path) >= _SPLIT_SIZE
+
+    except OSError:
+        return False
+
+
+def _search_split(path, matcher, with_context, text_cache=None,
+                  context_chars=None, max_snippets=None, parse_cache=None):
+    # Searches a single large ePub with its spine split across the
+    # processes, the parts are merged back in the order of the spine
+    tag_strategy = None
+    strategy_stats = None
+
+    if parse_cache is not None:
+        record = parse_cache.get(path)
+
+        if record is not None:
+            # Known to be broken, do not parse it again
+            if record.error is not None:
+                return SearchResult(path=path, error=record.error)
+
+            tag_strategy = record.tag_strategy
+
+        fingerprint = util.file_fingerprint(path)
+        strategy_stats = parse_cache.strategy_stats
+
+    try:
+        epub_file = epub.Epub(path, tag_strategy, labels=with_context)
+
+    except epub.BadEpubError:
+        # Handles reporting and recording the error
+        return _search_epub(path, matcher, with_context, text_cache,
+                            context_chars, max_snippets, parse_cache)
+
+    with epub_file:
+        title = epub_file.title
+        author = epub_file.author
+        producer = epub_file.producer
+        spine = epub_file.spine
+        warnings = list(epub_file.warnings or ())
+
+    n_parts = min(len(spine),
+                  multiprocess.cpu_count() * _PARTS_PER_PROCESS)
+    if n_parts < 2:
+        return _search_epub(path, matcher, with_context, text_cache,
+                            context_chars, max_snippets, parse_cache)
+
+    searches = []
+    for i in range(n_parts):
+        items = spine[i * len(spine) // n_parts:
+                      (i + 1) * len(spine) // n_parts]
+        searches.append((path, i, items, matcher, with_context,
+                         context_chars, max_snippets, tag_strategy,
+                         strategy_stats))
+
+    # Only the index is compared, the rest need not be orderable
+    parts = sorted(multiprocess.Job(_search_spine, searches),
+                   key=lambda x: x[0])
+
+    n_matches = 0
+    matches = [] if with_context else None
+    n_snippets = 0
+
+    fallback = None
+    tag_stats = None
+
+    for index, found, part_warnings, part_strategy, part_stats in parts:
+        # The ePub changed since it was opened
+        if not isinstance(found, tuple):
+            return SearchResult(path=path, error=found)
+
+        # As for _search_epub_many(), for all of the parts together
+        if part_stats is not None:
+            if tag_stats is None:
+                tag_stats = tag_stripper.StrategyStats()
+
+            tag_stats.merge(part_stats)
+
+            if part_stats.failed and part_strategy != tag_strategy and \
+               fallback is None:
+                fallback = part_strategy
+
+        # Each part has the warnings from opening the ePub
+        for warning in part_warnings or ():
+            if warning not in warnings:
+                warnings.append(warning)
+
+        n_matches += found[0]
         if not with_context:
-            for content in epub_file.contents:
-                n_matches += matcher.count(content.text)
+            continue
 
-        else:
-            for content in epub_file.contents:
-                label_matches = []
+        for label_matches in found[1]:
+            if max_snippets is not None:
+                if n_snippets >= max_snippets:
+                    break
 
-                for match in matcher.match(content.text):
-                    n_matches += len(match)
-                    label_matches.append(match)
+                label_matches = label_matches._replace(
+                    matches=label_matches.matches[:max_snippets -
+                                                  n_snippets])
+
+            n_snippets += len(label_matches.matches)
+            matches.append(label_matches)
+
+    if with_context:
+        # Prevent modification
+        matches = tuple(matches)
+
+    if parse_cache is not None and tag_stats is not None:
+        if fallback is not None:
+            parse_cache.put(path, fingerprint, tag_strategy=fallback)
+
+        if tag_strategy is None:
+            parse_cache.add_strategy_stats(producer, tag_stats)
+
+    return SearchResult(path=path, title=title, author=author,
+                        n_matches=n_matches, matches=matches,
+                        warnings=tuple(warnings) if warnings else None)
+
+
+class _DataLimit(object):
+    """Holds back the ePubs read from tar bundles for the processes.
+
+    feed() is consumed by the Job's thread, which waits while at
+    least max_size bytes of ePubs are waiting for the processes,
+    done() is called with the path of each result received and
+    close() stops feeding, before the Job is terminated.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
 
-                if label_matches:
-                    # Prevent modification
-                    label_matches = tuple(label_matches)
-                    matches.append(LabelMatches(label=content.label,
-                                                matches=label_matches))
+        self.__condition = threading.Condition()
+        self.__size = 0
+        self.__sizes = {}
+        self.__closed = False
 
-            # Prevent modification
-            matches = tuple(matches)
+    def feed(self, searches):
+        for x in searches:
+            path = x[0]
+            data = x[-1]
 
-        return SearchResult(path=path, title=epub_file.title,
-                            author=epub_file.author, n_matches=n_matches,
-                            matches=matches, warnings=epub_file.warnings)
+            if data is not None:
+                with self.__condition:
+                    while self.__size >= self.max_size and \
+                            not self.__closed:
+                        self.__condition.wait()
 
+                    # The pool waits for this thread when terminated
+                    if self.__closed:
+                        return
+
+                    self.__size += len(data)
+                    self.__sizes.setdefault(path, []).append(len(data))
+
+            yield x
+
+    def done(self, path):
+        with self.__condition:
+            sizes = self.__sizes.get(path, None)
+            if not sizes:
+                return
+
+            self.__size -= sizes.pop()
+            self.__condition.notify()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+
+
+def _search_bounded(searches, search_func=_search_epub):
+    # Searches in a single Job, at most about _BUNDLE_BATCH_SIZE bytes
+    # of ePubs read from tar bundles are waiting for the processes
+    # Closing the generator terminates the Job
+    limit = _DataLimit(_BUNDLE_BATCH_SIZE)
+    job = multiprocess.Job(search_func, limit.feed(searches))
+
+    try:
+        for result in job:
+            # A list of the SearchResults for each query of search_many()
+            if isinstance(result, list):
+                limit.done(result[0].path)
+
+            else:
+                limit.done(result.path)
+
+            yield result
+
+    finally:
+        limit.close()
+        job.terminate()
+
+
+def _cache_results(cache, key, results):
+    cached = []
+
+    for result in results:
+        cached.append(result)
+        yield result
+
+    # Only complete searches are cached
+    cache.put(key, cached)
+
+
+def _expand_duplicates(groups, results):
+    groups = dict((group[0], group) for group in groups)
+
+    for result in results:
+        group = groups[result.path]
+        if len(group) == 1:
+            yield result
+            continue
+
+        # Every ePub with the content gets the result
+        for path in group:
+            duplicates = tuple(x for x in group if x != path)
+            yield result._replace(path=path, duplicates=duplicates)
+
+
+def search(paths, matcher, with_context, sync=None, cache=None,
+           text_cache=None, context_chars=None, max_snippets=None,
+           dedup=False, parse_cache=None, progress=None, progress_rate=10.0):
+    """Searches the ePubs at @paths with @matcher.
+
+    Yields a SearchResult for each path, in the order the paths
+    were given when running sync and otherwise as they finish.
+    @cache is a cache.ResultCache for whole searches and
+    @text_cache a cache.TextCache used instead of parsing
+    the ePubs which it has up to date text for.
+    @context_chars and @max_snippets limit the context kept
+    for each ePub, see _match_contents().
+
+    A single ePub of at least _SPLIT_SIZE bytes is searched with
+    its chapters split across the processes, unless @sync is given.
+
+    ePubs in a tar bundle, see bundle.py, are read from it in a
+    single pass and handed to the processes in memory.
+
+    Closing the returned generator before the end stops searching,
+    so only part of the results can be taken.
+
+    When @dedup is True ePubs with the same content, going by
+    util.content_signature(), are searched once and the result
+    is given for each of them with duplicates set. Long chapters
+    repeated in different ePubs, as in omnibus editions, are matched
+    once by each process, see _memoized().
+
+    @parse_cache is a cache.ParseCache, ePubs which failed to parse
+    before are reported without parsing them again and those which
+    needed a fallback tag stripper start with it.
+
+    @progress is called with a progress.Progress as the results
+    are yielded, at most @progress_rate times a second.
+    """
 
-def search(paths, matcher, with_context, sync=None):
     if not paths:
         return []
 
+    if progress is not None:
+        results = search(paths, matcher, with_context, sync, cache,
+                         text_cache, context_chars, max_snippets, dedup,
+                         parse_cache)
+
+        return Reporter(progress, paths, progress_rate).report(results)
+
+    if dedup:
+        groups = util.group_duplicates(paths)
+        results = search(tuple(group[0] for group in groups), matcher,
+                         with_context, sync, cache, text_cache,
+                         context_chars, max_snippets,
+                         parse_cache=parse_cache)
+
+        return _expand_duplicates(groups, results)
+
+    if cache is not None:
+        # Any change to the ePubs changes the key
+        key = cache.key(matcher, with_context, util.fingerprint(paths),
+                        context_chars, max_snippets)
+
+        results = cache.get(key)
+        if results is not None:
+            return iter(results)
+
+        return _cache_results(cache, key,
+                              search(paths, matcher, with_context, sync,
+                                     text_cache=text_cache,
+                                     context_chars=context_chars,
+                                     max_snippets=max_snippets,
+                                     parse_cache=parse_cache))
+
     # Only run in sync if specifically told to or when there is only
     # one path but we haven't been specifically told not to run sync.
+    if sync is None and len(paths) == 1 and \
+       _should_split(paths[0], matcher, text_cache):
+        return iter([_search_split(paths[0], matcher, with_context,
+                                   text_cache, context_chars, max_snippets,
+                                   parse_cache)])
+
+    # ePubs in a tar bundle are read from it in one pass
+    if sync or (sync is None and len(paths) == 1):
+        def search_sync():
+            for path, data in bundle.with_data(paths):
+                yield _search_epub(path, matcher, with_context, text_cache,
+                                   context_chars, max_snippets, parse_cache,
+                                   data)
+
+        return search_sync()
+
+    searches = ((path, matcher, with_context, text_cache, context_chars,
+                 max_snippets, parse_cache, data)
+                for path, data in bundle.with_data(paths))
+    return _search_bounded(searches)
+
+
+def search_many(paths, queries, sync=None, text_cache=None,
+                parse_cache=None):
+    """Searches the ePubs at @paths with each of @queries at once.
+
+    @queries are (matcher, with_context, context_chars, max_snippets)
+    tuples. Each ePub is parsed, or loaded from @text_cache, once for
+    all of them. Yields a list with the SearchResult of each query
+    for each path, in the order search() yields them. @sync,
+    @text_cache and @parse_cache are as for search().
+    """
+
+    queries = [tuple(x) for x in queries]
+    if not paths or not queries:
+        return iter([])
+
+    # Same rules as search(), except a large ePub is not split
     if sync or (sync is None and len(paths) == 1):
         def search_sync():
-            for path in paths:
-                yield _search_epub(path, matcher, with_context)
+            for path, data in bundle.with_data(paths):
+                yield _search_epub_many(path, queries, text_cache,
+                                        parse_cache, data)
 
         return search_sync()
 
-    searches = [(path, matcher, with_context) for path in paths]
-    return multiprocess.Job(_search_epub, searches)
+    searches = ((path, queries, text_cache, parse_cache, data)
+                for path, data in bundle.with_data(paths))
+    return _search_bounded(searches, _search_epub_many)
 
 # ex:et:ts=4:
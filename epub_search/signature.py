@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Signatures of text for cheap negative checks.
+
+A signature is a bitmap with a bit set for the hash of each
+character trigram within the words of the lower cased text. When a
+trigram of a string is not set the string is not in the text, when
+all of them are set it might be. Trigrams spanning words are left
+out, which makes signatures much faster to build as each distinct
+word is only looked at once. About _BITS_PER_TRIGRAM bits are used for each
+distinct trigram, so a trigram which is not in the text is set for
+about 1 in 9 of them and a string of a few words is almost never
+thought to be in a text which does not have it.
+"""
+
+import re
+import zlib
+
+
+_BITS_PER_TRIGRAM = 8
+
+_MIN_BITS = 64
+_MAX_BITS = 1 << 20
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+_FINAL_SIGMA = u'ς'
+_SIGMA = u'σ'
+
+
+def _normalize(string):
+    # lower() changes sigma depending on what follows it,
+    # which can be different for the string and the text
+    return string.lower().replace(_FINAL_SIGMA, _SIGMA)
+
+
+def _trigrams(string):
+    trigrams = set()
+
+    # The words of a string within the text are within its words
+    for word in set(_WORD_RE.findall(string)):
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+
+    return trigrams
+
+
+def _hash(trigram):
+    # hash() is randomized for each process
+    return zlib.crc32(trigram.encode('utf-8')) & 0xffffffff
+
+
+class Signature(object):
+    """The signature of a text, bitmap is its bits."""
+
+    __slots__ = ('bitmap', '__mask')
+
+    def __init__(self, bitmap):
+        # Indexing is the same in Python 2 and 3
+        self.bitmap = bytearray(bitmap)
+        self.__mask = len(bitmap) * 8 - 1
+
+    @classmethod
+    def build(cls, text):
+        """Returns the Signature of @text."""
+
+        trigrams = _trigrams(_normalize(text))
+
+        n_bits = _MIN_BITS
+        while n_bits < len(trigrams) * _BITS_PER_TRIGRAM and \
+              n_bits < _MAX_BITS:
+            n_bits *= 2
+
+        mask = n_bits - 1
+        bitmap = bytearray(n_bits // 8)
+
+        for trigram in trigrams:
+            bit = _hash(trigram) & mask
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+
+        return cls(bitmap)
+
+    def __getstate__(self):
+        return bytes(self.bitmap)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def may_contain(self, string):
+        """Returns False when the text can not contain @string.
+
+        Case is ignored, so this is also the case for a case
+        sensitive search. Strings without a word of at least
+        3 characters might always be in the text.
+        """
+
+        bitmap = self.bitmap
+        mask = self.__mask
+
+        for trigram in _trigrams(_normalize(string)):
+            bit = _hash(trigram) & mask
+            if not bitmap[bit >> 3] & (1 << (bit & 7)):
+                return False
+
+        return True
+
+# ex:et:ts=4:
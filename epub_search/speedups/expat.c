@@ -21,9 +21,18 @@
 #include "Python.h"
 
 #include "stdio.h"
+#include "string.h"
 
 #include "expat.h"
 
+/* The text is UTF-8 bytes, which is str in Python 2 */
+#if PY_MAJOR_VERSION >= 3
+#define PyString_FromStringAndSize PyBytes_FromStringAndSize
+#define PyString_AS_STRING PyBytes_AS_STRING
+#define PyString_GET_SIZE PyBytes_GET_SIZE
+#define _PyString_Resize _PyBytes_Resize
+#endif
+
 
 typedef struct {
     int buffer_len;
@@ -38,7 +47,7 @@ strip_tags_state_append_data (StripTagsState *state,
                               int len)
 {
     /* Using memmove as the buffer and data might overlap */
-    Py_MEMCPY(state->buffer, data, len * sizeof(XML_Char));
+    memmove(state->buffer, data, len * sizeof(XML_Char));
 
     state->buffer += len;
     state->buffer_len += len;
@@ -141,7 +150,7 @@ py_expat_strip_tags(PyObject *self,
 
 static PyMethodDef speedups_expat_methods[] = {
     { "strip_tags",  py_expat_strip_tags, METH_VARARGS,
-      "Strips the tags from the XHTML string."},
+      "Strips the tags from the XHTML bytes, returning UTF-8 bytes."},
     { NULL, NULL, 0, NULL}
 };
 
@@ -176,7 +185,7 @@ moduleinit(void)
 
 #if PY_MAJOR_VERSION >= 3
 PyMODINIT_FUNC
-PyInit_speedups_expat(void)
+PyInit__speedups_expat(void)
 {
     return moduleinit();
 }
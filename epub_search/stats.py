@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Term frequencies across ePubs."""
+
+from array import array
+from collections import defaultdict, namedtuple
+import heapq
+import re
+
+try:
+    import cPickle as pickle
+
+except ImportError:
+    import pickle # Python 3
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+from epub_search import multiprocess
+from epub_search import util
+from epub_search.corpus import _extract_book
+from epub_search.search import SearchResult
+
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_FORMAT = 'epub-search term matrix 2'
+
+
+BookTotal = namedtuple('BookTotal', ('path', 'title', 'author', 'total'))
+
+
+def tokenize(text):
+    """Returns the lowercase words of @text."""
+
+    return _TOKEN_RE.findall(text.lower())
+
+
+def normalize_terms(terms):
+    """Returns @terms as they are in a TermMatrix, lowercase and
+    without repeats, in the order they were given."""
+
+    return tuple(util.unique(term.lower() for term in terms))
+
+
+def _count_terms(path, per_chapter, text_cache):
+    extracted = _extract_book(path, text_cache)
+    if isinstance(extracted, SearchResult):
+        return path, extracted.error
+
+    title, author, warnings, labels, texts = extracted
+
+    rows = []
+    for label, text in zip(labels, texts):
+        counts = defaultdict(int)
+
+        for term in tokenize(text):
+            counts[term] += 1
+
+        rows.append((label, dict(counts)))
+
+    if not per_chapter:
+        counts = defaultdict(int)
+
+        for label, chapter_counts in rows:
+            for term, count in chapter_counts.items():
+                counts[term] += count
+
+        rows = [(None, dict(counts))]
+
+    return path, (title, author, rows)
+
+
+class TermMatrix(object):
+    """A sparse matrix of term counts for each ePub or chapter.
+
+    The matrix is stored by term, for each term the rows it occurs
+    in and its count in them are a slice of the row_indices and
+    counts arrays starting at term_ptr[term_id]. book_dfs[term_id]
+    is the number of ePubs it occurs in. When numpy is available it
+    is used to combine the columns.
+    """
+
+    def __init__(self, books, row_books, row_labels, vocabulary,
+                 term_ptr, row_indices, counts, book_dfs):
+        self.books = tuple(books)
+        self.row_books = row_books
+        self.row_labels = tuple(row_labels)
+
+        self.__vocabulary = vocabulary
+        self.__term_ptr = term_ptr
+        self.__row_indices = row_indices
+        self.__counts = counts
+        self.__book_dfs = book_dfs
+
+        self.__book_lengths = None
+
+    @classmethod
+    def build(cls, paths, per_chapter=False, sync=None, text_cache=None):
+        """Tokenizes the ePubs at @paths once and counts every term.
+
+        Returns the matrix and a list of the errors for ePubs
+        that could not be parsed. When @per_chapter is True
+        there is a row for each chapter instead of each ePub.
+        """
+
+        paths = tuple(paths)
+        searches = [(path, per_chapter, text_cache) for path in paths]
+
+        # Same rules as search.search()
+        if sync or (sync is None and len(paths) <= 1):
+            counted = [_count_terms(*x) for x in searches]
+
+        else:
+            counted = list(multiprocess.Job(_count_terms, searches))
+
+            order = dict((path, i) for i, path in enumerate(paths))
+            counted.sort(key=lambda x: order[x[0]])
+
+        errors = []
+        books = []
+        row_books = array('l')
+        row_labels = []
+        postings = defaultdict(lambda: (array('l'), array('l')))
+
+        for path, book in counted:
+            if not isinstance(book, tuple):
+                errors.append(book)
+                continue
+
+            title, author, rows = book
+            books.append((path, title, author))
+
+            for label, counts in rows:
+                row = len(row_labels)
+                row_books.append(len(books) - 1)
+                row_labels.append(label)
+
+                for term, count in counts.items():
+                    term_rows, term_counts = postings[term]
+                    term_rows.append(row)
+                    term_counts.append(count)
+
+        vocabulary = {}
+        term_ptr = array('l', [0])
+        row_indices = array('l')
+        counts = array('l')
+        book_dfs = array('l')
+
+        for term in sorted(postings):
+            term_rows, term_counts = postings.pop(term)
+
+            vocabulary[term] = len(vocabulary)
+            row_indices.extend(term_rows)
+            counts.extend(term_counts)
+            term_ptr.append(len(row_indices))
+
+            # The rows are in order and those of an ePub are together
+            df = 0
+            previous = -1
+            for row in term_rows:
+                if row_books[row] != previous:
+                    previous = row_books[row]
+                    df += 1
+
+            book_dfs.append(df)
+
+        matrix = cls(books, row_books, row_labels, vocabulary,
+                     term_ptr, row_indices, counts, book_dfs)
+
+        return matrix, errors
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as matrix_file:
+            data = pickle.load(matrix_file)
+
+        if data[0] != _FORMAT:
+            raise ValueError('%r is not a term matrix of this version' %
+                             (path))
+
+        return cls(*data[1:])
+
+    def save(self, path):
+        data = (_FORMAT, self.books, self.row_books, self.row_labels,
+                self.__vocabulary, self.__term_ptr, self.__row_indices,
+                self.__counts, self.__book_dfs)
+
+        with open(path, 'wb') as matrix_file:
+            pickle.dump(data, matrix_file, pickle.HIGHEST_PROTOCOL)
+
+    @property
+    def n_rows(self):
+        return len(self.row_labels)
+
+    @property
+    def n_terms(self):
+        return len(self.__vocabulary)
+
+    @property
+    def book_lengths(self):
+        """Returns the number of words in each ePub."""
+
+        if self.__book_lengths is not None:
+            return self.__book_lengths
+
+        rows = self.__row_indices
+        counts = self.__counts
+
+        if numpy is not None and len(rows) > 0:
+            row_books = numpy.frombuffer(self.row_books,
+                                         dtype=self.row_books.typecode)
+            books = row_books[numpy.frombuffer(rows, dtype=rows.typecode)]
+            weights = numpy.frombuffer(counts, dtype=counts.typecode)
+
+            lengths = numpy.bincount(books, weights=weights,
+                                     minlength=len(self.books))
+            lengths = lengths.astype(numpy.int64).tolist()
+
+        else:
+            row_books = self.row_books
+            lengths = [0] * len(self.books)
+
+            for row, count in zip(rows, counts):
+                lengths[row_books[row]] += count
+
+        self.__book_lengths = lengths
+        return lengths
+
+    def __contains__(self, term):
+        return term.lower() in self.__vocabulary
+
+    def column(self, term):
+        """Returns the (rows, counts) arrays for @term."""
+
+        term_id = self.__vocabulary.get(term.lower(), None)
+        if term_id is None:
+            return array('l'), array('l')
+
+        start = self.__term_ptr[term_id]
+        end = self.__term_ptr[term_id + 1]
+
+        return self.__row_indices[start:end], self.__counts[start:end]
+
+    def book_df(self, term):
+        """Returns the number of ePubs @term occurs in."""
+
+        term_id = self.__vocabulary.get(term.lower(), None)
+        if term_id is None:
+            return 0
+
+        return self.__book_dfs[term_id]
+
+    def __accumulate(self, terms, n_bins, bin_of_row=None):
+        # Sums the counts of @terms into n_bins, by row or by bin_of_row
+        columns = [self.column(term) for term in normalize_terms(terms)]
+
+        if numpy is not None:
+            totals = numpy.zeros(n_bins, dtype=numpy.int64)
+
+            for rows, counts in columns:
+                rows = numpy.frombuffer(rows, dtype=rows.typecode)
+                if bin_of_row is not None:
+                    rows = bin_of_row[rows]
+
+                totals += numpy.bincount(
+                    rows, weights=numpy.frombuffer(counts,
+                                                   dtype=counts.typecode),
+                    minlength=n_bins).astype(numpy.int64)
+
+            return totals.tolist()
+
+        totals = [0] * n_bins
+
+        for rows, counts in columns:
+            for row, count in zip(rows, counts):
+                if bin_of_row is not None:
+                    row = bin_of_row[row]
+
+                totals[row] += count
+
+        return totals
+
+    def row_totals(self, terms):
+        """Returns the total count of @terms in each row."""
+
+        return self.__accumulate(terms, self.n_rows)
+
+    def book_totals(self, terms):
+        """Returns the total count of @terms in each ePub."""
+
+        row_books = self.row_books
+        if numpy is not None:
+            row_books = numpy.frombuffer(row_books, dtype=row_books.typecode)
+
+        return self.__accumulate(terms, len(self.books), row_books)
+
+    def term_totals(self, terms):
+        """Returns a dict of the total count of each of @terms,
+        by their normalize_terms()."""
+
+        return dict((term, sum(self.column(term)[1]))
+                    for term in normalize_terms(terms))
+
+    def top_books(self, terms, n=10):
+        """Returns a BookTotal for the @n ePubs with the most @terms."""
+
+        totals = self.book_totals(terms)
+        best = heapq.nlargest(n, (i for i in range(len(totals))
+                                  if totals[i] > 0),
+                              key=totals.__getitem__)
+
+        return [BookTotal(*(self.books[i] + (totals[i],))) for i in best]
+
+    def totals_by(self, field, terms):
+        """Returns {value: {term: total}} grouping ePubs by @field.
+
+        @field is 'author' or 'title', ePubs without
+        one are grouped under None.
+        """
+
+        index = ('title', 'author').index(field) + 1
+        grouped = defaultdict(lambda: defaultdict(int))
+
+        for term in normalize_terms(terms):
+            for i, total in enumerate(self.book_totals((term,))):
+                if total > 0:
+                    grouped[self.books[i][index]][term] += total
+
+        return dict((key, dict(value)) for key, value in grouped.items())
+
+# ex:et:ts=4:
@@ -17,6 +17,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import time
 import xml.parsers.expat
 
 from lxml import etree as ElementTree
@@ -36,7 +37,8 @@ class _TagStripperBase(object):
     __NEWLINE_TAGS = set(('p', 'div', 'br',
                           'h1', 'h2', 'h3', 'h4', 'h5', 'h6'))
 
-    def __call__(self, xhtml):
+    def __call__(self, xhtml, utf8=False):
+        # The parsers only give text, encoding it would cost more
         parts = []
         parts_append = parts.append
         newline_tags = self.__NEWLINE_TAGS
@@ -65,30 +67,42 @@ if _speedups_expat is not None:
         __slots__ = ()
 
         @staticmethod
-        def __call__(xhtml):
+        def __call__(xhtml, utf8=False):
             try:
-                return _speedups_expat.strip_tags(xhtml)
+                text = _speedups_expat.strip_tags(xhtml)
 
             except ValueError as e:
                 raise TagStripError(e)
 
+            # In Python 2 the UTF-8 bytes are already a str
+            if utf8 or isinstance(text, str):
+                return text
+
+            return text.decode('utf-8')
+
 else:
     class _ExpatTagStripper(_TagStripperBase):
         __slots__ = ('__parser',)
 
         def __init__(self):
-            self.__parser = xml.parsers.expat.ParserCreate()
+            self.__parser = self.__create_parser()
+
+        @staticmethod
+        def __create_parser():
+            parser = xml.parsers.expat.ParserCreate()
 
             # Avoid join()ing thousands of strings
             # a decent buffer size is used
-            self.__parser.buffer_text = True
+            parser.buffer_text = True
 
             # Faster to parse str than unicode
             try:
-                self.__parser.returns_unicode = False
+                parser.returns_unicode = False
             except: 
                 pass # Python 3
 
+            return parser
+
         def parse(self, xhtml):
             try:
                 self.__parser.Parse(xhtml, True)
@@ -96,6 +110,10 @@ else:
             except xml.parsers.expat.ExpatError as e:
                 raise TagStripError(e)
 
+            finally:
+                # An expat parser can only parse a single document
+                self.__parser = self.__create_parser()
+
         def set_start_element_handler(self, value):
             self.__parser.StartElementHandler = value
 
@@ -153,28 +171,191 @@ class _LxmlTagStripper(_TagStripperBase):
         self.__target.data_handler = value
 
 
+# The strategies in the order they are tried
+STRATEGIES = ('expat', 'lxml')
+
+_STRIPPERS = {'expat': _ExpatTagStripper,
+              'lxml': _LxmlTagStripper}
+
+_BUILTIN_STRATEGIES = STRATEGIES
+
+# Registered strategies are tried first this many
+# times for each producer of ePubs, to measure them
+_MIN_TRIES = 8
+
+# Once each strategy used was tried this many times for a
+# producer, successes no longer change its order enough to store
+_SETTLED_TRIES = 64
+
+
+def register(strategy, stripper_class):
+    """Adds the tag stripping method @strategy.
+
+    Instances of @stripper_class are called with the XHTML and
+    utf8, as for TagStripper, and must raise TagStripError for XHTML
+    which they can not strip exactly as expat does. The strategy is
+    tried before lxml, which recovers from broken XHTML, and first
+    until StrategyStats has measured it.
+    """
+
+    global STRATEGIES
+
+    if strategy in _STRIPPERS:
+        raise ValueError('%r is already registered' % (strategy))
+
+    _STRIPPERS[strategy] = stripper_class
+    STRATEGIES = STRATEGIES[:-1] + (strategy,) + STRATEGIES[-1:]
+
+
+class StrategyStats(object):
+    """How the strategies did for some XHTML, such as an ePub producer's.
+
+    For each strategy this is the number of times it was tried,
+    how many of those failed, the seconds taken and the bytes of
+    XHTML, from which the order to try them in is worked out.
+    """
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or ())
+
+    def __getstate__(self):
+        return self.counts
+
+    def __setstate__(self, state):
+        self.counts = state
+
+    @property
+    def failed(self):
+        """Whether any of the strategies failed."""
+
+        return any(count[1] for count in self.counts.values())
+
+    def record(self, strategy, n_bytes, seconds, failed):
+        count = self.counts.setdefault(strategy, [0, 0, 0.0, 0])
+
+        count[0] += 1
+        count[1] += 1 if failed else 0
+        count[2] += seconds
+        count[3] += n_bytes
+
+    def worth_merging(self, stored):
+        """Whether merging into the StrategyStats @stored is worthwhile.
+
+        A failure always is, otherwise only while a strategy
+        used has been tried less than _SETTLED_TRIES times.
+        """
+
+        return self.failed or \
+            any(stored.counts.get(strategy, (0,))[0] < _SETTLED_TRIES
+                for strategy in self.counts)
+
+    def merge(self, other):
+        """Adds the counts of the StrategyStats @other."""
+
+        for strategy, (n_tried, n_failed, seconds, n_bytes) in \
+            other.counts.items():
+            count = self.counts.setdefault(strategy, [0, 0, 0.0, 0])
+
+            count[0] += n_tried
+            count[1] += n_failed
+            count[2] += seconds
+            count[3] += n_bytes
+
+    def order(self):
+        """Returns the known strategies in the order to try them."""
+
+        def cost(strategy):
+            n_tried, n_failed, seconds, n_bytes = \
+                self.counts.get(strategy, (0, 0, 0.0, 0))
+
+            # Without any counts the order is kept
+            if n_tried == 0 or n_bytes == 0:
+                return None
+
+            # The order with the least expected time until one
+            # succeeds tries the cheapest for each success first
+            succeeded = (n_tried - n_failed + 0.5) / (n_tried + 1.0)
+            return seconds / n_bytes / succeeded
+
+        costs = dict((strategy, cost(strategy)) for strategy in STRATEGIES)
+
+        # Those not measured yet keep their place after the others
+        order = sorted(STRATEGIES, key=lambda x: (costs[x] is None,
+                                                  costs[x] or 0.0))
+
+        # Registered strategies are measured first
+        untried = [strategy for strategy in order
+                   if strategy not in _BUILTIN_STRATEGIES and
+                   self.counts.get(strategy, (0,))[0] < _MIN_TRIES]
+
+        return untried + [x for x in order if x not in untried]
+
+
 class TagStripper(object):
     """Strips the tags from an XHTML string.
 
     Supports a fast mode for properly formatted XHTML with fallbacks
     for broken XHTML. Once a fallback method has been used it will
     continue to be used by subsequent calls on that instance.
+
+    When strategy, one of STRATEGIES, is given the earlier
+    methods are skipped, such as for XHTML known to be broken.
+    Otherwise when stats, a StrategyStats, is given the methods
+    are tried in its order. What happens is recorded in the
+    StrategyStats recorded.
+
+    When called with utf8=True the text may be returned as UTF-8
+    bytes, which the expat speedups produce without decoding them.
+    The other methods only produce text so still return that.
     """
 
-    def __init__(self):
-        self.__tag_stipper = _ExpatTagStripper()
-        self.__tag_stippers = (_LxmlTagStripper,)
+    def __init__(self, strategy=None, stats=None):
+        if strategy is not None:
+            order = STRATEGIES[STRATEGIES.index(strategy):]
+
+        elif stats is not None:
+            order = stats.order()
+
+        else:
+            order = STRATEGIES
+
+        self.recorded = StrategyStats()
+
+        self.__strategy = order[0]
+        self.__tag_stipper = _STRIPPERS[order[0]]()
+        self.__tag_stippers = tuple(order[1:])
+
+    @property
+    def strategy(self):
+        """Returns the name of the method currently used."""
+
+        return self.__strategy
+
+    def __call__(self, xhtml, utf8=False):
+        xhtml = xhtml.replace(b'\n', b' ')
 
-    def __call__(self, xhtml):
         while 1:
+            start = time.time()
+
             try:
-                return self.__tag_stipper(xhtml.replace(b'\n', b' '))
+                text = self.__tag_stipper(xhtml, utf8)
 
             except TagStripError:
+                self.recorded.record(self.__strategy, len(xhtml),
+                                     time.time() - start, True)
+
                 if not self.__tag_stippers:
                     raise
 
-                self.__tag_stipper = self.__tag_stippers[0]()
+                self.__strategy = self.__tag_stippers[0]
+                self.__tag_stipper = _STRIPPERS[self.__strategy]()
                 self.__tag_stippers = self.__tag_stippers[1:]
+                continue
+
+            self.recorded.record(self.__strategy, len(xhtml),
+                                 time.time() - start, False)
+            return text
 
 # ex:et:ts=4:
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Compressed storage for stripped text."""
+
+from collections import OrderedDict
+import sys
+import zlib
+
+try:
+    import lzma
+
+except ImportError:
+    # Python 2
+    lzma = None
+
+
+_CODECS = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress)}
+
+if lzma is not None:
+    _CODECS['lzma'] = (lzma.compress, lzma.decompress)
+
+
+COMPRESSIONS = tuple(sorted(_CODECS))
+
+
+def compress(text, compression):
+    """Returns @text compressed with @compression."""
+
+    try:
+        compress_func = _CODECS[compression][0]
+
+    except KeyError:
+        raise ValueError('Unknown compression %r' % (compression))
+
+    return compress_func(text.encode('utf-8'))
+
+
+class CompressedTextStore(object):
+    """Keeps text compressed in memory.
+
+    Text is decompressed on demand and the most recently
+    used texts are kept decompressed, in the order they
+    were last used, up to cache_size of them.
+    """
+
+    def __init__(self, compression='zlib', cache_size=16):
+        if compression not in _CODECS:
+            raise ValueError('Unknown compression %r' % (compression))
+
+        self.compression = compression
+        self.cache_size = cache_size
+
+        self.__decompress = _CODECS[compression][1]
+        self.__blobs = []
+        self.__lengths = []
+        self.__cache = OrderedDict()
+
+        self.__n_bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+
+    def __len__(self):
+        return len(self.__blobs)
+
+    def add(self, text):
+        """Stores @text and returns its key."""
+
+        return self.add_compressed(compress(text, self.compression),
+                                   len(text))
+
+    def add_compressed(self, blob, length):
+        """Stores @blob which was created with compress().
+
+        @length is the number of characters in the uncompressed text.
+        """
+
+        self.__blobs.append(blob)
+        self.__lengths.append(length)
+        self.__n_bytes += len(blob)
+
+        return len(self.__blobs) - 1
+
+    def length(self, key):
+        """Returns the number of characters of the text for @key."""
+
+        return self.__lengths[key]
+
+    def get(self, key):
+        """Returns the text for @key."""
+
+        cache = self.__cache
+
+        try:
+            text = cache.pop(key)
+
+        except KeyError:
+            self.__misses += 1
+            text = self.__decompress(self.__blobs[key]).decode('utf-8')
+
+            if self.cache_size > 0 and len(cache) >= self.cache_size:
+                # Evict the least recently used
+                cache.popitem(last=False)
+
+        else:
+            self.__hits += 1
+
+        if self.cache_size > 0:
+            cache[key] = text
+
+        return text
+
+    def clear_cache(self):
+        self.__cache.clear()
+
+    @property
+    def n_chars(self):
+        """Returns the number of uncompressed characters stored."""
+
+        return sum(self.__lengths)
+
+    @property
+    def memory_usage(self):
+        """Returns the approximate number of bytes used.
+
+        This is the compressed text plus the decompressed cache.
+        """
+
+        return self.__n_bytes + sum(sys.getsizeof(text)
+                                    for text in self.__cache.values())
+
+    @property
+    def compressed_size(self):
+        """Returns the number of bytes of compressed text."""
+
+        return self.__n_bytes
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    @property
+    def hit_rate(self):
+        """Returns the fraction of get() calls served by the cache."""
+
+        total = self.__hits + self.__misses
+        if total == 0:
+            return 0.0
+
+        return float(self.__hits) / total
+
+# ex:et:ts=4:
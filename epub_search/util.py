@@ -17,12 +17,16 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import hashlib
 import itertools
 import os
 import zipfile
 
+from epub_search import bundle
 
-def epubs_in_path(path):
+
+def epubs_in_path(path, members=bundle.members):
+    # The ePubs in the bundles are listed with members(bundle_path)
     # Must expand the path for os.path's functions to work
     path = os.path.expanduser(path)
 
@@ -30,12 +34,17 @@ def epubs_in_path(path):
         raise Exception('%r does not exist' % (path))
 
     if not os.path.isdir(path):
+        # The ePubs in a zip or tar bundle are searched
+        if bundle.is_bundle(path):
+            return members(path)
+
         if not zipfile.is_zipfile(path):
             raise Exception('%r is not an ePub' % (path))
 
         return [path]
 
     dir_paths = []
+    bundle_paths = []
     for root, dirs, files in os.walk(path, followlinks=True):
         for child in files:
             if child.endswith('.epub'):
@@ -43,7 +52,20 @@ def epubs_in_path(path):
                 # an ePub, a warning will be printed later
                 dir_paths.append(os.path.join(root, child))
 
+            elif child.endswith(bundle.EXTENSIONS):
+                child_path = os.path.join(root, child)
+
+                # Other archives are ignored
+                if bundle.is_bundle(child_path):
+                    bundle_paths.append(child_path)
+
     dir_paths.sort(key=str.lower)
+    bundle_paths.sort(key=str.lower)
+
+    # Members are kept in the order of the bundle
+    for bundle_path in bundle_paths:
+        dir_paths.extend(members(bundle_path))
+
     return dir_paths
 
 
@@ -61,4 +83,150 @@ def unique(iterable):
 
         yield element
 
+
+def file_fingerprint(path):
+    """Returns a value which changes when the file at @path changes."""
+
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        # An ePub in a bundle changes with the bundle
+        located = bundle.split(path)
+        if located is None:
+            return None
+
+        return file_fingerprint(located[0])
+
+    # Python 2 only has the float
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = stat.st_mtime
+
+    return (stat.st_size, mtime)
+
+
+def file_size(path):
+    """Returns the size of the file at @path, or 0 when it has none,
+    such as an ePub in a bundle."""
+
+    try:
+        return os.path.getsize(path)
+
+    except OSError:
+        return 0
+
+
+def fingerprint(paths):
+    """Returns a hex digest which changes when any of @paths change."""
+
+    digest = hashlib.sha1()
+
+    for path in paths:
+        digest.update(repr((path, file_fingerprint(path))).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def content_signature(path):
+    """Returns a hex digest of the contents of the ePub at @path.
+
+    Only the zip's central directory is read, the names, CRCs and
+    sizes of the members identify the content however the ePub was
+    compressed. Returns None when @path is not a zip.
+    """
+
+    # Imported here as zipreader is not needed otherwise
+    from epub_search import zipreader
+
+    try:
+        # Only the central directory is wanted
+        with zipreader.ZipReader(path, small_size=0) as epub_zipfile:
+            members = sorted((info.filename, info.CRC, info.file_size)
+                             for info in epub_zipfile.infolist())
+
+    except Exception:
+        return None
+
+    return hashlib.sha1(repr(members).encode('utf-8')).hexdigest()
+
+
+def content_digest(path):
+    """Returns a hex digest of the uncompressed members of the ePub
+    at @path, or None when it can not be read.
+
+    This confirms that ePubs with the same content_signature(),
+    which only has the CRCs, really have the same content.
+    """
+
+    from epub_search import zipreader
+
+    digest = hashlib.sha1()
+
+    try:
+        with zipreader.ZipReader(path) as epub_zipfile:
+            for name in sorted(epub_zipfile.namelist()):
+                data = epub_zipfile.read(name)
+
+                digest.update(repr((name, len(data))).encode('utf-8'))
+                digest.update(data)
+
+    except Exception:
+        return None
+
+    return digest.hexdigest()
+
+
+def group_duplicates(paths):
+    """Returns a list of the paths in @paths with the same content.
+
+    Each item is a tuple of the paths which share a
+    content_signature(), in the order they were given. Paths
+    with the signature of an earlier one are only grouped with
+    it when their content_digest() is the same too.
+    """
+
+    groups = {}
+    order = []
+
+    # The keys of the groups with each signature and the digest of
+    # the first path of a group, made once another path needs it
+    buckets = {}
+    digests = {}
+
+    for path in paths:
+        signature = content_signature(path)
+
+        # Paths which are not zips are never duplicates
+        if signature is None:
+            key = ('path', path)
+
+        else:
+            keys = buckets.setdefault(signature, [])
+
+            key = None
+            if keys:
+                digest = content_digest(path)
+
+                for x in keys:
+                    if x not in digests:
+                        digests[x] = content_digest(groups[x][0])
+
+                    if digest is not None and digests[x] == digest:
+                        key = x
+                        break
+
+            # A CRC collision, or the first with this signature
+            if key is None:
+                key = (signature, len(keys))
+                keys.append(key)
+
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+
+        groups[key].append(path)
+
+    return [tuple(groups[key]) for key in order]
+
 # ex:et:ts=4:
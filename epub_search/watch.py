@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Watching ePub libraries for changes."""
+
+from collections import namedtuple
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+
+except ImportError:
+    import queue # Python 3
+
+from epub_search import bundle
+from epub_search import util
+
+
+Changes = namedtuple('Changes', ('added', 'modified', 'removed'))
+
+
+class Watcher(object):
+    """Polls paths, as given to util.epubs_in_path(), for changes.
+
+    Iterating yields a Changes once a change has been seen and then
+    nothing else changed for debounce seconds, so that copying many
+    ePubs into the library results in a single batch. The members
+    of a bundle are only listed again once the bundle changed.
+    """
+
+    def __init__(self, paths, interval=2.0, debounce=1.0):
+        self.paths = tuple(paths)
+        self.interval = interval
+        self.debounce = debounce
+
+        # Everything is added on the first poll()
+        self.__state = {}
+
+        # The fingerprint and members of each bundle
+        self.__bundles = {}
+
+    def scan(self):
+        """Returns the fingerprint of each ePub currently in the paths."""
+
+        state = {}
+        bundles = {}
+
+        def members(bundle_path):
+            # Listing a compressed tar decompresses all of it
+            fingerprint = util.file_fingerprint(bundle_path)
+
+            listed = self.__bundles.get(bundle_path, None)
+            if listed is None or listed[0] != fingerprint:
+                listed = (fingerprint, bundle.members(bundle_path))
+
+            bundles[bundle_path] = listed
+            return listed[1]
+
+        for path in self.paths:
+            try:
+                epub_paths = util.epubs_in_path(path, members)
+
+            # Removed or not yet created
+            except Exception:
+                continue
+
+            for epub_path in epub_paths:
+                fingerprint = util.file_fingerprint(epub_path)
+
+                # Removed since listing the directory
+                if fingerprint is not None:
+                    state[epub_path] = fingerprint
+
+        # Forgets the bundles which are gone
+        self.__bundles = bundles
+
+        return state
+
+    def poll(self):
+        """Returns the Changes since the previous poll()."""
+
+        old_state = self.__state
+        new_state = self.scan()
+
+        added = []
+        modified = []
+
+        for path, fingerprint in new_state.items():
+            old_fingerprint = old_state.get(path, None)
+
+            if old_fingerprint is None:
+                added.append(path)
+
+            elif old_fingerprint != fingerprint:
+                modified.append(path)
+
+        removed = [path for path in old_state if path not in new_state]
+
+        self.__state = new_state
+
+        return Changes(tuple(sorted(added)), tuple(sorted(modified)),
+                       tuple(sorted(removed)))
+
+    def __iter__(self):
+        while 1:
+            changes = self.poll()
+
+            if not any(changes):
+                time.sleep(self.interval)
+                continue
+
+            # Keep merging until nothing changes for the debounce time
+            while 1:
+                time.sleep(self.debounce)
+
+                more_changes = self.poll()
+                if not any(more_changes):
+                    break
+
+                changes = _merge_changes(changes, more_changes)
+
+            yield changes
+
+
+def _merge_changes(changes, more_changes):
+    added = set(changes.added)
+    modified = set(changes.modified)
+    removed = set(changes.removed)
+
+    for path in more_changes.added:
+        # Removed and added back is a modification
+        if path in removed:
+            removed.discard(path)
+            modified.add(path)
+
+        else:
+            added.add(path)
+
+    for path in more_changes.modified:
+        if path not in added:
+            modified.add(path)
+
+    for path in more_changes.removed:
+        # Added and removed again was never seen
+        if path in added:
+            added.discard(path)
+
+        else:
+            modified.discard(path)
+            removed.add(path)
+
+    return Changes(tuple(sorted(added)), tuple(sorted(modified)),
+                   tuple(sorted(removed)))
+
+
+class Refresher(threading.Thread):
+    """Keeps a cache.TextCache up to date in the background.
+
+    ePubs are re-extracted at no more than max_rate per second so
+    that searches running at the same time are not starved. When
+    a result_cache is given it is cleared after each batch, as
+    results for any scope containing a changed ePub are stale.
+    callback is called with the Changes of each batch, the paths of
+    the ePubs which were re-extracted and the errors.
+    """
+
+    def __init__(self, text_cache, result_cache=None, max_rate=10.0,
+                 callback=None):
+        super(Refresher, self).__init__()
+
+        # Do not keep the process alive
+        self.daemon = True
+
+        self.text_cache = text_cache
+        self.result_cache = result_cache
+        self.max_rate = max_rate
+        self.callback = callback
+
+        self.__queue = queue.Queue()
+
+    def submit(self, changes):
+        """Queues a Changes to be applied."""
+
+        self.__queue.put(changes)
+
+    def join_queue(self):
+        """Blocks until all submitted changes have been applied."""
+
+        self.__queue.join()
+
+    def __refresh(self, changes):
+        min_delay = 1.0 / self.max_rate if self.max_rate else 0
+        errors = []
+        updated = []
+
+        # Such as a full disk, other ePubs might still work
+        for path in changes.removed:
+            try:
+                self.text_cache.remove(path)
+
+            except Exception as e:
+                errors.append('Failed to remove %r: %s' % (path, e))
+
+        for path in changes.added + changes.modified:
+            # Also skips ePubs that were already up to date on startup
+            if self.text_cache.is_fresh(path):
+                continue
+
+            started = time.time()
+
+            try:
+                error = self.text_cache.update(path)
+
+            except Exception as e:
+                error = 'Failed to update %r: %s' % (path, e)
+
+            if error is not None:
+                errors.append(error)
+
+            else:
+                updated.append(path)
+
+            delay = min_delay - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        if self.result_cache is not None and (updated or changes.removed):
+            self.result_cache.clear()
+
+        if self.callback is not None:
+            self.callback(changes, tuple(updated), errors)
+
+    def run(self):
+        while 1:
+            changes = self.__queue.get()
+
+            try:
+                self.__refresh(changes)
+
+            # The thread must keep applying later changes
+            except Exception as e:
+                sys.stderr.write('Error: Failed to apply changes: %s\n' %
+                                 (e))
+
+            finally:
+                self.__queue.task_done()
+
+# ex:et:ts=4:
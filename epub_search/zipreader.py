@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+# epub-search - ePub content searching program
+# Copyright (C) 2013 Garrett Regier
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Reading zip members with as few reads as possible.
+
+zipfile seeks and reads a file object for each part of each member,
+which on network storage is a round-trip each time. ZipReader reads
+the end of the file, which has the central directory, with a single
+positional read, or the whole file when it is small. The members
+that will be needed can be prefetched with coalesced reads.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+import os
+import struct
+import zlib
+
+
+_END = struct.Struct('<4s4H2LH')
+_END_SIGNATURE = b'PK\x05\x06'
+
+_END64_LOCATOR = struct.Struct('<4sLQL')
+_END64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+
+_END64 = struct.Struct('<4sQ2H2L4Q')
+_END64_SIGNATURE = b'PK\x06\x06'
+
+_CENTRAL = struct.Struct('<4s6H3L5H2L')
+_CENTRAL_SIGNATURE = b'PK\x01\x02'
+
+_LOCAL = struct.Struct('<4s5H3L2H')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+_ZIP64_EXTRA = 0x0001
+
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+
+_STORED = 0
+_DEFLATED = 8
+
+# The end of central directory record can have a comment
+_MAX_COMMENT = 0xffff
+
+# Files this small are read whole by the first read
+_SMALL_SIZE = 1024 * 1024
+
+# Prefetches are joined when the gap between them is at most this
+_MAX_GAP = 64 * 1024
+
+
+ZipInfo = namedtuple('ZipInfo', ('filename', 'CRC', 'file_size',
+                                 'compress_size', 'compress_type',
+                                 'flag_bits', 'header_offset'))
+
+
+class BadZipFile(Exception):
+    """The error raised for files which are not zips or are corrupt."""
+
+
+def _pread(zip_file, length, offset):
+    # Python 2 does not have os.pread()
+    if hasattr(os, 'pread'):
+        return os.pread(zip_file.fileno(), length, offset)
+
+    zip_file.seek(offset)
+    return zip_file.read(length)
+
+
+def _zip64_values(extra, values):
+    # Replaces the values that are 0xffffffff
+    # with those from the zip64 extra field
+    position = 0
+
+    while position + 4 <= len(extra):
+        header_id, size = struct.unpack('<2H', extra[position:position + 4])
+        position += 4
+
+        if header_id == _ZIP64_EXTRA:
+            field = extra[position:position + size]
+            values = list(values)
+            i = 0
+
+            for j, value in enumerate(values):
+                if value == 0xffffffff:
+                    values[j], = struct.unpack('<Q', field[i:i + 8])
+                    i += 8
+
+            return values
+
+        position += size
+
+    return values
+
+
+class ZipReader(object):
+    """Reads the members of a zip.
+
+    Files of at most small_size bytes are read whole when opened.
+    When data is given it is the zip, such as one read from a bundle,
+    and path is not opened.
+    """
+
+    def __init__(self, path, small_size=_SMALL_SIZE, data=None):
+        self.path = path
+
+        self.__file = None
+
+        # Sorted (offset, data) of what has been read
+        self.__starts = []
+        self.__buffers = []
+
+        self.__infos = {}
+        self.__names = []
+
+        try:
+            if data is not None:
+                self.__add_buffer(0, data)
+                self.__read_directory(len(data), len(data))
+                return
+
+            self.__file = open(path, 'rb')
+            size = os.fstat(self.__file.fileno()).st_size
+            self.__read_directory(size, small_size)
+
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        self.__starts = []
+        self.__buffers = []
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __add_buffer(self, offset, data):
+        i = bisect_right(self.__starts, offset)
+        self.__starts.insert(i, offset)
+        self.__buffers.insert(i, data)
+
+    def __data(self, offset, length):
+        # Returns length bytes at offset, from what
+        # has been read already when it is possible
+        i = bisect_right(self.__starts, offset) - 1
+
+        if i >= 0:
+            start = self.__starts[i]
+            data = self.__buffers[i]
+
+            if offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+
+        # Everything is in memory
+        if self.__file is None:
+            return b''
+
+        return _pread(self.__file, length, offset)
+
+    def __read_directory(self, size, small_size):
+        if size < _END.size:
+            raise BadZipFile('File is not a zip file')
+
+        if size <= small_size:
+            tail_offset = 0
+
+        else:
+            tail_offset = max(0, size - (_END.size + _MAX_COMMENT +
+                                         _END64_LOCATOR.size + _END64.size))
+
+        tail = self.__data(tail_offset, size - tail_offset)
+        if self.__file is not None:
+            self.__add_buffer(tail_offset, tail)
+
+        end = tail.rfind(_END_SIGNATURE)
+        if end == -1 or end + _END.size > len(tail):
+            raise BadZipFile('File is not a zip file')
+
+        (signature, disk, directory_disk, n_disk_entries, n_entries,
+         directory_size, directory_offset, comment_length) = \
+            _END.unpack(tail[end:end + _END.size])
+
+        end_offset = tail_offset + end
+        locator = end - _END64_LOCATOR.size
+
+        if locator >= 0 and \
+           tail[locator:locator + 4] == _END64_LOCATOR_SIGNATURE:
+            signature, disk, end64_offset, n_disks = \
+                _END64_LOCATOR.unpack(tail[locator:end])
+
+            end64 = self.__data(end64_offset, _END64.size)
+            if end64[:4] != _END64_SIGNATURE:
+                raise BadZipFile('Corrupt zip64 end of central directory')
+
+            values = _END64.unpack(end64)
+            n_entries, directory_size, directory_offset = values[-3:]
+            end_offset = end64_offset
+
+        # Data might be prepended to the zip, such as a stub
+        concat = end_offset - directory_size - directory_offset
+        if concat < 0:
+            raise BadZipFile('Corrupt central directory')
+
+        directory = self.__data(directory_offset + concat, directory_size)
+        if len(directory) != directory_size:
+            raise BadZipFile('Truncated central directory')
+
+        position = 0
+        for i in range(n_entries):
+            header = directory[position:position + _CENTRAL.size]
+            if len(header) != _CENTRAL.size or \
+               header[:4] != _CENTRAL_SIGNATURE:
+                raise BadZipFile('Corrupt central directory')
+
+            (signature, version_made, version_needed, flag_bits, method,
+             time, date, crc, compress_size, file_size, name_length,
+             extra_length, comment_length, disk_start, internal_attributes,
+             external_attributes, header_offset) = _CENTRAL.unpack(header)
+
+            position += _CENTRAL.size
+            name = directory[position:position + name_length]
+            position += name_length
+            extra = directory[position:position + extra_length]
+            position += extra_length + comment_length
+
+            file_size, compress_size, header_offset = _zip64_values(
+                extra, (file_size, compress_size, header_offset))
+
+            # The same as zipfile
+            if flag_bits & _FLAG_UTF8:
+                name = bytes(name).decode('utf-8')
+
+            else:
+                name = bytes(name).decode('cp437')
+
+            info = ZipInfo(name, crc, file_size, compress_size, method,
+                           flag_bits, header_offset + concat)
+
+            # The local header usually has the same extra field
+            self.__infos[name] = (info, name_length + extra_length)
+            self.__names.append(name)
+
+    def namelist(self):
+        return list(self.__names)
+
+    def infolist(self):
+        return [self.__infos[name][0] for name in self.__names]
+
+    def __entry(self, name):
+        # The same error as zipfile's
+        try:
+            return self.__infos[name]
+
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' %
+                           (name))
+
+    def getinfo(self, name):
+        """Returns the ZipInfo for @name, raises KeyError if missing."""
+
+        return self.__entry(name)[0]
+
+    def prefetch(self, names):
+        """Reads the members @names with as few reads as possible.
+
+        Members which are close together are read together,
+        unknown names are ignored.
+        """
+
+        if self.__file is None:
+            return
+
+        ranges = []
+        for name in names:
+            entry = self.__infos.get(name, None)
+            if entry is None:
+                continue
+
+            info, header_extra = entry
+            start = info.header_offset
+            end = start + _LOCAL.size + header_extra + info.compress_size
+
+            # Already read, such as for small files
+            i = bisect_right(self.__starts, start) - 1
+            if i >= 0 and \
+               end <= self.__starts[i] + len(self.__buffers[i]):
+                continue
+
+            ranges.append((start, end))
+
+        ranges.sort()
+
+        merged = []
+        for start, end in ranges:
+            if merged and start - merged[-1][1] <= _MAX_GAP:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+
+            else:
+                merged.append((start, end))
+
+        for start, end in merged:
+            self.__add_buffer(start, _pread(self.__file, end - start, start))
+
+    def read(self, name):
+        """Returns the uncompressed data of the member @name."""
+
+        info, header_extra = self.__entry(name)
+
+        if info.flag_bits & _FLAG_ENCRYPTED:
+            raise BadZipFile('%r is encrypted' % (name))
+
+        # Usually read along with the local header
+        length = _LOCAL.size + header_extra + info.compress_size
+        data = self.__data(info.header_offset, length)
+
+        header = data[:_LOCAL.size]
+        if len(header) != _LOCAL.size or header[:4] != _LOCAL_SIGNATURE:
+            raise BadZipFile('Bad local header for %r' % (name))
+
+        name_length, extra_length = _LOCAL.unpack(header)[-2:]
+        start = _LOCAL.size + name_length + extra_length
+
+        if start + info.compress_size > len(data):
+            data = self.__data(info.header_offset,
+                               start + info.compress_size)
+
+        compressed = data[start:start + info.compress_size]
+        if len(compressed) != info.compress_size:
+            raise BadZipFile('Truncated data for %r' % (name))
+
+        if info.compress_type == _STORED:
+            uncompressed = bytes(compressed)
+
+        elif info.compress_type == _DEFLATED:
+            try:
+                uncompressed = zlib.decompress(compressed, -15)
+
+            except zlib.error as e:
+                raise BadZipFile('Bad data for %r: %s' % (name, e))
+
+        else:
+            raise BadZipFile('Unsupported compression %i for %r' %
+                             (info.compress_type, name))
+
+        if zlib.crc32(uncompressed) & 0xffffffff != info.CRC:
+            raise BadZipFile('Bad CRC-32 for %r' % (name))
+
+        return uncompressed
+
+# ex:et:ts=4:
@@ -24,6 +24,7 @@ def run_setup(with_extensions):
           author_email='garrettregier@gmail.com',
           url='http://github.com/gregier/epub-search',
           install_requires=['lxml'],
+          extras_require={'stats': ['numpy']},
           packages=['epub_search'],
           ext_modules=[] if not with_extensions else extensions,
           cmdclass={'build_ext': FailableBuildExt},